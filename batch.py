@@ -0,0 +1,237 @@
+"""
+Headless batch processing of feet sessions
+Usage:
+    batch.py [options] SESSION...
+
+Options:
+    SESSION                     Session directory or glob pattern (e.g. 'sessions/*')
+    -m --model=MODEL            Segmentation model [default: default_model.tflite]
+    -p --precision=P            Use the float32, float16 or int8 variant of the model (<model>_int8.tflite)
+    -c --cmap=CMAP              Input colormap (Gris or Hierro) [default: Gris]
+    -s --min-size=SIZE          Post processing small object threshold [default: 2500]
+    -r --scale=RANGE            Fixed temperature scale 'min,max'. Read from images if not given
+    -w --workers=N              Number of worker processes (defaults to all cores)
+    -o --output=DIR             Output directory name inside each session [default: outputs]
+    --cold-start                Register the dermatomes of every frame from scratch
+    --format=EXT                Format of the segmented images (png, jpg, webp) [default: png]
+    --quality=Q                 Encoding quality of the segmented images, 0-100 [default: 95]
+    --memory=MB                 Working memory budget per worker for streaming the frames [default: 512]
+    --ocr-cache=PATH            Tesseract results cache shared between sessions [default: outputs/ocr_cache.json]
+"""
+import matplotlib
+matplotlib.use('Agg')
+
+import docopt
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from multiprocessing import Pool, cpu_count
+
+import cv2
+import numpy as np
+
+from segment import SessionToSegment, normalize_inputs
+from postprocessing import PostProcessing
+from temperatures import mean_temperature, session_dermatomes_temperatures, session_statistics
+from report import render_report
+from writer import OutputWriter
+from session import find_session_images, get_times
+from interpreters import registry, PRECISIONS, model_variant
+from tuning import TuningStore
+import scales
+
+
+#State of each worker process, filled by init_worker
+_worker = {}
+
+
+def init_worker(model, options):
+    """
+    Loads one segmentation interpreter per worker process
+    """
+    registry.settings_provider = worker_settings(TuningStore(), options['threads'])
+    s2s = SessionToSegment(memory_budget = options['memory'])
+    s2s.setModel(model)
+    s2s.loadModel()
+    _worker['s2s'] = s2s
+    _worker['ocr_cache'] = scales.OCRCache(options['ocr_cache'])
+    _worker['writer'] = OutputWriter(workers = 2, quality = options['quality'], format = options['format'])
+    _worker['options'] = options
+
+
+def worker_settings(store, threads):
+    """
+    Tuned interpreter settings (config.json) with at most threads interpreter threads,
+    as every worker process runs its own interpreter
+    """
+    def provider(path):
+        settings = dict(store.lookup(path) or {})
+        settings['num_threads'] = min(settings.get('num_threads') or threads, threads)
+        return settings
+    return provider
+
+
+def segment_session(s2s, writer, files, cmap, min_size, output_dir, read_scales = True, ocr_cache = None, threshold = 0.5):
+    """
+    Segments, post processes and writes the masks of a session, streaming it in chunks
+    so only one chunk of full resolution frames is in memory at a time
+    Returns the (H,W,1) masks in the model input resolution, the normalized model
+    inputs and the scales read from the frames (empty if read_scales is False)
+    """
+    post_processing = PostProcessing(min_size)
+    recognizer = scales.DigitRecognizer() if read_scales else None
+    masks, inputs, scale_range, futures = [], [], [], []
+    for chunk in s2s.stream(files, cmap = cmap):
+        Y = chunk.Y_pred / chunk.Y_pred.max(axis=(1,2,3), keepdims=True)
+        Y = np.where( Y >= threshold  , 1 , 0)
+        chunk_masks = list(post_processing.execute_batch(Y))
+        futures += write_masks(writer, chunk.files, chunk_masks, chunk.images, output_dir)
+        if read_scales:
+            scale_range.extend(scales.extract_multiple_scales(chunk.images, recognizer = recognizer, cache = ocr_cache))
+        masks.extend(chunk_masks)
+        inputs.append(chunk.X)
+    for future in futures:
+        future.result()
+    return masks, normalize_inputs(np.concatenate(inputs)), scale_range
+
+
+def session_temperatures(Xarray, masks, scale_range, warm_start = True):
+    """
+    Mean and dermatomes temperatures for all the frames of a session
+    scale_range is either a list with one [min, max] per frame or a single [min, max]
+    warm_start: start the dermatomes registration of each frame from the previous one
+    """
+    mean_temps, segmented_temps, original_temps = [], [], []
+    for i in range(len(masks)):
+        range_ = scale_range[i] if np.ndim(scale_range) == 2 else scale_range
+        mean_out, temp, original_temp = mean_temperature(Xarray[i,:,:,0] , masks[i][:,:,0] , range_, plot = False)
+        mean_temps.append(mean_out)
+        segmented_temps.append(temp)
+        original_temps.append(original_temp)
+    #Sessions already run in parallel processes, register the frames of each one serially
+    dermatomes_temps, dermatomes_masks = session_dermatomes_temperatures(original_temps, masks, workers = 1, warm_start = warm_start)
+    return (mean_temps, np.array(segmented_temps), np.array(original_temps),
+            dermatomes_temps, dermatomes_masks)
+
+
+def write_masks(writer, files, masks, frames, output_dir):
+    """
+    Writes binary masks and queues the segmented images (input image under the mask)
+    Returns the futures of the segmented images
+    """
+    futures = []
+    for file, mask, img in zip(files, masks, frames):
+        name = os.path.splitext(os.path.basename(file))[0]
+        full_mask = cv2.resize(mask, (img.shape[1],img.shape[0]), interpolation = cv2.INTER_NEAREST)
+        cv2.imwrite(os.path.join(output_dir, f'{name}_mask.png'), (255*full_mask).astype('uint8'))
+        futures.append(writer.submit(os.path.join(output_dir, f'{name}.png'), mask, image = img))
+    return futures
+
+
+def process_session(session_dir):
+    """
+    Full pipeline for one session directory. Runs inside a worker process
+    """
+    s2s = _worker['s2s']
+    options = _worker['options']
+    t0 = time.time()
+    files = find_session_images(session_dir)
+    if not files:
+        return session_dir, 'skipped', 'no jpg images found', 0
+
+    try:
+        times = get_times(files)
+        output_dir = os.path.join(session_dir, options['output'])
+        os.makedirs(output_dir, exist_ok = True)
+
+        masks, Xarray, scale_range = segment_session(s2s, _worker['writer'], files, options['cmap'], options['min_size'], output_dir,
+                                                     read_scales = options['scale'] is None,
+                                                     ocr_cache = _worker['ocr_cache'])
+        _worker['ocr_cache'].save()     #Once per session, merged with the other workers' entries
+        if options['scale'] is not None:
+            scale_range = [list(options['scale'])]*len(files)
+
+        (mean_temps, segmented_temps, original_temps,
+         dermatomes_temps, dermatomes_masks) = session_temperatures(Xarray, masks, scale_range, not options['cold_start'])
+        np.save(os.path.join(output_dir, 'temperatures.npy'), original_temps)
+        np.save(os.path.join(output_dir, 'dermatomes_masks.npy'), dermatomes_masks)
+
+        exit_value = render_report(img_temps = original_temps, segmented_temps = segmented_temps, mean_temps = list(mean_temps),
+                                   times = times, path = os.path.join(session_dir, 'report'),
+                                   dermatomes_temps = dermatomes_temps, dermatomes_masks = dermatomes_masks)
+
+        session_info = {'Modelo': os.path.basename(s2s.model),
+                        'Tiempos': times,
+                        'Temperaturas_medias': mean_temps,
+                        'Escalas_de_temperatura': [list(map(float, s)) for s in scale_range],
+                        'Temperaturas_de_dermatomas': dermatomes_temps.tolist()}
+        statistics = session_statistics(original_temps, masks, dermatomes_masks)
+        session_info['Estadisticas'] = {group: {key: value.tolist() for key, value in stats.items()}
+                                        for group, stats in statistics.items()}
+        with open(os.path.join(session_dir, 'report.json'), 'w') as outfile:
+            json.dump(session_info, outfile, default = float)
+
+        status = 'ok' if exit_value == 0 else 'nan'
+        return session_dir, status, f'{len(files)} images', time.time() - t0
+    except Exception:
+        return session_dir, 'error', traceback.format_exc(), time.time() - t0
+
+
+def expand_sessions(patterns):
+    """
+    Expands glob patterns into a sorted list of unique session directories
+    """
+    sessions = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(path) and path not in sessions:
+                sessions.append(path)
+    return sessions
+
+
+def main(args):
+    sessions = expand_sessions(args['SESSION'])
+    if not sessions:
+        print('No session directories found')
+        return 1
+
+    workers = int(args['--workers']) if args['--workers'] else cpu_count()
+    workers = max(1, min(workers, len(sessions)))
+    options = {'cmap': args['--cmap'],
+               'min_size': int(args['--min-size']),
+               'scale': [float(v) for v in args['--scale'].split(',')] if args['--scale'] else None,
+               'output': args['--output'],
+               'cold_start': args['--cold-start'],
+               'format': args['--format'],
+               'quality': int(args['--quality']),
+               'memory': int(args['--memory'])*2**20,
+               'ocr_cache': args['--ocr-cache'],
+               'threads': max(1, cpu_count()//workers)}
+
+    model = args['--model']
+    if args['--precision']:
+        if args['--precision'] not in PRECISIONS:
+            print(f"Unknown precision {args['--precision']}, use one of {', '.join(PRECISIONS)}")
+            return 2
+        model = model_variant(model, args['--precision'])
+        if not os.path.isfile(model):
+            print(f'Model {model} not found')
+            return 2
+
+    print(f'Processing {len(sessions)} sessions with {workers} workers')
+    t0 = time.time()
+    failed = 0
+    with Pool(workers, initializer = init_worker, initargs = (model, options)) as pool:
+        for i, (session_dir, status, detail, elapsed) in enumerate(pool.imap_unordered(process_session, sessions)):
+            print(f'[{i+1}/{len(sessions)}] {session_dir}: {status} ({elapsed:.1f} s) {detail}')
+            failed += status == 'error'
+    print(f'Done in {time.time()-t0:.1f} s, {failed} failed')
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
@@ -0,0 +1,354 @@
+"""
+Per-stage benchmarks of the session pipeline
+Usage:
+    benchmark.py [options]
+
+Options:
+    -i --image=PATH         Thermographic image [default: images/example_image.jpg]
+    -k --mask=PATH          Segmentation mask of the image [default: images/example_maks.png]
+    -m --model=MODEL        Segmentation model, inference stages are skipped if missing [default: default_model.tflite]
+    -n --frames=N           Frames of the synthetic session [default: 20]
+    -r --repeats=N          Timed repetitions of each stage [default: 20]
+    -s --stages=LIST        Comma separated stages to run (all by default)
+    -o --output=PATH        Write the results as JSON (e.g. to save a baseline)
+    -b --baseline=PATH      Compare against saved results, exits with 1 on regressions
+    -t --tolerance=T        Allowed relative slowdown of the fastest run against the baseline [default: 0.2]
+    -f --noise-floor=MS     Stages faster than this in the baseline are not checked [default: 5]
+    -a --retries=N          Times a regressed stage is measured again before it is reported [default: 2]
+
+Stages: decode, preprocess, invoke, postprocessing, extract_feet, registration,
+temperatures, scales_digits, scales_tesseract, report, end_to_end
+"""
+import matplotlib
+matplotlib.use('Agg')
+
+import docopt
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from segment import ImageToSegment, SessionToSegment, read_frame, normalize_inputs
+from postprocessing import PostProcessing
+from dermatomes import extract_feet, get_dermatomes, SessionRegistration
+from temperatures import mean_temperature, dermatomes_temperatures, session_statistics
+from report import render_report
+import scales
+
+
+STAGES = ['decode', 'preprocess', 'invoke', 'postprocessing', 'extract_feet', 'registration',
+          'temperatures', 'scales_digits', 'scales_tesseract', 'report', 'end_to_end']
+
+
+class Skip(Exception):
+    """
+    Raised by a stage that cannot run here (e.g. missing model)
+    """
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB, since it started
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10     #Bytes on macOS, KB on Linux
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process in MB, None where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError, ValueError):
+        return None
+
+
+class RSSSampler(threading.Thread):
+    """
+    Samples the resident set size while a stage runs. stop() returns the peak above the
+    size at start, i.e. the memory the stage itself needed
+    """
+    def __init__(self, interval = 0.005):
+        super(RSSSampler, self).__init__(daemon = True)
+        self.interval = interval
+        self.start_mb = current_rss_mb()
+        self.peak_mb = self.start_mb
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        if self.start_mb is None:
+            return None
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return self.peak_mb - self.start_mb
+
+
+def measure(function, repeats = 20, items = 1, warmup = 1):
+    """
+    Runs function warmup + repeats times. Returns latency statistics (ms), throughput
+    (items per second) and the memory growth of the stage, sampled during the warmup
+    runs (or the first run without warmup) so that the sampler does not slow down the
+    rest. min_ms and the trimmed mean (middle half of the runs) are the least sensitive
+    to other load on the machine
+    """
+    sampler = RSSSampler()
+    if sampler.start_mb is not None:
+        sampler.start()
+    growth_mb = None
+    for _ in range(warmup):
+        function()
+    if warmup and sampler.is_alive():
+        growth_mb = sampler.stop()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+        if sampler.is_alive():
+            growth_mb = sampler.stop()
+    times = np.sort(times)*1000
+    middle = times[len(times)//4:len(times) - len(times)//4]
+    return {'repeats': repeats,
+            'items': items,
+            'mean_ms': float(times.mean()),
+            'min_ms': float(times.min()),
+            'trimmed_mean_ms': float(middle.mean()),
+            'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90)),
+            'p99_ms': float(np.percentile(times, 99)),
+            'throughput': float(items/(times.mean()/1000)),
+            'rss_growth_mb': growth_mb}
+
+
+def make_session(image_path, mask_path, frames, directory, seed = 0):
+    """
+    Synthetic session of frames jpgs built from the example image, slightly shifted and
+    with noise so frames differ. Returns the file list and the (frames,224,224,1) masks
+    """
+    rng = np.random.default_rng(seed)
+    img = cv2.imread(image_path)
+    mask = (cv2.imread(mask_path)[:,:,0] != 0).astype('uint8')
+    files, masks = [], []
+    for i in range(frames):
+        dy, dx = rng.integers(-4, 5, size = 2)
+        frame = np.roll(img, (dy, dx), axis = (0, 1)).astype('int16') + rng.integers(-3, 4, size = img.shape)
+        files.append(os.path.join(directory, f't{5*i}.jpg'))
+        cv2.imwrite(files[-1], np.clip(frame, 0, 255).astype('uint8'))
+        shifted = np.roll(mask, (dy, dx), axis = (0, 1))
+        masks.append(cv2.resize(shifted, (224, 224), interpolation = cv2.INTER_NEAREST)[:,:,None])
+    return files, np.array(masks, dtype = 'float32')
+
+
+class Benchmark():
+    """
+    Holds the synthetic session and the inputs shared by the stages
+    """
+    def __init__(self, image_path, mask_path, model, frames, repeats):
+        self.directory = tempfile.mkdtemp(prefix = 'feet_benchmark_')
+        self.files, self.masks = make_session(image_path, mask_path, frames, self.directory)
+        self.model = model if os.path.isfile(model) else None
+        self.repeats = repeats
+        self.frames = np.array([read_frame(f, 'Gris') for f in self.files])
+        X = np.array([cv2.resize(f, (224, 224), interpolation = cv2.INTER_NEAREST) for f in self.frames])
+        self.Xarray = normalize_inputs(X)
+        self.scale_range = [25, 45]
+        self.original_temps = np.array([mean_temperature(x[:,:,0], m[:,:,0], self.scale_range)[2]
+                                        for x, m in zip(self.Xarray, self.masks)])
+        self.dermatomes_masks = None
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def require_model(self):
+        if self.model is None:
+            raise Skip('segmentation model not found')
+
+    def decode(self):
+        return measure(lambda: [read_frame(f, 'Gris') for f in self.files], self.repeats, len(self.files))
+
+    def preprocess(self):
+        size = 224
+        def run():
+            X = np.array([cv2.resize(f, (size, size), interpolation = cv2.INTER_NEAREST) for f in self.frames])
+            return normalize_inputs(X), np.float32(X)/np.float32(255)
+        return measure(run, self.repeats, len(self.frames))
+
+    def invoke(self):
+        self.require_model()
+        s2s = SessionToSegment()
+        s2s.setModel(self.model)
+        size = s2s.input_shape()
+        X = np.float32([cv2.resize(f, (size, size), interpolation = cv2.INTER_NEAREST) for f in self.frames])/255
+        return measure(lambda: s2s.predict(X), self.repeats, len(X))
+
+    def postprocessing(self):
+        post_processing = PostProcessing(2500)
+        return measure(lambda: post_processing.execute_batch(self.masks), self.repeats, len(self.masks))
+
+    def extract_feet(self):
+        masks = self.masks[:,:,:,0] != 0
+        return measure(lambda: [extract_feet(m) for m in masks], self.repeats, len(masks))
+
+    def registration(self):
+        masks = self.masks[:,:,:,0].astype('uint8')
+        def run():
+            registration = SessionRegistration()
+            self.dermatomes_masks = np.array([get_dermatomes(m, registration = registration) for m in masks])
+        return measure(run, max(1, self.repeats//5), len(masks), warmup = 0)
+
+    def temperatures(self):
+        if self.dermatomes_masks is None:
+            self.registration()
+        def run():
+            for x, m in zip(self.Xarray, self.masks):
+                mean_temperature(x[:,:,0], m[:,:,0], self.scale_range)
+            session_statistics(self.original_temps, self.masks, self.dermatomes_masks)
+        return measure(run, self.repeats, len(self.masks))
+
+    def scales_digits(self):
+        recognizer = scales.DigitRecognizer()
+        return measure(lambda: recognizer.predict(self.frames), self.repeats, len(self.frames))
+
+    def scales_tesseract(self):
+        """
+        Tesseract fallback of the scale reading, without the OCR cache
+        """
+        if shutil.which('tesseract') is None:
+            raise Skip('tesseract not found')
+        return measure(lambda: scales.extract_multiple_scales_with_pytesseract(self.frames),
+                       max(1, self.repeats//5), len(self.frames))
+
+    def report(self):
+        if self.dermatomes_masks is None:
+            self.registration()
+        segmented_temps = self.original_temps*self.masks[:,:,:,0]
+        dermatomes_temps = np.zeros((len(self.files), 10))
+        path = os.path.join(self.directory, 'report')
+        return measure(lambda: render_report(self.original_temps, segmented_temps, [[30, 31]]*len(self.files),
+                                             dermatomes_temps, self.dermatomes_masks, list(range(len(self.files))), path),
+                       max(1, self.repeats//2), len(self.files))
+
+    def end_to_end(self):
+        self.require_model()
+        def run():
+            s2s = SessionToSegment()
+            s2s.setModel(self.model)
+            s2s.whole_extract(self.files, cmap = 'Gris', keep_images = True)
+            Y = s2s.Y_pred / s2s.Y_pred.max(axis=(1,2,3), keepdims=True)
+            masks = PostProcessing(2500).execute_batch(np.where(Y >= 0.5, 1, 0))
+            scale_range = scales.DigitRecognizer().predict(s2s.img_array)[0]
+            registration = SessionRegistration()
+            temps = [mean_temperature(s2s.Xarray[i,:,:,0], masks[i][:,:,0], scale_range[i]) for i in range(len(masks))]
+            original_temps = np.array([t[2] for t in temps])
+            dermatomes = [dermatomes_temperatures(original_temps[i], masks[i], registration) for i in range(len(masks))]
+            render_report(original_temps, np.array([t[1] for t in temps]), [t[0] for t in temps],
+                          np.array([d[0] for d in dermatomes]), np.array([d[1] for d in dermatomes]),
+                          list(range(len(masks))), os.path.join(self.directory, 'report'))
+        return measure(run, max(1, self.repeats//5), len(self.files), warmup = 0)
+
+
+def compare(results, baseline, tolerance, noise_floor = 5, metric = 'min_ms'):
+    """
+    Prints the fastest run of every stage against the baseline. Returns the regressed
+    stages. Stages below noise_floor ms in the baseline are shown but not checked
+    """
+    regressions = []
+    print(f"\n{'stage':<18}{'baseline ms':>14}{'current ms':>14}{'ratio':>8}")
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if metric not in current or not previous or metric not in previous:
+            continue
+        ratio = current[metric]/previous[metric]
+        flag = ''
+        if previous[metric] < noise_floor:
+            flag = '  (below noise floor)'
+        elif ratio > 1 + tolerance:
+            regressions.append(stage)
+            flag = '  REGRESSION'
+        print(f"{stage:<18}{previous[metric]:>14.2f}{current[metric]:>14.2f}{ratio:>8.2f}{flag}")
+    return regressions
+
+
+def run_stage(bench, stage):
+    try:
+        result = getattr(bench, stage)()
+        growth = '' if result['rss_growth_mb'] is None else f"  RSS +{result['rss_growth_mb']:.0f} MB"
+        print(f"{stage:<18}min {result['min_ms']:9.2f} ms  p50 {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms  "
+              f"{result['throughput']:9.1f} frames/s{growth}")
+    except Skip as e:
+        result = {'skipped': str(e)}
+        print(f'{stage:<18}skipped: {e}')
+    return result
+
+
+def main(args):
+    stages = args['--stages'].split(',') if args['--stages'] else STAGES
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        print(f"Unknown stages: {', '.join(sorted(unknown))}")
+        return 2
+
+    frames = int(args['--frames'])
+    bench = Benchmark(args['--image'], args['--mask'], args['--model'], frames, int(args['--repeats']))
+    results = {'host': {'hostname': platform.node(),
+                        'machine': platform.machine(),
+                        'platform': platform.platform(),
+                        'cpus': os.cpu_count(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'opencv': cv2.__version__},
+               'frames': frames,
+               'model': args['--model'],
+               'stages': {}}
+    try:
+        for stage in stages:
+            results['stages'][stage] = run_stage(bench, stage)
+
+        regressions = []
+        if args['--baseline']:
+            with open(args['--baseline']) as infile:
+                baseline = json.load(infile)
+            tolerance, noise_floor = float(args['--tolerance']), float(args['--noise-floor'])
+            regressions = compare(results, baseline, tolerance, noise_floor)
+            #Other load on the machine comes in bursts: keep the fastest of several measurements
+            for _ in range(int(args['--retries'])):
+                if not regressions:
+                    break
+                print(f"\nMeasuring again: {', '.join(regressions)}")
+                for stage in regressions:
+                    result = run_stage(bench, stage)
+                    if result['min_ms'] < results['stages'][stage]['min_ms']:
+                        results['stages'][stage] = result
+                regressions = compare(results, baseline, tolerance, noise_floor)
+    finally:
+        bench.close()
+    results['process_peak_rss_mb'] = peak_rss_mb()
+
+    if args['--output']:
+        with open(args['--output'], 'w') as outfile:
+            json.dump(results, outfile, indent = 2)
+
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
@@ -0,0 +1,142 @@
+#Camera acquisition on a dedicated thread
+
+import queue
+import threading
+import time
+import numpy as np
+import cv2
+
+
+class CameraReader(threading.Thread):
+    """
+    Reads frames from cv2.VideoCapture into a preallocated ring buffer of RGB frames.
+    The consumer takes the latest frame with acquire_latest(). The slot it gets is not
+    written again until the next call, so it can be handed to QImage without copies.
+    If the camera fails, the reader retries on the next camera indices without
+    blocking the consumer.
+    """
+    def __init__(self, index = 0, width = 640, height = 480, slots = 4, max_index = 5, retry_delay = 1.0):
+        super(CameraReader, self).__init__(daemon = True)
+        self.index = index
+        self.first_index = index
+        self.max_index = max_index
+        self.width = width
+        self.height = height
+        self.retry_delay = retry_delay
+        self.buffer = np.empty((slots, height, width, 3), dtype = np.uint8)
+        self.timestamps = np.zeros(slots)
+        self.lock = threading.Lock()
+        self.messages = queue.Queue()
+        self.capture = None
+        self.running = True
+        self.latest_slot = -1
+        self.reading_slot = -1
+        self.sequence = 0
+        self.consumed_sequence = 0
+        #Metrics
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.read_failures = 0
+        self.reconnects = 0
+        self.latency = 0.0
+        self.fps = 0.0
+        self.last_read_time = None
+
+    def open(self):
+        capture = cv2.VideoCapture(self.index)
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        if capture.isOpened():
+            self.capture = capture
+            return True
+        capture.release()
+        return False
+
+    def next_index(self):
+        self.messages.put(f'No se detectó cámara {self.index}. Reintentando...')
+        print(f'Camera was not detected on index {self.index}')
+        if self.index < self.max_index:
+            self.index += 1
+            print(f'Retrying with index {self.index}...')
+        else:
+            self.messages.put("Error detectando cámara. Por favor revisar conexión.")
+            self.index = self.first_index
+        self.reconnects += 1
+        time.sleep(self.retry_delay)
+
+    def run(self):
+        while self.running:
+            if self.capture is None and not self.open():
+                self.next_index()
+                continue
+            ret, frame = self.capture.read()
+            if not ret or frame is None:
+                self.read_failures += 1
+                self.capture.release()
+                self.capture = None
+                self.next_index()
+                continue
+            self.write(frame)
+        if self.capture is not None:
+            self.capture.release()
+
+    def write(self, frame):
+        with self.lock:
+            slot = (self.latest_slot + 1) % len(self.buffer)
+            if slot == self.reading_slot:
+                slot = (slot + 1) % len(self.buffer)
+        if frame.shape[:2] != (self.height, self.width):
+            frame = cv2.resize(frame, (self.width, self.height))
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst = self.buffer[slot])
+        now = time.time()
+        with self.lock:
+            if self.sequence > self.consumed_sequence:
+                self.frames_dropped += 1      #Previous frame was never consumed
+            self.latest_slot = slot
+            self.timestamps[slot] = now
+            self.sequence += 1
+            self.frames_read += 1
+            if self.last_read_time is not None:
+                self.fps = 0.9*self.fps + 0.1/max(now - self.last_read_time, 1e-6)
+            self.last_read_time = now
+
+    def acquire_latest(self):
+        """
+        Returns (sequence, frame) with the latest frame, or None if there is no new one.
+        The frame is a view of the ring buffer, valid until the next call
+        """
+        with self.lock:
+            if self.latest_slot < 0 or self.sequence == self.consumed_sequence:
+                return None
+            self.reading_slot = self.latest_slot
+            self.consumed_sequence = self.sequence
+            self.latency = 0.9*self.latency + 0.1*(time.time() - self.timestamps[self.reading_slot])
+            return self.sequence, self.buffer[self.reading_slot]
+
+    def snapshot(self):
+        """
+        Copy of the latest frame (None if no frame was read yet)
+        """
+        with self.lock:
+            if self.latest_slot < 0:
+                return None
+            return self.buffer[self.latest_slot].copy()
+
+    def pop_messages(self):
+        messages = []
+        while not self.messages.empty():
+            messages.append(self.messages.get_nowait())
+        return messages
+
+    def metrics(self):
+        return {'fps': self.fps,
+                'latency_ms': 1000*self.latency,
+                'frames_read': self.frames_read,
+                'frames_dropped': self.frames_dropped,
+                'read_failures': self.read_failures,
+                'reconnects': self.reconnects,
+                'camera_index': self.index}
+
+    def stop(self):
+        self.running = False
+        self.join(timeout = 2)
@@ -0,0 +1,222 @@
+"""
+Benchmark of every segmentation model of a folder over images with ground truth masks
+Usage:
+    compare_models.py [options] MODELS_DIR [PAIR...]
+
+Options:
+    MODELS_DIR              Folder with the .tflite models, as loaded in the interface
+    PAIR                    image:mask pairs [default: images/example_image.jpg:images/example_maks.png]
+    -d --dataset=DIR        Folder of images with masks in DIR/masks/<name>.png or DIR/<name>_mask.png
+    -c --cmap=CMAP          Input colormap (Gris or Hierro) [default: Gris]
+    -s --min-size=SIZE      Post processing small object threshold [default: 2500]
+    -r --scale=RANGE        Temperature scale 'min,max'. Read from the images if not given
+    -n --repeats=N          Timed invokes per image [default: 10]
+    -w --workers=N          Models benchmarked concurrently (defaults to all cores, up to the models)
+    -b --budget=MS          Latency budget (p95 ms), picks the most accurate model within it
+    -o --output=PATH        Write the results as JSON
+"""
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import traceback
+
+import cv2
+import numpy as np
+
+from interpreters import registry
+from metrics import masks_from, dice, iou
+from postprocessing import PostProcessing
+from segment import read_frame
+from temperatures import mean_temperature
+import scales
+
+
+DEFAULT_PAIRS = ['images/example_image.jpg:images/example_maks.png']
+
+
+def find_models(models_dir):
+    return sorted(os.path.join(root, name) for root, dirs, files in os.walk(models_dir)
+                  for name in files if name.endswith('.tflite'))
+
+
+def find_pairs(dataset_dir):
+    """
+    (image, mask) pairs of a folder: masks in masks/<name>.png or <name>_mask.png
+    """
+    pairs = []
+    for image in sorted(glob.glob(os.path.join(dataset_dir, '*.jpg')) + glob.glob(os.path.join(dataset_dir, '*.png'))):
+        name = os.path.splitext(os.path.basename(image))[0]
+        if name.endswith('_mask'):
+            continue
+        for mask in (os.path.join(dataset_dir, 'masks', name + '.png'), os.path.join(dataset_dir, name + '_mask.png')):
+            if os.path.isfile(mask):
+                pairs.append((image, mask))
+                break
+    return pairs
+
+
+def parse_pairs(pairs):
+    return [tuple(pair.rsplit(':', 1)) for pair in pairs]
+
+
+def load_reference(pairs, cmap = 'Gris'):
+    """
+    Frames (uint8) and boolean ground truth masks of the reference set
+    """
+    images, masks = [], []
+    for image_path, mask_path in pairs:
+        images.append(read_frame(image_path, cmap))
+        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            raise FileNotFoundError(mask_path)
+        masks.append(mask != 0)
+    return images, masks
+
+
+def feet_mean(img, mask, scale_range):
+    """
+    Mean feet temperature as computed downstream (both feet averaged)
+    """
+    if not mask.any():
+        return float('nan')
+    means = mean_temperature(img, mask, scale_range)[0]
+    return float(np.mean(means))
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10     #Bytes on macOS, KB on Linux
+
+
+def evaluate_model(task):
+    """
+    Latency and accuracy of one model on the reference set. Runs in a worker process
+    """
+    model_path, images, gt_masks, scale_ranges, options = task
+    try:
+        registry.set_settings(model_path, {'num_threads': options['threads']})
+        input_details, _ = registry.load(model_path)
+        size = input_details[0]['shape'][1]
+        post_processing = PostProcessing(options['min_size'])
+        times, dice_scores, iou_scores, temperature_errors = [], [], [], []
+        with registry.lease(model_path) as model:
+            model.resize_batch(1)
+            for img, gt, scale_range in zip(images, gt_masks, scale_ranges):
+                X = cv2.resize(img, (size, size), interpolation = cv2.INTER_NEAREST)[None]
+                model.predict(X, scale = 1/255)     #Warm up
+                for _ in range(options['repeats']):
+                    t0 = time.perf_counter()
+                    Y = model.predict(X, scale = 1/255)
+                    times.append(1000*(time.perf_counter() - t0))
+                mask = post_processing.execute(masks_from(Y, options['threshold'])[0].astype('uint8'))[:,:,0] != 0
+                gt = cv2.resize(gt.astype('uint8'), (size, size), interpolation = cv2.INTER_NEAREST) != 0
+                dice_scores.append(dice(mask, gt))
+                iou_scores.append(iou(mask, gt))
+                Xarray = X[0,:,:,0]/max(X.max(), 1)
+                temperature_errors.append(abs(feet_mean(Xarray, mask, scale_range) - feet_mean(Xarray, gt, scale_range)))
+        times = np.array(times)
+        return {'model': model_path,
+                'precision': registry.precision(model_path),
+                'input_size': int(size),
+                'p50_ms': float(np.percentile(times, 50)),
+                'p95_ms': float(np.percentile(times, 95)),
+                'throughput': float(1000/times.mean()),
+                'peak_rss_mb': peak_rss_mb(),
+                'dice': float(np.mean(dice_scores)),
+                'iou': float(np.mean(iou_scores)),
+                'temperature_error': float(np.nanmean(temperature_errors)) if not np.all(np.isnan(temperature_errors)) else None}
+    except Exception as e:
+        return {'model': model_path, 'error': f'{type(e).__name__}: {e}', 'traceback': traceback.format_exc()}
+
+
+def compare(models, pairs, cmap = 'Gris', min_size = 2500, scale = None, repeats = 10, workers = None,
+            threshold = 0.5, progress = None):
+    """
+    Benchmarks every model in a pool of worker processes, a fresh process per model so the
+    peak memory is its own. Interpreter threads are split between the workers.
+    progress: callable(done, total)
+    """
+    images, gt_masks = load_reference(pairs, cmap)
+    if scale is not None:
+        scale_ranges = [list(scale)]*len(images)
+    else:
+        scale_ranges = [list(s) for s in scales.DigitRecognizer().predict(np.array(images))[0]]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(models)))
+    options = {'min_size': min_size, 'repeats': repeats, 'threshold': threshold,
+               'threads': max(1, (os.cpu_count() or 1)//workers)}
+    tasks = [(model, images, gt_masks, scale_ranges, options) for model in models]
+    results = []
+    #spawn: the interface process has Qt threads running, fork is not safe there
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, maxtasksperchild = 1) as pool:
+        for result in pool.imap_unordered(evaluate_model, tasks):
+            results.append(result)
+            if progress is not None:
+                progress(len(results), len(tasks))
+    results.sort(key = lambda r: models.index(r['model']))
+    return results
+
+
+def pick_model(results, budget_ms):
+    """
+    Most accurate (Dice) model whose p95 latency is within the budget, or None
+    """
+    within = [r for r in results if 'error' not in r and r['p95_ms'] <= budget_ms]
+    return max(within, key = lambda r: r['dice']) if within else None
+
+
+def format_table(results):
+    lines = [f"{'model':<32}{'precision':>10}{'p50 ms':>10}{'p95 ms':>10}{'frames/s':>10}{'RSS MB':>8}"
+             f"{'Dice':>8}{'IoU':>8}{'ΔT °C':>8}"]
+    for r in results:
+        name = os.path.basename(r['model'])
+        if 'error' in r:
+            lines.append(f"{name:<32}  {r['error']}")
+            continue
+        error = f"{r['temperature_error']:>8.3f}" if r['temperature_error'] is not None else f"{'-':>8}"
+        lines.append(f"{name:<32}{r['precision']:>10}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['throughput']:>10.1f}"
+                     f"{r['peak_rss_mb']:>8.0f}{r['dice']:>8.4f}{r['iou']:>8.4f}{error}")
+    return lines
+
+
+def save_results(path, results, pairs, **settings):
+    with open(path, 'w') as outfile:
+        json.dump({'pairs': pairs, 'settings': settings, 'results': results}, outfile, indent = 2)
+
+
+def main(args):
+    models = find_models(args['MODELS_DIR'])
+    if args['--dataset']:
+        pairs = find_pairs(args['--dataset'])
+    else:
+        pairs = parse_pairs(args['PAIR'] or DEFAULT_PAIRS)
+    if not models:
+        print(f"No .tflite models in {args['MODELS_DIR']}")
+        return 2
+    if not pairs:
+        print('No images with ground truth masks')
+        return 2
+
+    scale = [float(v) for v in args['--scale'].split(',')] if args['--scale'] else None
+    workers = int(args['--workers']) if args['--workers'] else None
+    print(f'Comparing {len(models)} models on {len(pairs)} images')
+    results = compare(models, pairs, args['--cmap'], int(args['--min-size']), scale, int(args['--repeats']), workers,
+                      progress = lambda done, total: print(f'[{done}/{total}]'))
+    print('\n'.join(format_table(results)))
+    if args['--budget']:
+        best = pick_model(results, float(args['--budget']))
+        print(f"\nBest within {args['--budget']} ms: " + (os.path.basename(best['model']) if best else 'none'))
+    if args['--output']:
+        save_results(args['--output'], results, pairs, cmap = args['--cmap'], min_size = int(args['--min-size']),
+                     scale = scale, repeats = int(args['--repeats']))
+    return 0
+
+
+if __name__ == "__main__":
+    import docopt
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
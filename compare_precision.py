@@ -0,0 +1,113 @@
+"""
+Accuracy and latency of the reduced precision variants of a segmentation model
+Usage:
+    compare_precision.py [options] [MODEL...]
+
+Options:
+    MODEL                   Models to compare, by default the float16 and int8 variants found
+                            next to the reference (<name>_float16.tflite, <name>_int8.tflite)
+    -f --float=MODEL        Reference float32 model [default: default_model.tflite]
+    -i --images=GLOB        Comma separated image globs [default: images/example_image.jpg]
+    -c --cmap=CMAP          Input colormap (Gris or Hierro) [default: Gris]
+    -t --threshold=T        Segmentation threshold [default: 0.5]
+    -r --repeats=N          Timed invokes per image [default: 10]
+    -o --output=PATH        Write the results as JSON
+"""
+import docopt
+import glob
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from interpreters import registry, PRECISIONS, model_variant
+from segment import read_frame
+from metrics import masks_from, dice
+
+
+def load_inputs(paths, cmap, size, channels):
+    """
+    uint8 (N,size,size,channels) model inputs, resized as the segmenters do
+    """
+    X = []
+    for path in paths:
+        img = cv2.resize(read_frame(path, cmap), (size, size), interpolation = cv2.INTER_NEAREST)
+        X.append(img[:,:,:channels])
+    return np.array(X, dtype = np.uint8)
+
+
+def run_model(path, X, repeats):
+    """
+    Predictions of every image (one invoke per image, as the live segmentation) and the
+    per image latencies in ms
+    """
+    predictions, times = [], []
+    with registry.lease(path) as model:
+        model.resize_batch(1)
+        for x in X:
+            model.predict(x[None], scale = 1/255)     #Warm up
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                Y = model.predict(x[None], scale = 1/255)
+                times.append(1000*(time.perf_counter() - t0))
+            predictions.append(Y[0])
+    return np.array(predictions), np.array(times)
+
+
+def main(args):
+    reference = args['--float']
+    models = args['MODEL'] or [model_variant(reference, p) for p in PRECISIONS[1:]
+                               if os.path.isfile(model_variant(reference, p))]
+    paths = sorted(set(path for pattern in args['--images'].split(',') for path in glob.glob(pattern)))
+    if not os.path.isfile(reference):
+        print(f'Reference model {reference} not found')
+        return 2
+    if not paths:
+        print('No images found')
+        return 2
+
+    input_details, _ = registry.load(reference)
+    size, channels = input_details[0]['shape'][1], input_details[0]['shape'][-1]
+    X = load_inputs(paths, args['--cmap'], size, channels)
+    threshold = float(args['--threshold'])
+    repeats = int(args['--repeats'])
+
+    reference_Y, reference_times = run_model(reference, X, repeats)
+    reference_masks = masks_from(reference_Y, threshold)
+    reference_ms = float(np.median(reference_times))
+    results = []
+    for path in [reference] + models:
+        if path == reference:
+            Y, times = reference_Y, reference_times
+        else:
+            Y, times = run_model(path, X, repeats)
+        masks = masks_from(Y, threshold)
+        scores = [dice(a, b) for a, b in zip(masks, reference_masks)]
+        results.append({'model': path,
+                        'precision': registry.precision(path),
+                        'size_mb': os.path.getsize(path)/2**20,
+                        'p50_ms': float(np.median(times)),
+                        'p90_ms': float(np.percentile(times, 90)),
+                        'speedup': reference_ms/float(np.median(times)),
+                        'dice_mean': float(np.mean(scores)),
+                        'dice_min': float(np.min(scores)),
+                        'max_abs_error': float(np.abs(Y - reference_Y).max())})
+
+    print(f"{len(paths)} images, threshold {threshold}, Dice against {os.path.basename(reference)}\n")
+    print(f"{'model':<32}{'precision':>10}{'MB':>8}{'p50 ms':>10}{'p90 ms':>10}{'speedup':>9}{'Dice':>8}{'min Dice':>10}")
+    for r in results:
+        print(f"{os.path.basename(r['model']):<32}{r['precision']:>10}{r['size_mb']:>8.1f}{r['p50_ms']:>10.2f}"
+              f"{r['p90_ms']:>10.2f}{r['speedup']:>9.2f}{r['dice_mean']:>8.4f}{r['dice_min']:>10.4f}")
+
+    if args['--output']:
+        with open(args['--output'], 'w') as outfile:
+            json.dump({'images': paths, 'threshold': threshold, 'results': results}, outfile, indent = 2)
+    return 0
+
+
+if __name__ == "__main__":
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
@@ -7,14 +7,19 @@ Options:
     IMG_PATH    Path to thermographic image
     MASK_PATH   Path segmentation mask
 """
-import docopt
 
 
 import cv2
-import SimpleITK as sitk
 import numpy as np 
-import matplotlib.pyplot as plt
 import time 
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from instrument import traced, tracer
+from startup import lazy_import
+
+sitk = lazy_import('SimpleITK')
+plt = lazy_import('matplotlib.pyplot')
 
 
 def plot_predict(y,y_pred):
@@ -37,20 +42,31 @@ def define_contour(dermatomes):
     return dermatomes
 
 
-def no_rigid_registration(fixed_image, moving_image): 
-    fixed_image =  sitk.Cast(sitk.GetImageFromArray(fixed_image.copy()),sitk.sitkFloat32)
-    moving_image = sitk.Cast(sitk.GetImageFromArray(moving_image.copy()),sitk.sitkFloat32)
+@traced()
+def no_rigid_registration(fixed_image, moving_image, initial_transform = None, iterations = 600): 
+    """
+    BSpline registration of moving_image into fixed_image.
+    If initial_transform is given (converged transform of a similar image), the
+    optimization starts from it at the finest mesh level only (warm start)
+    """
+    fixed_image = to_sitk(fixed_image)
+    moving_image = to_sitk(moving_image)
 
-    transformDomainMeshSize=[3]*fixed_image.GetDimension()
+    if initial_transform is None:
+        transformDomainMeshSize=[3]*fixed_image.GetDimension()
 
-    tx = sitk.BSplineTransformInitializer(fixed_image,
-                                      transformDomainMeshSize)   
+        tx = sitk.BSplineTransformInitializer(fixed_image,
+                                          transformDomainMeshSize)   
+        scaleFactors = [1,2,4,8]
+    else:
+        tx = adapt_transform(initial_transform, fixed_image)
+        scaleFactors = [1]
 
     R = sitk.ImageRegistrationMethod()
     R.SetMetricAsCorrelation()
 
     R.SetOptimizerAsGradientDescentLineSearch(learningRate=10.,
-                                              numberOfIterations=600,
+                                              numberOfIterations=iterations,
                                               convergenceMinimumValue=1e-20,
                                               convergenceWindowSize=30)
 
@@ -60,27 +76,175 @@ def no_rigid_registration(fixed_image, moving_image):
 
     R.SetInitialTransformAsBSpline(tx,
                                    inPlace=False,
-                                   scaleFactors=[1,2,4,8])
+                                   scaleFactors=scaleFactors)
     #R.SetShrinkFactorsPerLevel([4,2,1])
     #R.SetSmoothingSigmasPerLevel([4,2,1])
 
     outTx = R.Execute(fixed_image, moving_image)
     return outTx
 
+
+def as_bspline(transform):
+    """
+    Downcast the output of a registration into a sitk.BSplineTransform
+    """
+    if transform.GetName() == 'CompositeTransform':
+        composite = sitk.CompositeTransform(transform)
+        transform = composite.GetNthTransform(composite.GetNumberOfTransforms()-1)
+    return sitk.BSplineTransform(transform)
+
+
+def adapt_transform(transform, fixed_image):
+    """
+    Maps a BSpline transform converged on a foot onto the domain of fixed_image
+    (same mesh, displacements scaled with the change of foot size)
+    """
+    transform = as_bspline(transform)
+    tx = sitk.BSplineTransformInitializer(fixed_image, transform.GetTransformDomainMeshSize())
+    old_size = np.array(transform.GetTransformDomainPhysicalDimensions())
+    new_size = np.array(tx.GetTransformDomainPhysicalDimensions())
+    params = np.array(transform.GetParameters()).reshape(fixed_image.GetDimension(), -1)
+    params = params * (new_size/old_size)[:,None]
+    tx.SetParameters(params.ravel().tolist())
+    return tx
+
+
+class SessionRegistration():
+    """
+    Session-aware registration: frames of a session show the same feet a few minutes
+    apart, so the registration of each foot starts from the transform converged on
+    the previous frame. Falls back to a cold start when the foot moved too much
+    (bounding box size change or low overlap with the previous foot)
+    """
+    def __init__(self, min_overlap = 0.9, max_size_change = 0.15, iterations = 100):
+        self.min_overlap = min_overlap
+        self.max_size_change = max_size_change
+        self.iterations = iterations
+        self.previous = {}      #side -> (foot, transform)
+        self.warm_starts = 0
+        self.cold_starts = 0
+        self.lock = threading.Lock()    #Both feet may be registered concurrently
+
+    def is_similar(self, foot, previous_foot):
+        size_change = np.abs(np.array(foot.shape)/np.array(previous_foot.shape) - 1).max()
+        if size_change > self.max_size_change:
+            return False
+        previous_foot = cv2.resize(previous_foot, (foot.shape[1],foot.shape[0]), interpolation = cv2.INTER_NEAREST)
+        intersection = np.logical_and(foot, previous_foot).sum()
+        dice = 2*intersection/(np.count_nonzero(foot) + np.count_nonzero(previous_foot) + 1e-8)
+        return dice >= self.min_overlap
+
+    def register(self, side, foot, mask_dermatomes):
+        previous = self.previous.get(side)
+        if previous is not None and self.is_similar(foot, previous[0]):
+            transform = no_rigid_registration(foot, mask_dermatomes, previous[1], self.iterations)
+            warm = True
+        else:
+            transform = no_rigid_registration(foot, mask_dermatomes)
+            warm = False
+        with self.lock:
+            self.previous[side] = (foot.copy(), transform)
+            self.warm_starts += warm
+            self.cold_starts += not warm
+            tracer.counter('registration', warm_starts = self.warm_starts, cold_starts = self.cold_starts)
+        return transform
+
+    def reset(self):
+        self.previous = {}
+
+
+def to_sitk(image):
+    """
+    Float32 SimpleITK image from a numpy array (sitk images are returned as they are)
+    """
+    if isinstance(image, sitk.Image):
+        return image
+    return sitk.Cast(sitk.GetImageFromArray(image),sitk.sitkFloat32)
+
+
 def resample(moving_image,fixed_image,registration_transform):
-    fixed_image =  sitk.Cast(sitk.GetImageFromArray(fixed_image),sitk.sitkFloat32)
-    moving_image = sitk.Cast(sitk.GetImageFromArray(moving_image),sitk.sitkFloat32) 
+    fixed_image = to_sitk(fixed_image)
+    moving_image = to_sitk(moving_image)
     return sitk.GetArrayFromImage(sitk.Resample(moving_image,fixed_image, registration_transform,sitk.sitkNearestNeighbor))
 
 
+#Dermatomes template resized to a foot bounding box
+#labels: label map, mask: float foot mask (moving image), *_image: same as float32 sitk images
+Template = namedtuple('Template', ['labels', 'mask', 'labels_image', 'mask_image'])
+
+
+def make_template(dermatomes, size):
+    """
+    Resizes a dermatomes label map to size (height, width) and builds its moving mask
+    """
+    labels = cv2.resize(dermatomes, (size[1],size[0]), interpolation = cv2.INTER_NEAREST)
+    mask = (labels >0).astype('float')
+    return Template(labels, mask, to_sitk(labels), to_sitk(mask))
+
+
+class DermatomeAtlas():
+    """
+    Dermatomes templates of both feet, decoded once.
+    Right foot template is the flipped image, left foot labels are the right ones + 1.
+    Templates resized to each requested foot size are kept in a LRU cache, so
+    consecutive frames (same feet, similar bounding boxes) reuse them.
+    """
+    def __init__(self, path_right_foot='images/dermatomes.png', path_left_foot='images/dermatomes.png', cache_size=128):
+        right_dermatomes = cv2.flip(cv2.imread(path_right_foot)[...,2],1)
+
+        left_dermatomes = cv2.imread(path_left_foot)[...,2] 
+        left_dermatomes[left_dermatomes!=0] = left_dermatomes[left_dermatomes!=0] + 1 
+
+        self.dermatomes = {'right': right_dermatomes, 'left': left_dermatomes}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, side, size):
+        """
+        Template of side ('right' or 'left') resized to size (height, width)
+        """
+        key = (side, tuple(size))
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        template = make_template(self.dermatomes[side], size)
+        with self.lock:
+            self.cache[key] = template
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return template
+
+    def preload(self, sizes):
+        """
+        Precomputes templates for a list of (height, width) foot sizes, for both feet
+        """
+        for size in sizes:
+            for side in self.dermatomes:
+                self.get(side, size)
+
+
+@lru_cache(maxsize=None)
+def get_atlas(path_right_foot='images/dermatomes.png', path_left_foot='images/dermatomes.png'):
+    """
+    Shared atlas for a pair of template images
+    """
+    return DermatomeAtlas(path_right_foot, path_left_foot)
+
 
-def register_one_foot(foot,dermatomes):
-    hight = foot.shape[0]
-    width = foot.shape[1]
-    dermatomes = cv2.resize(dermatomes, (width,hight), interpolation = cv2.INTER_NEAREST)
-    mask_dermatomes = (dermatomes.copy() >0).astype('float')
-    registration_transform = no_rigid_registration(foot,mask_dermatomes) 
-    registered = resample(dermatomes,foot,registration_transform)
+@traced()
+def register_one_foot(foot,dermatomes,registration=None,side='right'):
+    """
+    dermatomes: label map (np.ndarray) or a Template already resized to the foot
+    """
+    if isinstance(dermatomes, np.ndarray):
+        dermatomes = make_template(dermatomes, foot.shape)
+    if registration is None:
+        registration_transform = no_rigid_registration(foot,dermatomes.mask_image) 
+    else:
+        registration_transform = registration.register(side,foot,dermatomes.mask_image)
+    registered = resample(dermatomes.labels_image,foot,registration_transform)
     return  registered
 
     
@@ -120,7 +284,8 @@ def extract_feet(img):
 
 
 
-def get_dermatomes(fixed_image,path_right_foot='images/dermatomes.png',path_left_foot='images/dermatomes.png'):
+@traced()
+def get_dermatomes(fixed_image,path_right_foot='images/dermatomes.png',path_left_foot='images/dermatomes.png',registration=None,atlas=None,executor=None):
     """
     0 -> background
     255 -> boundary
@@ -131,20 +296,27 @@ def get_dermatomes(fixed_image,path_right_foot='images/dermatomes.png',path_left
        30-31 -> Sural
        40-41 -> Tibial
        50-51 -> Saphenous
+
+    registration: optional SessionRegistration, to warm start from the previous frame
+    atlas: optional DermatomeAtlas, by default the shared one for the given template paths
+    executor: optional concurrent.futures executor, to register both feet concurrently
     """
     #all in hxw
 
     fixed_image = np.squeeze(fixed_image)
 
-    right_dermatomes = cv2.flip(cv2.imread(path_right_foot)[...,2],1)
-
-    left_dermatomes = cv2.imread(path_left_foot)[...,2] 
-    left_dermatomes[left_dermatomes!=0] = left_dermatomes[left_dermatomes!=0] + 1 
+    if atlas is None:
+        atlas = get_atlas(path_right_foot, path_left_foot)
 
     right_foot,left_foot, coord = extract_feet(fixed_image)
     
-    right_dermatomes = register_one_foot(right_foot,right_dermatomes)
-    left_dermatomes = register_one_foot(left_foot,left_dermatomes)
+    if executor is None:
+        right_dermatomes = register_one_foot(right_foot,atlas.get('right',right_foot.shape),registration,'right')
+        left_dermatomes = register_one_foot(left_foot,atlas.get('left',left_foot.shape),registration,'left')
+    else:
+        left_future = executor.submit(register_one_foot,left_foot,atlas.get('left',left_foot.shape),registration,'left')
+        right_dermatomes = register_one_foot(right_foot,atlas.get('right',right_foot.shape),registration,'right')
+        left_dermatomes = left_future.result()
 
     output_dermatomes = np.zeros_like(fixed_image,dtype='float')
     output_dermatomes[coord[0][0]:coord[0][1],coord[0][2]:coord[0][3]] = right_dermatomes
@@ -200,5 +372,6 @@ def main(args):
 #
 
 if __name__ == "__main__":
+    import docopt
     args = docopt.docopt(__doc__)
     main(args)
\ No newline at end of file
@@ -0,0 +1,111 @@
+#Lightweight timing of the pipeline hot paths
+#Spans are recorded only while the tracer is enabled (FEET_TRACE=1 or tracer.enable()).
+#Disabled, a traced function costs one attribute check per call
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer():
+    """
+    Collects spans and counters as Chrome trace events (chrome://tracing, Perfetto)
+    """
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def enable(self, enabled = True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.events = []
+            self.origin = time.perf_counter()
+
+    def _timestamp(self, t):
+        return (t - self.origin)*1e6    #Microseconds
+
+    def add_span(self, name, start, end, args = None):
+        event = {'name': name, 'ph': 'X', 'ts': self._timestamp(start), 'dur': (end - start)*1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        with tracer.span('stage'):
+            ...
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.perf_counter(), args)
+
+    def counter(self, name, **values):
+        if not self.enabled:
+            return
+        event = {'name': name, 'ph': 'C', 'ts': self._timestamp(time.perf_counter()),
+                 'pid': os.getpid(), 'args': values}
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        """
+        {name: {'count', 'total_ms', 'mean_ms', 'max_ms'}} of the recorded spans, slowest first
+        """
+        with self.lock:
+            spans = [e for e in self.events if e['ph'] == 'X']
+        stats = {}
+        for event in spans:
+            s = stats.setdefault(event['name'], {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            s['count'] += 1
+            s['total_ms'] += event['dur']/1000
+            s['max_ms'] = max(s['max_ms'], event['dur']/1000)
+        for s in stats.values():
+            s['mean_ms'] = s['total_ms']/s['count']
+        return dict(sorted(stats.items(), key = lambda item: -item[1]['total_ms']))
+
+    def export_chrome(self, path, metadata = None):
+        """
+        Writes the events as Chrome trace-event JSON
+        """
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as outfile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': metadata or {}}, outfile)
+
+
+tracer = Tracer(enabled = os.environ.get('FEET_TRACE', '0') not in ('', '0'))
+
+
+def traced(name = None):
+    """
+    Decorator recording a span per call while the tracer is enabled
+    """
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tracer.add_span(span_name, start, time.perf_counter())
+        return wrapper
+    return decorator
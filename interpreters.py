@@ -0,0 +1,277 @@
+#Process-wide registry of TFLite interpreters
+#Each model file is read once and its interpreters are reused between segmenters
+
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from startup import lazy_import
+
+tflite = lazy_import('tflite_runtime.interpreter')
+
+
+PRECISIONS = ['float32', 'float16', 'int8']
+
+#External delegates tried by the tuner when their library can be loaded
+DELEGATE_LIBRARIES = {'armnn': 'libarmnn_delegate.so',
+                      'gpu': 'libtensorflowlite_gpu_delegate.so'}
+
+
+def make_interpreter(model_content, settings = None):
+    """
+    Interpreter with the tuned settings: num_threads (None for the default) and delegate,
+    'xnnpack' (the default CPU delegate), 'none' (builtin kernels only) or one of
+    DELEGATE_LIBRARIES
+    """
+    settings = settings or {}
+    kwargs = {'model_content': model_content, 'num_threads': settings.get('num_threads')}
+    delegate = settings.get('delegate', 'xnnpack')
+    if delegate == 'none':
+        kwargs['experimental_op_resolver_type'] = tflite.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+    elif delegate in DELEGATE_LIBRARIES:
+        kwargs['experimental_delegates'] = [tflite.load_delegate(DELEGATE_LIBRARIES[delegate])]
+    return tflite.Interpreter(**kwargs)
+
+
+def model_variant(path, precision):
+    """
+    Path of the precision variant of a model: <name>_float16.tflite, <name>_int8.tflite,
+    or <name>.tflite for float32. Variants are looked up next to the given model
+    """
+    root, ext = os.path.splitext(path)
+    for suffix in PRECISIONS[1:]:
+        if root.endswith('_' + suffix):
+            root = root[:-len(suffix)-1]
+    return root + ext if precision == 'float32' else f'{root}_{precision}{ext}'
+
+
+def quantize(X, details, scale = 1.0):
+    """
+    Model input from X, whose real values are X*scale. Integer inputs are quantized with
+    the tensor (scale, zero_point); uint8 pixels are passed as they are when the input
+    quantization is already pixels/255
+    """
+    dtype = details['dtype']
+    if not np.issubdtype(dtype, np.integer):
+        X = np.asarray(X, dtype = np.float32)
+        return X if scale == 1.0 else X*np.float32(scale)
+    input_scale, zero_point = details['quantization']
+    if X.dtype == dtype and zero_point == 0 and np.isclose(scale, input_scale):
+        return np.ascontiguousarray(X)
+    info = np.iinfo(dtype)
+    q = np.round(np.asarray(X, dtype = np.float32)*np.float32(scale/input_scale)) + zero_point
+    return np.clip(q, info.min, info.max).astype(dtype)
+
+
+def dequantize(Y, details):
+    """
+    Real valued (float32) model output
+    """
+    if not np.issubdtype(details['dtype'], np.integer):
+        return Y
+    scale, zero_point = details['quantization']
+    return (Y.astype(np.float32) - zero_point)*np.float32(scale)
+
+
+class ModelInstance():
+    """
+    Interpreter with its tensor details, handed out by the registry
+    """
+    def __init__(self, key, model_content, settings = None):
+        self.key = key
+        self.settings = settings or {}
+        self.interpreter = make_interpreter(model_content, self.settings)
+        self.interpreter.allocate_tensors()
+        self.update_details()
+        self.precision = self.detect_precision()
+
+    def detect_precision(self):
+        """
+        int8/uint8 for quantized inputs, float16 if the weights are stored as float16
+        """
+        dtype = self.input_details[0]['dtype']
+        if np.issubdtype(dtype, np.integer):
+            return np.dtype(dtype).name
+        if any(tensor['dtype'] == np.float16 for tensor in self.interpreter.get_tensor_details()):
+            return 'float16'
+        return 'float32'
+
+    def predict(self, X, scale = 1.0):
+        """
+        Runs the model on a batch whose real values are X*scale. Returns float32 outputs
+        of the first output tensor, whatever the precision of the model
+        """
+        self.interpreter.set_tensor(self.input_details[0]['index'], quantize(X, self.input_details[0], scale))
+        self.interpreter.invoke()
+        return dequantize(self.interpreter.get_tensor(self.output_details[0]['index']), self.output_details[0])
+
+    def update_details(self):
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = self.input_details[0]['shape'][0]
+
+    def resize_batch(self, n):
+        """
+        Resizes interpreter input to a batch of n samples. If the model rejects it, the
+        previous batch is restored before raising
+        """
+        if n == self.batch_size:
+            return
+        index = self.input_details[0]['index']
+        shape = list(self.input_details[0]['shape'][1:])
+        try:
+            self.interpreter.resize_tensor_input(index, [n, *shape])
+            self.interpreter.allocate_tensors()
+        except (RuntimeError, ValueError):
+            #Back to the last batch that worked, so the instance stays usable (and can be
+            #leased again) when the model does not support this batch
+            self.interpreter.resize_tensor_input(index, [self.batch_size, *shape])
+            self.interpreter.allocate_tensors()
+            raise
+        self.update_details()
+
+
+class InterpreterRegistry():
+    """
+    Loads each model file once, keyed by absolute path, modification time and size.
+    Interpreters are not thread safe, so they are leased: a thread gets an idle
+    instance (or a new one built from the cached model bytes) and returns it when done.
+    At most max_models files are kept: the least recently used one that is not leased
+    is dropped with its idle interpreters when another model is loaded
+    """
+    def __init__(self, max_models = 3):
+        self.lock = threading.Lock()
+        self.max_models = max_models
+        self.contents = OrderedDict()   #key -> model bytes, least recently used first
+        self.leases = {}     #key -> interpreters in use
+        self.idle = {}       #key -> list of idle ModelInstance
+        self.details = {}    #key -> (input_details, output_details)
+        self.precisions = {} #key -> precision of the model
+        self.settings = {}   #key -> interpreter settings (num_threads, delegate)
+        self.settings_provider = None   #Optional callable(path) -> settings, e.g. tuning.TuningStore
+
+    def key(self, path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+    def _forget(self, key):
+        del self.contents[key]
+        self.idle.pop(key, None)
+        self.details.pop(key, None)
+        self.precisions.pop(key, None)
+        self.settings.pop(key, None)
+
+    def _content(self, key):
+        with self.lock:
+            if key in self.contents:
+                return self.contents[key]
+        with open(key[0], 'rb') as model_file:
+            content = model_file.read()
+        with self.lock:
+            #Drop stale versions of the same file
+            for old in [k for k in self.contents if k[0] == key[0] and k != key]:
+                self._forget(old)
+            content = self.contents.setdefault(key, content)
+            #Then the least recently used models, e.g. prefetched but never selected
+            for old in [k for k in self.contents if not self.leases.get(k)]:
+                if len(self.contents) <= self.max_models:
+                    break
+                self._forget(old)
+            return content
+
+    def _settings(self, key):
+        with self.lock:
+            if key in self.settings:
+                return self.settings[key]
+        settings = self.settings_provider(key[0]) if self.settings_provider is not None else None
+        with self.lock:
+            return self.settings.setdefault(key, settings or {})
+
+    def set_settings(self, path, settings):
+        """
+        Interpreter settings of a model. Idle interpreters are dropped and rebuilt with them
+        """
+        key = self.key(path)
+        with self.lock:
+            self.settings[key] = settings or {}
+            self.idle.pop(key, None)
+
+    def acquire(self, path):
+        key = self.key(path)
+        with self.lock:
+            self.leases[key] = self.leases.get(key, 0) + 1     #Not evicted while leased
+            if key in self.contents:
+                self.contents.move_to_end(key)
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop()
+        try:
+            instance = ModelInstance(key, self._content(key), self._settings(key))
+        except BaseException:
+            self._unlease(key)
+            raise
+        with self.lock:
+            if key in self.contents:
+                self.details.setdefault(key, (instance.input_details, instance.output_details))
+                self.precisions.setdefault(key, instance.precision)
+        return instance
+
+    def _unlease(self, key):
+        with self.lock:
+            self.leases[key] -= 1
+            if not self.leases[key]:
+                del self.leases[key]
+
+    def release(self, instance):
+        self._unlease(instance.key)
+        with self.lock:
+            if instance.key in self.contents and instance.settings == self.settings.get(instance.key):
+                self.idle.setdefault(instance.key, []).append(instance)
+
+    @contextmanager
+    def lease(self, path):
+        """
+        with registry.lease(model_path) as model:
+            model.interpreter.invoke()
+        """
+        instance = self.acquire(path)
+        try:
+            yield instance
+        finally:
+            self.release(instance)
+
+    def load(self, path):
+        """
+        Makes sure a model is loaded and returns its (input_details, output_details)
+        """
+        key = self.key(path)
+        with self.lock:
+            if key in self.details:
+                self.contents.move_to_end(key)
+                return self.details[key]
+        with self.lease(path) as instance:
+            with self.lock:
+                return self.details.get(key, (instance.input_details, instance.output_details))
+
+    def precision(self, path):
+        """
+        float32, float16, int8 or uint8
+        """
+        key = self.key(path)
+        with self.lock:
+            if key in self.precisions:
+                return self.precisions[key]
+        with self.lease(path) as instance:
+            return instance.precision
+
+    def clear(self):
+        with self.lock:
+            self.contents.clear()
+            self.idle.clear()
+            self.details.clear()
+            self.precisions.clear()
+            self.settings.clear()
+
+
+registry = InterpreterRegistry()
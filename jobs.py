@@ -0,0 +1,238 @@
+#Background jobs of the interface
+#Heavy actions run on a QThreadPool instead of the GUI thread. Jobs report progress and
+#results through signals (delivered on the GUI thread), can be cancelled cooperatively and
+#are queued: jobs of the same queue run one after another and a job can wait for others
+
+import subprocess
+import threading
+from collections import deque
+from PySide2.QtCore import QObject, QRunnable, QThreadPool, Signal, Slot
+
+
+class Cancelled(Exception):
+    """
+    Raised inside a job when it has been cancelled
+    """
+
+
+class JobSignals(QObject):
+    """
+    Signals of a job. They are emitted from the worker thread and received on the GUI thread
+    """
+    progress = Signal(object, int)
+    finished = Signal(object, object)
+    failed = Signal(object, object)
+
+
+class Job(QRunnable):
+    """
+    A named action running function(job, **kwargs) on the thread pool.
+    The function reports progress with job.setValue(percent), so the job can be passed
+    wherever a progress bar is expected, and stops at the next report once cancelled.
+    prepare runs on the GUI thread right before the job starts and returns the kwargs of
+    function (e.g. widget values), or None to skip the job
+    """
+    QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+
+    def __init__(self, name, function, queue = 'default', after = (), prepare = None,
+                 on_done = None, on_error = None, progress_format = '%p%', kwargs = None):
+        super(Job, self).__init__()
+        self.setAutoDelete(False)
+        self.name = name
+        self.function = function
+        self.queue = queue
+        self.after = [job for job in after if job is not None]
+        self.prepare = prepare
+        self.on_done = on_done
+        self.on_error = on_error
+        self.progress_format = progress_format
+        self.kwargs = kwargs or {}
+        self.state = Job.QUEUED
+        self.result = None
+        self.error = None
+        self.signals = JobSignals()
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def check(self):
+        """
+        Raises Cancelled if the job was cancelled. Call it between steps of long functions
+        """
+        if self._cancel.is_set():
+            raise Cancelled(self.name)
+
+    def setValue(self, percent):
+        self.check()
+        self.signals.progress.emit(self, int(percent))
+
+    def run(self):
+        try:
+            self.check()
+            result = self.function(self, **self.kwargs)
+            self.check()
+            self.signals.finished.emit(self, result)
+        except Exception as e:
+            self.signals.failed.emit(self, e)
+
+
+class JobScheduler(QObject):
+    """
+    Runs jobs on a thread pool. Jobs of the same queue run in submission order, one at a
+    time; after lists jobs that must finish first. A job whose dependency fails or is
+    cancelled is cancelled too
+    """
+    started = Signal(object)
+    progress = Signal(object, int)
+    finished = Signal(object)
+    failed = Signal(object, object)
+    cancelled = Signal(object)
+    idle = Signal()
+
+    def __init__(self, max_threads = None):
+        super(JobScheduler, self).__init__()
+        self.pool = QThreadPool()
+        if max_threads:
+            self.pool.setMaxThreadCount(max_threads)
+        self.pending = deque()
+        self.running = []
+        self.history = deque(maxlen = 32)    #Ended jobs, kept alive until their runnable returns
+
+    def submit(self, name, function, queue = 'default', after = (), prepare = None,
+               on_done = None, on_error = None, progress_format = '%p%', **kwargs):
+        """
+        Queues function(job, **kwargs). A job with the same name that has not finished is
+        returned instead of queueing it twice
+        """
+        for job in list(self.pending) + self.running:
+            if job.name == name and not job.cancelled:
+                return job
+        job = Job(name, function, queue, after, prepare, on_done, on_error, progress_format, kwargs)
+        job.signals.progress.connect(self._on_progress)
+        job.signals.finished.connect(self._on_finished)
+        job.signals.failed.connect(self._on_failed)
+        self.pending.append(job)
+        self._dispatch()
+        return job
+
+    def busy(self, queue = None):
+        """
+        True while jobs (of a queue, or of any queue) are queued or running
+        """
+        return any(queue is None or job.queue == queue for job in list(self.pending) + self.running)
+
+    def cancel(self, job = None, queue = None):
+        """
+        Cancels a job, the jobs of a queue or every job. Queued jobs are dropped, running
+        jobs stop at their next progress report
+        """
+        jobs = [job] if job is not None else [other for other in list(self.pending) + self.running
+                                               if queue is None or other.queue == queue]
+        for job in jobs:
+            job.cancel()
+            if job in self.pending:
+                self.pending.remove(job)
+                self._end(job, Job.CANCELLED)
+        self._dispatch()
+
+    def _ready(self, job):
+        if any(other.queue == job.queue for other in self.running):
+            return False
+        if any(other.queue == job.queue for other in self.pending if other is not job and
+               self.pending.index(other) < self.pending.index(job)):
+            return False
+        return all(dependency.state == Job.DONE for dependency in job.after)
+
+    def _dispatch(self):
+        for job in list(self.pending):
+            if job not in self.pending:
+                continue    #Cancelled by a previous iteration
+            if any(dependency.state in (Job.FAILED, Job.CANCELLED) for dependency in job.after):
+                self.pending.remove(job)
+                self._end(job, Job.CANCELLED)
+                continue
+            if not self._ready(job):
+                continue
+            self.pending.remove(job)
+            if job.prepare is not None:
+                try:
+                    kwargs = job.prepare()
+                except Exception as e:
+                    job.error = e
+                    self._end(job, Job.FAILED)
+                    continue
+                if kwargs is None:
+                    self._end(job, Job.CANCELLED)
+                    continue
+                job.kwargs.update(kwargs)
+            job.state = Job.RUNNING
+            self.running.append(job)
+            self.started.emit(job)
+            self.pool.start(job)
+        if not self.busy():
+            self.idle.emit()
+
+    def _end(self, job, state):
+        if job in self.running:
+            self.running.remove(job)
+        self.history.append(job)
+        if state == Job.DONE and job.on_done is not None:
+            try:
+                job.on_done(job.result)
+            except Exception as e:
+                job.error = e
+                state = Job.FAILED
+        job.state = state
+        if state == Job.DONE:
+            self.finished.emit(job)
+        elif state == Job.FAILED:
+            if job.on_error is not None:
+                job.on_error(job.error)
+            self.failed.emit(job, job.error)
+        else:
+            self.cancelled.emit(job)
+
+    @Slot(object, int)
+    def _on_progress(self, job, percent):
+        if job.state == Job.RUNNING:
+            self.progress.emit(job, percent)
+
+    @Slot(object, object)
+    def _on_finished(self, job, result):
+        job.result = result
+        #A job cancelled after its last check finishes, but its result is dropped
+        self._end(job, Job.CANCELLED if job.cancelled else Job.DONE)
+        self._dispatch()
+
+    @Slot(object, object)
+    def _on_failed(self, job, error):
+        job.error = error
+        self._end(job, Job.CANCELLED if isinstance(error, Cancelled) else Job.FAILED)
+        self._dispatch()
+
+    def wait(self, msecs = -1):
+        """
+        Waits for the running jobs (e.g. before quitting)
+        """
+        return self.pool.waitForDone(msecs)
+
+
+def run_command(job, args, poll_interval = 0.2):
+    """
+    Runs an external command inside a job, terminating it if the job is cancelled.
+    Returns its exit code
+    """
+    process = subprocess.Popen(args)
+    while True:
+        try:
+            return process.wait(timeout = poll_interval)
+        except subprocess.TimeoutExpired:
+            if job.cancelled:
+                process.terminate()
+                process.wait()
+                job.check()
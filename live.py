@@ -0,0 +1,224 @@
+#Live segmentation of camera frames on a background thread
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from PySide2.QtCore import QObject, QThread, Signal
+from segment import ImageToSegment
+from postprocessing import PostProcessing
+from temperatures import mean_temperature, dermatomes_temperatures
+from dermatomes import SessionRegistration
+
+
+def segment_frame(i2s, frame, cmap, min_size, threshold = 0.5):
+    """
+    Segments an in-memory frame. Returns the post processed mask (H,W,1) in the
+    model resolution and the mask resized to the frame
+    """
+    i2s.extract_array(frame, cmap = cmap)
+    Y = i2s.Y_pred
+    Y = Y / Y.max()
+    Y = np.where( Y >= threshold  , 1 , 0)
+    mask = PostProcessing(min_size).execute(Y[0])
+    frame_mask = cv2.resize(mask, (frame.shape[1],frame.shape[0]), interpolation = cv2.INTER_NEAREST)
+    return mask, frame_mask
+
+
+class LiveSegmentationWorker(QThread):
+    """
+    Segments camera frames as fast as the hardware allows.
+    Live frames go through a single slot where the latest frame wins, so the
+    worker never lags behind the camera. Capture requests are never dropped.
+    """
+    segmented = Signal(str, object, object, object, object)   #tag, frame, mask, frame mask, contours
+
+    def __init__(self, model, cmap = 'Gris', min_size = 2500):
+        super(LiveSegmentationWorker, self).__init__()
+        self.i2s = ImageToSegment()
+        self.i2s.setModel(model)
+        self.cmap = cmap
+        self.min_size = min_size
+        self.live = False
+        self.condition = threading.Condition()
+        self.latest_frame = None
+        self.captures = []
+        self.running = True
+        self.processed = 0
+        self.dropped = 0
+
+    def set_model(self, model):
+        self.i2s.setModel(model)
+
+    def submit(self, frame):
+        """
+        Offers a live frame. Replaces the pending one if the worker is still busy
+        """
+        if not self.live:
+            return
+        with self.condition:
+            if self.latest_frame is not None:
+                self.dropped += 1
+            self.latest_frame = frame
+            self.condition.notify()
+
+    def submit_capture(self, frame, tag = 'capture'):
+        """
+        Requests the segmentation of a captured frame. The tag is emitted back with the result
+        """
+        with self.condition:
+            self.captures.append((tag, frame))
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.captures and self.latest_frame is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                if self.captures:
+                    tag, frame = self.captures.pop(0)
+                else:
+                    tag, frame = 'live', self.latest_frame
+                    self.latest_frame = None
+            try:
+                mask, frame_mask = segment_frame(self.i2s, frame, self.cmap, self.min_size)
+            except Exception as e:
+                print(f'Live segmentation failed: {e}')
+                continue
+            contours, _ = cv2.findContours(frame_mask.astype('uint8'), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            self.processed += 1
+            self.segmented.emit(tag, frame, mask, frame_mask, contours)
+
+
+def draw_overlay(frame, contours, color = (0, 255, 0)):
+    """
+    Draws feet contours over a copy of the frame
+    """
+    overlay = frame.copy()
+    cv2.drawContours(overlay, contours, -1, color, 2)
+    return overlay
+
+
+class LiveSession(QObject):
+    """
+    Per-frame results of a session being captured. Each capture is processed once,
+    on a background thread and in capture order, and the dermatomes registration
+    starts from the previous frame, so the work per capture does not grow with
+    the session length
+    """
+    frame_processed = Signal(int)
+
+    def __init__(self, session_dir, interval = 5):
+        super(LiveSession, self).__init__()
+        self.session_dir = session_dir
+        self.interval = interval    #Minutes between captures after t1
+        self.files = []
+        self.times = []
+        self.scale_range = []
+        self.masks = []
+        self.mean_temps = []
+        self.segmented_temps = []
+        self.original_temps = []
+        self.dermatomes_temps = []
+        self.dermatomes_masks = []
+        self.registration = SessionRegistration()
+        self.submitted = set()      #Captures already sent to process
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1)
+
+    def next_capture(self):
+        """
+        Path and time of the next capture: t0, t1, t5, t10...
+        """
+        n = len(self.files)
+        time = n if n <= 1 else self.interval*n - self.interval
+        return os.path.join(self.session_dir, f't{time}.jpg'), time
+
+    def add_capture(self, path, time, scale_range):
+        """
+        Registers a saved capture, returns its index
+        """
+        with self.lock:
+            self.files.append(path)
+            self.times.append(time)
+            self.scale_range.append(list(scale_range))
+            for results in (self.masks, self.mean_temps, self.segmented_temps, self.original_temps,
+                            self.dermatomes_temps, self.dermatomes_masks):
+                results.append(None)
+            return len(self.files) - 1
+
+    def set_scale(self, index, scale_range):
+        """
+        Sets the scale of a capture read after it was added, before it is processed
+        """
+        with self.lock:
+            self.scale_range[index] = list(scale_range)
+
+    def process(self, index, frame, mask, cmap = 'Gris'):
+        """
+        Computes the temperatures of capture index from its RGB frame and its (S,S,1) mask
+        Emits frame_processed(index) when done. A capture is only processed once, a second
+        request would advance the warm start registration again and returns None
+        """
+        with self.lock:
+            if index in self.submitted:
+                return None
+            self.submitted.add(index)
+        return self.executor.submit(self._process, index, frame, mask, cmap)
+
+    def _process(self, index, frame, mask, cmap):
+        try:
+            img_size = mask.shape[0]
+            if cmap == 'Hierro':
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)[:,:,None]
+            X = cv2.resize(frame, (img_size, img_size), interpolation = cv2.INTER_NEAREST)
+            X = X.reshape(img_size, img_size, -1)
+            Xarray = X[:,:,0]/max(X.max(), 1)
+            mean, temp, original_temp = mean_temperature(Xarray, mask[:,:,0], self.scale_range[index], plot = False)
+            dermatomes_temps, dermatomes_mask = dermatomes_temperatures(original_temp, mask, self.registration)
+        except Exception as e:
+            print(f'Capture {index} could not be processed: {e}')
+            return
+        with self.lock:
+            self.masks[index] = mask
+            self.mean_temps[index] = mean
+            self.segmented_temps[index] = temp
+            self.original_temps[index] = original_temp
+            self.dermatomes_temps[index] = dermatomes_temps
+            self.dermatomes_masks[index] = dermatomes_mask
+        self.frame_processed.emit(index)
+
+    def processed(self):
+        """
+        Indices of the captures whose results are ready
+        """
+        with self.lock:
+            return [i for i, mean in enumerate(self.mean_temps) if mean is not None]
+
+    def results(self):
+        """
+        Results of the processed captures, in the format of a whole session extraction
+        """
+        indices = self.processed()
+        with self.lock:
+            return {'files': [self.files[i] for i in indices],
+                    'times': [self.times[i] for i in indices],
+                    'scale_range': [self.scale_range[i] for i in indices],
+                    'masks': [self.masks[i] for i in indices],
+                    'mean_temps': [self.mean_temps[i] for i in indices],
+                    'segmented_temps': np.array([self.segmented_temps[i] for i in indices]),
+                    'original_temps': np.array([self.original_temps[i] for i in indices]),
+                    'dermatomes_temps': np.array([self.dermatomes_temps[i] for i in indices]),
+                    'dermatomes_masks': np.array([self.dermatomes_masks[i] for i in indices])}
+
+    def close(self):
+        self.executor.shutdown(wait = False)
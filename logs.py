@@ -0,0 +1,104 @@
+#Interface logs: in-memory ring buffer plus a background file writer
+
+import json
+import queue
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from PySide2.QtCore import QObject, Signal
+
+
+LogRecord = namedtuple('LogRecord', ['time', 'level', 'message'])
+
+
+def record_to_json(record):
+    return json.dumps({'time': datetime.fromtimestamp(record.time).isoformat(timespec = 'milliseconds'),
+                       'level': record.level,
+                       'message': record.message}, ensure_ascii = False)
+
+
+def record_to_html(record):
+    return f"\n <br> >>> </br>  {record.message}\n"
+
+
+class LogWriter(threading.Thread):
+    """
+    Appends log records to logs.html and logs.jsonl on its own thread.
+    Records are written in batches every flush_interval seconds, so logging never
+    blocks the caller on disk.
+    """
+    def __init__(self, html_path = 'outputs/logs.html', jsonl_path = 'outputs/logs.jsonl', flush_interval = 0.5):
+        super(LogWriter, self).__init__(daemon = True)
+        self.html_path = html_path
+        self.jsonl_path = jsonl_path
+        self.flush_interval = flush_interval
+        self.records = queue.Queue()
+        self.running = True
+        #Start both files empty, like the previous log
+        with open(self.html_path, 'w') as out_file:
+            out_file.write('<meta charset="UTF-8">\n')
+        open(self.jsonl_path, 'w').close()
+
+    def put(self, record):
+        self.records.put(record)
+
+    def drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.records.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def write(self, batch):
+        if not batch:
+            return
+        with open(self.html_path, 'a') as out_file:
+            out_file.write(''.join(record_to_html(r) for r in batch))
+        with open(self.jsonl_path, 'a') as out_file:
+            out_file.write(''.join(record_to_json(r) + '\n' for r in batch))
+
+    def run(self):
+        while self.running:
+            time.sleep(self.flush_interval)
+            try:
+                self.write(self.drain())
+            except OSError as e:
+                print(f'Could not write logs: {e}')
+
+    def stop(self):
+        self.running = False
+        self.join(timeout = 2)
+        self.write(self.drain())
+
+
+class Logger(QObject):
+    """
+    Keeps the last max_records messages in memory and emits each new one, so the
+    console widget only appends a line instead of reloading the whole log.
+    Can be called from any thread; the signal is delivered on the GUI thread.
+    """
+    appended = Signal(object)
+
+    def __init__(self, max_records = 1000, writer = None):
+        super(Logger, self).__init__()
+        self.records = deque(maxlen = max_records)
+        self.lock = threading.Lock()
+        self.writer = writer if writer is not None else LogWriter()
+        self.writer.start()
+
+    def log(self, message, level = 'INFO'):
+        record = LogRecord(time.time(), level, str(message))
+        with self.lock:
+            self.records.append(record)
+        self.writer.put(record)
+        self.appended.emit(record)
+        return record
+
+    def history(self):
+        with self.lock:
+            return list(self.records)
+
+    def close(self):
+        self.writer.stop()
@@ -3,33 +3,44 @@
 # Mayo de 2021
 # Disponible en https//:github.com/blotero/FEET-GUI
 
+from startup import timer as startup_timer, lazy_import     #First, so the imports are timed
 import os
 import re
 from pathlib import Path
 import json
 import sys
-import matplotlib.pyplot as plt
 import numpy as np
 import cv2
 import time
-import pytesseract
 from PySide2.QtWidgets import QApplication, QMainWindow, QFileDialog 
 from PySide2.QtCore import QFile, QObject, SIGNAL, QDir, QTimer
 from PySide2.QtUiTools import QUiLoader 
 from segment import ImageToSegment, SessionToSegment
 from manualseg import manualSeg
-from temperatures import mean_temperature, dermatomes_temperatures
-from scipy.interpolate import make_interp_spline 
+from temperatures import mean_temperature, dermatomes_temperatures, session_statistics, unpack_mean_temperatures
 import cv2
 from PySide2.QtWidgets import *
 from PySide2.QtCore import *
 from PySide2.QtGui import *
 from datetime import datetime
-import tflite_runtime.interpreter as tflite
+from interpreters import registry, PRECISIONS, model_variant
+from tuning import TuningStore, tune
+import compare_models
 from postprocessing import PostProcessing
-from report import plot_report
+from writer import OutputWriter
+from instrument import tracer
+from jobs import JobScheduler, run_command
+from live import LiveSegmentationWorker, LiveSession, draw_overlay
+from camera import CameraReader
+from logs import Logger
+import scales
+from session import alphanum_key
+from pipeline import SessionPipeline
 import threading
 
+plt = lazy_import('matplotlib.pyplot')
+startup_timer.mark('imports')
+
 
 class RemotePullException(Exception):
     def __init__(self, repoURL):
@@ -57,6 +68,129 @@ class NotImplementedError(Exception):
 
     
 
+class ModelLoader(QObject):
+    """
+    Loads models into the interpreter registry on a background thread
+    """
+    loaded = Signal(str)
+    failed = Signal(str)
+    _done = Signal(str, bool)
+
+    def __init__(self):
+        super(ModelLoader, self).__init__()
+        self._done.connect(self._on_done)
+
+    def load(self, path):
+        threading.Thread(target = self._load, args = (path,), daemon = True).start()
+
+    def _load(self, path):
+        try:
+            registry.load(path)
+            self._done.emit(path, True)
+        except Exception as e:
+            print(e)
+            self._done.emit(path, False)
+
+    @Slot(str, bool)
+    def _on_done(self, path, success):
+        #Runs on the GUI thread (queued connection)
+        if success:
+            self.loaded.emit(path)
+        else:
+            self.failed.emit(path)
+
+
+class PerformancePanel(QDockWidget):
+    """
+    Per-stage time breakdown of the last run, taken from the tracer
+    """
+    headers = ['Etapa', 'Llamadas', 'Total (ms)', 'Media (ms)', 'Máx (ms)']
+
+    def __init__(self, parent = None):
+        super(PerformancePanel, self).__init__("Rendimiento", parent)
+        self.label = QLabel("Sin datos")
+        self.table = QTableWidget(0, len(self.headers))
+        self.table.setHorizontalHeaderLabels(self.headers)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        container = QWidget()
+        layout = QVBoxLayout(container)
+        layout.addWidget(self.label)
+        layout.addWidget(self.table)
+        self.setWidget(container)
+
+    def show_summary(self, title, summary, elapsed_ms):
+        self.label.setText(f"{title}: {elapsed_ms:.0f} ms")
+        self.table.setRowCount(len(summary))
+        for row, (name, stats) in enumerate(summary.items()):
+            values = [name, str(stats['count']), f"{stats['total_ms']:.1f}", f"{stats['mean_ms']:.1f}", f"{stats['max_ms']:.1f}"]
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+        self.table.resizeColumnsToContents()
+
+
+class TemperatureCurvePanel(QDockWidget):
+    """
+    Running mean feet temperature of a live session. Each processed capture appends one
+    point and schedules a repaint, nothing is recomputed
+    """
+    def __init__(self, parent = None):
+        super(TemperatureCurvePanel, self).__init__("Curva de temperatura", parent)
+        self.curve = TemperatureCurve()
+        self.setWidget(self.curve)
+
+    def add_point(self, time, temperature):
+        self.curve.add_point(time, temperature)
+
+    def clear(self):
+        self.curve.clear()
+
+
+class TemperatureCurve(QWidget):
+    margin = 36
+
+    def __init__(self, parent = None):
+        super(TemperatureCurve, self).__init__(parent)
+        self.setMinimumSize(260, 180)
+        self.clear()
+
+    def clear(self):
+        self.times, self.temperatures = [], []
+        self.low = self.high = None
+        self.last_time = 0
+        self.update()
+
+    def add_point(self, time, temperature):
+        self.times.append(time)
+        self.temperatures.append(temperature)
+        self.low = temperature if self.low is None else min(self.low, temperature)
+        self.high = temperature if self.high is None else max(self.high, temperature)
+        self.last_time = max(self.last_time, time)
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.white)
+        if not self.times:
+            painter.drawText(self.rect(), Qt.AlignCenter, "Sin capturas procesadas")
+            return
+        width = self.width() - 2*self.margin
+        height = self.height() - 2*self.margin
+        low, high = self.low - 0.5, self.high + 0.5
+        last_time = max(self.last_time, 1)
+        points = [QPointF(self.margin + width*t/last_time, self.margin + height*(high - value)/(high - low))
+                  for t, value in zip(self.times, self.temperatures)]
+        painter.setPen(QPen(QColor('slategrey'), 2))
+        painter.drawPolyline(QPolygonF(points))
+        for point in points:
+            painter.drawEllipse(point, 3, 3)
+        painter.setPen(Qt.black)
+        painter.drawText(4, self.margin, f"{high:.1f} °C")
+        painter.drawText(4, self.margin + height, f"{low:.1f} °C")
+        painter.drawText(self.margin, self.height() - 8, "0 min")
+        painter.drawText(self.margin + width - 40, self.height() - 8, f"{last_time} min")
+
+
 class Window:
     def __init__(self):
         super(Window, self).__init__()
@@ -74,31 +208,85 @@ class Window:
         self.modelsPathExists = True   #As soon as the model is present in the expected path
         self.model = 'default_model.tflite'
         self.fullScreen = True
+        self.registration_workers = os.cpu_count()   #Concurrent dermatomes registrations
+        #Interpreter settings tuned for this device (config.json), applied on every model load
+        self.tuning_store = TuningStore('config.json')
+        self.pending_tuning = None     #Model waiting for the session jobs to end to be tuned
+        registry.settings_provider = self.tuning_store
         #Loading segmentation models
-        self.s2s = SessionToSegment()
+        self.s2s = SessionToSegment(memory_budget = 256*2**20)   #Stream sessions in chunks of frames
         self.i2s = ImageToSegment()
         self.s2s.setModel(self.model)
         self.i2s.setModel(self.model)
-        self.s2s.loadModel()
-        self.i2s.loadModel()
         self.ui.loadedModelLabel.setText(self.model)
         self.camera_index = 0
-        self.setup_camera()
         self.sessionIsCreated = False
+        self.capture_index = None     #Last capture of the live session
+        self.last_capture = None      #(index, frame, frame mask) of the last segmented capture
         self.driveURL = None
         self.rcloneIsConfigured = False
         self.repoUrl = 'https://github.com/blotero/FEET-GUI.git' 
-        self.digits_model = tflite.Interpreter(model_path = './digits_recognition.tflite')
-        self.digits_model.allocate_tensors()
+        self.digits_model_path = './digits_recognition.tflite'
+        self.digits_recognizer = scales.DigitRecognizer(self.digits_model_path)
+        self.ocr_cache = scales.OCRCache('outputs/ocr_cache.json')
+        QApplication.instance().aboutToQuit.connect(self.ocr_cache.save)    #Captures read during the session
+        self.model_loader = ModelLoader()
+        self.model_loader.loaded.connect(self.on_model_loaded)
+        self.model_loader.failed.connect(self.on_model_failed)
+        self.init_jobs()
+        self.performance_panel = PerformancePanel(self.ui)
+        self.ui.addDockWidget(Qt.RightDockWidgetArea, self.performance_panel)
+        self.performance_panel.setVisible(tracer.enabled)
+        self.curve_panel = TemperatureCurvePanel(self.ui)
+        self.ui.addDockWidget(Qt.RightDockWidgetArea, self.curve_panel)
+        self.curve_panel.setVisible(False)     #Shown with the first processed capture
+        self.ui.actionRendimiento.setChecked(tracer.enabled)
+        self.run_start = None
+        self.output_writer = OutputWriter(quality = 95, format = None)   #format e.g. 'png' to change the outputs format
         self.set_default_input_cmap()
-        self.file_system_model = QFileSystemModel()
-        self.file_system_model.setRootPath(QDir.currentPath())
-        self.ui.treeView.setModel(self.file_system_model)
-        plt.style.use('bmh')
+        self.set_default_precision()
+        self.live_contours = None
+        self.live_worker = LiveSegmentationWorker(self.model, self.input_cmap, self.ui.morphoSpinBox.value())
+        self.live_worker.segmented.connect(self.on_frame_segmented)
+        self.live_worker.start()
+        QApplication.instance().aboutToQuit.connect(self.live_worker.stop)
         self.session_info = {}
         self.ui.progressBar.setVisible(False)
         self.timer_cron = QTimer()
         self.timer_cron.timeout.connect(self.tick)
+        self.startupReported = False
+        startup_timer.mark('window created')
+
+    def finish_startup(self):
+        """
+        Initialization that can wait until the window is shown: segmentation model,
+        camera and file browser. The model is loaded in background, on_model_loaded
+        reports the startup times
+        """
+        startup_timer.mark('window shown')
+        self.pending_model = self.model
+        self.model_loader.load(self.model)
+        self.setup_camera()
+        QApplication.instance().aboutToQuit.connect(self.camera.stop)
+        self.file_system_model = QFileSystemModel()
+        self.file_system_model.setRootPath(QDir.currentPath())
+        self.ui.treeView.setModel(self.file_system_model)
+        import matplotlib.style      #Submodule, not loaded by matplotlib alone
+        matplotlib.style.use('bmh')
+        startup_timer.mark('camera and browser')
+
+    def report_startup(self):
+        """
+        Logs the startup time and writes the per step times to outputs/startup.json
+        """
+        self.startupReported = True
+        elapsed = startup_timer.mark('ready')
+        self.message_print(f"Interfaz lista en {elapsed/1000:.2f} s")
+        print(startup_timer.report())
+        try:
+            startup_timer.save('outputs/startup.json')
+        except OSError as e:
+            print(f'Could not write startup times: {e}')
         
     def tick(self):
         if self.current_secs < 10:
@@ -127,68 +315,23 @@ class Window:
         """
         Predicts digit value from a certain region image
         """
-
         image_2 = cv2.resize(image, (28, 28), interpolation = cv2.INTER_NEAREST)
-        
         image_2 = cv2.cvtColor(np.uint8(image_2), cv2.COLOR_BGR2GRAY)
-        
-        image_2 = np.expand_dims(image_2, -1)
-
-        image_2 = np.expand_dims(image_2, 0)
-        input_details = self.digits_model.get_input_details()
-        output_details = self.digits_model.get_output_details()
-
-        input_shape = input_details[0]['shape']
-        input_data = np.float32(image_2)
-
-        self.digits_model.set_tensor(input_details[0]['index'], input_data)
-
-        self.digits_model.invoke()  # predict
-
-        output_data = self.digits_model.get_tensor(output_details[0]['index'])
-
-        return np.argmax(output_data)  
+        probabilities = self.digits_recognizer.classify(np.float32(image_2)[None,:,:,None])
+        return np.argmax(probabilities)  
         
     def predict_number_with_pytesseract(self, img):
         """
         Obtain number from section of an image
         """
-        uint8img = img.astype("uint8")
-        #print(np.unique(uint8img))
-        #print(uint8img.shape)
-        thresh = cv2.threshold(uint8img , 100, 255, cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)[1]
-        #plt.figure()
-        # plt.imshow(thresh)
-        text = pytesseract.image_to_string(thresh,   config = '--psm 7')
-        #Text cleaning and replacement...
-        clean_text = text.replace('\n','').replace('-]', '4').replace(']', '1').replace(' ', '').replace(',', '.').replace('%', '7').replace('€','9').replace('[','').replace('&', '5').replace('-','3')
-        # plt.title(clean_text)
-        # plt.show()
-        try:
-            num = float(clean_text)
-            if num>=100:
-                num/=10
-        except:
-            print(f"Could not convert string {clean_text} into number")
-            self.message_print(f"No se ha podido detectar escalas automáticamente de: Texto base: {text}, Texto limpio: {clean_text}. Dejando rango por defecto: [25, 45]")
-            return -100
-        return num
+        return scales.predict_number_with_pytesseract(img, log = self.message_print, cache = self.ocr_cache)
 
 
     def extract_scales_with_pytesseract(self,x):
         """
         Extracts float lower and upper scales from a thermal image with pytesseract
         """
-        lower_seg = x[445: 467, 575: 625,0]
-        upper_seg = x[14: 34, 576: 624,0]
-        lower_prediction = self.predict_number_with_pytesseract(lower_seg)
-        upper_prediction = self.predict_number_with_pytesseract(upper_seg)
-        
-        if lower_prediction == -100:
-            lower_prediction = 25
-        if upper_prediction == -100:
-            upper_prediction = 45
-        return lower_prediction, upper_prediction
+        return scales.extract_scales_with_pytesseract(x, log = self.message_print, cache = self.ocr_cache)
 
      
     def extract_scales_2(self,x):
@@ -215,29 +358,16 @@ class Window:
     def extract_scales(self, x):
         """
         Extracts float lower and upper scales from a thermal image
+        with the digits model, or with pytesseract if the model is not confident
         """
-        lower_digit_1 = self.predict_number(x[445: 467, 575: 591])
-        lower_digit_2 = self.predict_number(x[445: 467, 589: 605])
-        lower_digit_3 = self.predict_number(x[445: 467, 609: 625])
-        
-        upper_digit_1 = self.predict_number(x[14: 34, 576: 590])
-        upper_digit_2 = self.predict_number(x[14: 34, 590: 604])
-        upper_digit_3 = self.predict_number(x[14: 34, 610: 624])
-
-        lower_bound = lower_digit_1*10 + lower_digit_2 + lower_digit_3*0.1
-        upper_bound = upper_digit_1*10 + upper_digit_2 + upper_digit_3*0.1
-
-        return lower_bound, upper_bound
+        return self.extract_multiple_scales(x[None])[0]
 
     def extract_multiple_scales(self, X):
         """
         Extracts scales from a whole imported session
         """
-        scales = []
-        for i in range(X.shape[0]):
-            scales.append(self.extract_scales_with_pytesseract(X[i]))
-            
-        return scales
+        return scales.extract_multiple_scales(X, log = self.message_print, recognizer = self.digits_recognizer,
+                                             cache = self.ocr_cache)
 
 
     def populate_session_info(self):
@@ -263,14 +393,17 @@ class Window:
         self.session_info['Temperaturas_medias'] = self.meanTemperatures
         self.session_info['Escalas_de_temperatura'] = self.scale_range
         self.session_info['Temperaturas_de_dermatomas'] = self.dermatomes_temps.tolist()
+        statistics = session_statistics(self.original_temps, self.Y, self.dermatomes_masks)
+        self.session_info['Estadisticas'] = {group: {key: value.tolist() for key, value in stats.items()}
+                                             for group, stats in statistics.items()}
 
     def setup_camera(self):
         """
         Initialize camera.
         """
-        self.capture = cv2.VideoCapture(self.camera_index)
-        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        self.camera = CameraReader(self.camera_index, 640, 480)
+        self.camera.start()
+        self.last_metrics_time = time.time()
 
         self.timer = QTimer()
         self.timer.timeout.connect(self.display_frame)
@@ -281,24 +414,30 @@ class Window:
         """
         Refresh frame from camera
         """
-        try:
-            self.ret, self.frame = self.capture.read()
-            self.frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
-            # image = qimage2ndarray.array2qimage(self.frame)
-            self.image = QImage(self.frame, self.frame.shape[1], self.frame.shape[0], 
-                        self.frame.strides[0], QImage.Format_RGB888)
+        for message in self.camera.pop_messages():
+            self.message_print(message)
+        latest = self.camera.acquire_latest()
+        if latest is None:
+            return
+        _, self.frame = latest      #View of the camera ring buffer, valid until next refresh
+        self.image = QImage(self.frame, self.frame.shape[1], self.frame.shape[0], 
+                    self.frame.strides[0], QImage.Format_RGB888)
+        if self.live_worker.live:
+            self.live_worker.submit(self.frame.copy())
+        if self.live_worker.live and self.live_contours is not None:
+            #Latest available segmentation drawn over the current frame
+            overlay = draw_overlay(self.frame, self.live_contours)
+            self.ui.inputImg.setPixmap(QPixmap.fromImage(QImage(overlay, overlay.shape[1], overlay.shape[0],
+                                       overlay.strides[0], QImage.Format_RGB888)))
+        else:
             self.ui.inputImg.setPixmap(QPixmap.fromImage(self.image))
-        except:
-            time.sleep(1)
-            self.message_print(f'No se detectó cámara {self.camera_index}. Reintentando...')
-            print(f'Camera was not detected on index {self.camera_index}')
-            if self.camera_index < 5:
-                self.camera_index += 1
-                print(f'Retrying with index {self.camera_index}...')
-            else:
-                self.message_print("Error detectando cámara. Por favor revisar conexión.")
-                self.timer.stop()
-                pass
+
+        if time.time() - self.last_metrics_time > 1:
+            metrics = self.camera.metrics()
+            self.ui.statusbar.showMessage(f"Cámara {metrics['camera_index']}: {metrics['fps']:.1f} fps, "
+                                          f"latencia {metrics['latency_ms']:.0f} ms, "
+                                          f"cuadros perdidos {metrics['frames_dropped']}")
+            self.last_metrics_time = time.time()
 
     
     def capture_image(self):
@@ -311,30 +450,54 @@ class Window:
         self.timer_cron.start(1000)
         if (not self.sessionIsCreated):
             self.message_print("No se ha creado una sesion. Creando nueva...")
-            time.sleep(1)
             self.create_session()
-        
-        if len(os.listdir(self.session_dir)) <= 1:
-            image_number = len(os.listdir(self.session_dir))
-        else:
-            image_number = 5*len(os.listdir(self.session_dir)) - 5
-        
+
+        save_path, image_number = self.live_session.next_capture()
         self.save_name = f't{image_number}.jpg'
-        plt.imsave(os.path.join(self.session_dir, self.save_name), self.frame)
-        self.ui.outputImg.setPixmap(QPixmap.fromImage(self.image))
+        self.captured_frame = self.camera.snapshot()
+        if self.captured_frame is None:
+            self.message_print("No se ha recibido ninguna imagen de la cámara.")
+            return
+        plt.imsave(save_path, self.captured_frame)
+        self.ui.outputImg.setPixmap(QPixmap.fromImage(QImage(self.captured_frame, self.captured_frame.shape[1],
+                                    self.captured_frame.shape[0], self.captured_frame.strides[0], QImage.Format_RGB888)))
         self.ui.imgName.setText(self.save_name[:-4])
         this_image = f"{self.defaultDirectory}/t{image_number}.jpg"
         self.ui.inputImgImport.setPixmap(this_image)
-        self.find_images()
-        
+        #The session is only extended, there is no need to scan the directory again
+        self.fileList.append(this_image)
+        self.files.append(self.save_name)
+        self.outfiles.append("outputs/" + self.save_name)
+        self.imageQuantity = len(self.fileList)
+
+        #Only the new capture is segmented and processed, in the background
+        self.capture_index = self.live_session.add_capture(this_image, image_number,
+                                                           [self.ui.minSpinBox.value(), self.ui.maxSpinBox.value()])
+        self.live_worker.min_size = self.ui.morphoSpinBox.value()
         if self.ui.autoScaleCheckBox.isChecked():
-            # Read and set the temperature range:
-            temp_scale = self.extract_scales_with_pytesseract(self.frame)
-            self.ui.minSpinBox.setValue(temp_scale[0])
-            self.ui.maxSpinBox.setValue(temp_scale[1])
+            #The scale is read in background (digits model, maybe tesseract), then the capture is segmented
+            self.jobs.submit(f'escala:{self.capture_index}', self.run_capture_scale, queue = 'capture',
+                             on_done = self.on_capture_scale, progress_format = "Leyendo escala...%p%",
+                             live_session = self.live_session, index = self.capture_index, frame = self.captured_frame)
+        else:
+            self.live_worker.submit_capture(self.captured_frame, tag = f'capture:{self.capture_index}')
+
+    def run_capture_scale(self, job, live_session, index, frame):
+        return live_session, index, frame, self.extract_scales(frame)
+
+    def on_capture_scale(self, result):
+        live_session, index, frame, temp_scale = result
+        if live_session is not getattr(self, 'live_session', None):
+            return     #The session was closed meanwhile
+        self.ui.minSpinBox.setValue(temp_scale[0])
+        self.ui.maxSpinBox.setValue(temp_scale[1])
+        live_session.set_scale(index, [self.ui.minSpinBox.value(), self.ui.maxSpinBox.value()])
+        self.live_worker.submit_capture(frame, tag = f'capture:{index}')
 
     def wipe_outputs(self, hard=False):
         self.message_print("Limpiando sesión...")
+        self.jobs.cancel(queue = 'session')     #Results of the previous input are not wanted anymore
+        self.jobs.cancel(queue = 'capture')
         self.imgs = []
         self.subj = []
         self.inputExists = False
@@ -342,13 +505,16 @@ class Window:
         self.isSegmented = False
         self.files = None
         self.temperaturesWereAcquired = False
-        self.s2s = SessionToSegment()
+        self.output_futures = []
+        self.s2s = SessionToSegment(memory_budget = 256*2**20)   #Stream sessions in chunks of frames
         self.i2s = ImageToSegment()
         self.s2s.setModel(self.model)
         self.i2s.setModel(self.model)
         self.s2s.loadModel()
         self.i2s.loadModel()
         self.sessionIsCreated = False
+        self.capture_index = None     #Last capture of the live session
+        self.last_capture = None      #(index, frame, frame mask) of the last segmented capture
         self.ui.outputImgImport.setPixmap("")
         self.ui.inputImgImport.setPixmap("")
         self.ui.outputImg.setPixmap("")
@@ -382,6 +548,11 @@ class Window:
             self.session_dir = os.path.join('outputs',self.dir_name)
             os.mkdir(self.session_dir)
             self.sessionIsCreated = True
+            self.live_session = LiveSession(os.path.abspath(self.session_dir))
+            self.live_session.frame_processed.connect(self.on_capture_processed)
+            self.curve_panel.clear()
+            self.fileList, self.files, self.outfiles = [], [], []
+            self.imageQuantity = 0
             self.message_print("Sesión " + self.session_dir + " creada exitosamente." )
             self.defaultDirectoryExists = True
             self.defaultDirectory = os.path.abspath(self.session_dir)
@@ -389,29 +560,34 @@ class Window:
             self.sessionIsSegmented = False
             self.input_type = 2 #Video input capture
         except Exception as ex:
-            self.message_print("Fallo al crear la sesión. Lea el manual de ayuda para encontrar solución, o reporte bugs al " + self.bugsURL)
+            self.message_print("Fallo al crear la sesión. Lea el manual de ayuda para encontrar solución, o reporte bugs al " + self.bugsURL, level = 'ERROR')
             print(ex)
         
     def sync_local_info_to_drive(self):
         """
-        Syncs info from the output directory to the configured sync path
+        Syncs info from the output directory to the configured sync path, in background
         """
         self.message_print("Sincronizando información al repositorio remoto...")
-        try:
-            status = os.system("rclone copy outputs drive:")
-            self.message_print("Sincronizando información al repositorio remoto...")
-            if self.rcloneIsConfigured:
-                if status == 0:
-                    self.message_print("Se ha sincronizado exitosamente la información")
-                    return
-                raise Exception("Error sincronizando imagenes al repositorio remoto")
+        return self.jobs.submit('sincronizacion', self.run_sync, queue = 'sync', on_done = self.on_synced,
+                                on_error = self.on_sync_failed, progress_format = "Sincronizando...")
+
+    def run_sync(self, job):
+        status = run_command(job, ['rclone', 'copy', 'outputs', 'drive:'])
+        if not self.rcloneIsConfigured:
             raise RemoteOriginUnauthorizedException(self.driveURL)
-        except RemoteOriginUnauthorizedException as ue:
-            self.message_print("Error de autorización durante la sincronización. Dirígase a Ayuda > Acerca de para más información.")
-            print(ue)
-        except Exception as e:
-            self.message_print("Error al sincronizar la información al repositorio. Verifique que ha seguido los pasos de instalación y configuración de rclone. Para más información, dirígase a Ayuda > Acerca de.")
-            print(e)
+        if status != 0:
+            raise Exception("Error sincronizando imagenes al repositorio remoto")
+        return status
+
+    def on_synced(self, status):
+        self.message_print("Se ha sincronizado exitosamente la información")
+
+    def on_sync_failed(self, error):
+        if isinstance(error, RemoteOriginUnauthorizedException):
+            self.message_print("Error de autorización durante la sincronización. Dirígase a Ayuda > Acerca de para más información.", level = 'ERROR')
+        else:
+            self.message_print("Error al sincronizar la información al repositorio. Verifique que ha seguido los pasos de instalación y configuración de rclone. Para más información, dirígase a Ayuda > Acerca de.", level = 'ERROR')
+        print(error)
 
     def repo_config_dialog(self):
         """
@@ -426,12 +602,15 @@ class Window:
         QObject.connect(self.ui.actionCargar_imagen, SIGNAL ('triggered()'), self.open_image)
         QObject.connect(self.ui.actionCargar_carpeta , SIGNAL ('triggered()'), self.open_folder)
         QObject.connect(self.ui.actionCargar_modelos , SIGNAL ('triggered()'), self.get_models_path)
+        QObject.connect(self.ui.actionAjustar_interprete , SIGNAL ('triggered()'), self.tune_model)
+        QObject.connect(self.ui.actionComparar_modelos , SIGNAL ('triggered()'), self.benchmark_models)
         QObject.connect(self.ui.actionPantalla_completa , SIGNAL ('triggered()'), self.toggle_fullscreen)
         QObject.connect(self.ui.actionSalir , SIGNAL ('triggered()'), self.exit_)
         QObject.connect(self.ui.actionC_mo_usar , SIGNAL ('triggered()'), self.display_how_to_use)
         QObject.connect(self.ui.actionUpdate , SIGNAL ('triggered()'), self.update_software)
         QObject.connect(self.ui.actionRepoSync , SIGNAL ('triggered()'), self.sync_local_info_to_drive)
         QObject.connect(self.ui.actionRepoConfig , SIGNAL ('triggered()'), self.repo_config_dialog)
+        self.ui.actionRendimiento.toggled.connect(self.toggle_performance_panel)
         QObject.connect(self.ui.segButtonImport, SIGNAL ('clicked()'), self.segment)
         QObject.connect(self.ui.tempButtonImport, SIGNAL ('clicked()'), self.temp_extract)
         QObject.connect(self.ui.captureButton, SIGNAL ('clicked()'), self.capture_image)
@@ -444,9 +623,14 @@ class Window:
         QObject.connect(self.ui.segButton, SIGNAL ('clicked()'), self.segment_capture)
         #Comboboxes:
         self.ui.inputColormapComboBox.currentIndexChanged['QString'].connect(self.toggle_input_colormap)
+        self.ui.modelComboBox.currentIndexChanged[int].connect(self.prefetch_model)
+        self.ui.precisionComboBox.currentIndexChanged[int].connect(self.toggle_precision)
+        #Checkboxes:
+        self.ui.liveCheckBox.toggled.connect(self.toggle_live_segmentation)
 
     def toggle_input_colormap(self):
         self.input_cmap = self.accepted_cmaps[self.ui.inputColormapComboBox.currentIndex()]
+        self.live_worker.cmap = self.input_cmap
         self.message_print(f"Se ha cambiado exitosamente el colormap de entrada a {self.input_cmap}")
 
     def set_default_input_cmap(self):
@@ -454,38 +638,199 @@ class Window:
         self.input_cmap = self.accepted_cmaps[0]
         self.ui.inputColormapComboBox.addItems(self.accepted_cmaps)
 
+    def set_default_precision(self):
+        #'auto' uses the selected model file as it is
+        self.precisions = ['auto'] + PRECISIONS
+        self.precision = self.precisions[0]
+        self.ui.precisionComboBox.blockSignals(True)
+        self.ui.precisionComboBox.addItems(['Precisión automática'] + PRECISIONS)
+        self.ui.precisionComboBox.blockSignals(False)
+
+    def model_for_precision(self, path, warn = True):
+        """
+        Variant of the model for the selected precision, or the model itself if the
+        variant does not exist
+        """
+        if self.precision == 'auto':
+            return path
+        variant = model_variant(path, self.precision)
+        if not os.path.isfile(variant):
+            if warn:
+                self.message_print(f"No se encontró el modelo {os.path.basename(variant)}, se usará {os.path.basename(path)}", level = 'WARNING')
+            return path
+        return variant
+
+    def toggle_precision(self, index):
+        """
+        Loads the variant of the current model for the selected precision
+        """
+        self.precision = self.precisions[index]
+        model = self.model_for_precision(model_variant(self.model, 'float32'))
+        if model != self.model:
+            self.message_print(f"Cargando modelo {os.path.basename(model)}...")
+            self.pending_model = model
+            self.model_loader.load(model)
+
 
     def segment_capture(self):
         """
-        Segment newly acquired capture with current loaded segmentation model
+        Shows the segmentation of the last capture. Captures are segmented as soon as they
+        are taken, so it is never submitted again
         """
-        self.message_print("Segmentando imagen...")
-        self.i2s.setModel(self.model)
-        self.i2s.setPath(os.path.join(self.session_dir,self.save_name))
-        self.i2s.loadModel()
-        self.i2s.extract(cmap = self.input_cmap)
-        threshold =  0.5   
-        img = plt.imread(os.path.join(self.session_dir, self.save_name))/255
-        Y = self.i2s.Y_pred
-        Y = Y / Y.max()
-        Y = np.where( Y >= threshold  , 1 , 0)
-        post_processing = PostProcessing(self.ui.morphoSpinBox.value())
-        u = post_processing.execute(Y[0])
-        self.Y = u[0]     #Eventually required by temp_extract
-        Y = np.copy(u)
-        Y = cv2.resize(Y[0], (img.shape[1],img.shape[0]), interpolation = cv2.INTER_NEAREST) # Resize the prediction to have the same dimensions as the input 
+        if self.capture_index is None:
+            self.message_print("No se ha capturado ninguna imagen.")
+            return
+        if self.last_capture is None or self.last_capture[0] != self.capture_index:
+            self.message_print("La captura se está segmentando...")
+            return
+        _, frame, frame_mask = self.last_capture
+        self.show_capture_segmentation(frame, frame_mask)
+
+    def toggle_live_segmentation(self, checked):
+        """
+        Starts or stops the live segmentation of camera frames
+        """
+        self.live_contours = None
+        self.live_worker.min_size = self.ui.morphoSpinBox.value()
+        self.live_worker.live = checked
+
+    def on_frame_segmented(self, tag, frame, mask, frame_mask, contours):
+        """
+        Receives segmentations from the live worker (GUI thread)
+        """
+        if tag == 'live':
+            if self.live_worker.live:
+                self.live_contours = contours
+            return
+
+        self.Y = mask     #Eventually required by temp_extract
+        self.show_capture_segmentation(frame, frame_mask)
+        if tag.startswith('capture:'):
+            index = int(tag.split(':')[1])
+            self.last_capture = (index, frame, frame_mask)
+            self.live_session.process(index, frame, mask, self.input_cmap)
+
+    def show_capture_segmentation(self, frame, frame_mask):
+        img = frame/255
         if self.ui.rainbowCheckBoxImport.isChecked():
             cmap = 'rainbow'
         else:
             cmap = 'gray'
-        # plt.figure()
-        # plt.plot(Y*img[:,:,0])
-        # plt.savefig("outputs/output.jpg")
-        plt.imsave("outputs/output.jpg" , Y*img[:,:,0] , cmap=cmap)
+        plt.imsave("outputs/output.jpg" , frame_mask*img[:,:,0] , cmap=cmap)
         self.ui.outputImg.setPixmap("outputs/output.jpg")
         self.isSegmented = True
         self.message_print("Imagen segmentada exitosamente")
 
+    def on_capture_processed(self, index):
+        """
+        Shows the temperature of a capture as soon as it is processed (GUI thread)
+        """
+        mean = self.live_session.mean_temps[index]
+        self.ui.temperatureLabel.setText(f'{np.round(mean, 2)} °C')
+        self.message_print(f"La temperatura media de pies es:  {np.round(mean, 2)} para el tiempo: t{self.live_session.times[index]}")
+        self.curve_panel.add_point(self.live_session.times[index], float(np.mean(mean)))
+        self.curve_panel.setVisible(True)
+        self.temperaturesWereAcquired = False     #Report data changed
+
+    def use_live_results(self):
+        """
+        Takes the per-capture results of the live session as the session temperatures
+        Returns False if no capture has been processed yet
+        """
+        results = self.live_session.results()
+        if not results['files']:
+            return False
+        self.timeList = results['times']
+        self.scale_range = results['scale_range']
+        self.Y = results['masks']
+        self.meanTemperatures = results['mean_temps']
+        self.segmented_temps = results['segmented_temps']
+        self.original_temps = results['original_temps']
+        self.dermatomes_temps = results['dermatomes_temps']
+        self.dermatomes_masks = results['dermatomes_masks']
+        self.temperaturesWereAcquired = True
+        return True
+
+
+    def init_jobs(self):
+        """
+        Heavy actions run as jobs on a thread pool, the progress bar and the cancel
+        button follow the running job
+        """
+        self.jobs = JobScheduler()
+        self.jobs.started.connect(self.on_job_started)
+        self.jobs.progress.connect(self.on_job_progress)
+        self.jobs.failed.connect(self.on_job_failed)
+        self.jobs.cancelled.connect(self.on_job_cancelled)
+        self.jobs.idle.connect(self.on_jobs_idle)
+        self.cancelButton = QPushButton("Cancelar")
+        self.cancelButton.setVisible(False)
+        self.cancelButton.clicked.connect(self.cancel_jobs)
+        self.ui.statusbar.addPermanentWidget(self.cancelButton)
+        QApplication.instance().aboutToQuit.connect(self.stop_jobs)
+
+    def cancel_jobs(self):
+        self.message_print("Cancelando tareas...")
+        self.jobs.cancel()
+
+    def stop_jobs(self):
+        self.jobs.cancel()
+        self.jobs.wait(5000)
+
+    def on_job_started(self, job):
+        self.ui.progressBar.setVisible(True)
+        self.ui.progressBar.setFormat(job.progress_format)
+        self.ui.progressBar.setValue(0)
+        self.cancelButton.setVisible(True)
+
+    def on_job_progress(self, job, percent):
+        self.ui.progressBar.setValue(percent)
+
+    def on_job_failed(self, job, error):
+        if job.on_error is None:
+            self.message_print(f"Error en la tarea {job.name}: {error}", level = 'ERROR')
+            print(error)
+
+    def on_job_cancelled(self, job):
+        self.message_print(f"Tarea {job.name} cancelada")
+
+    def on_jobs_idle(self):
+        self.ui.progressBar.setVisible(False)
+        self.ui.progressBar.setFormat("%p%")
+        self.cancelButton.setVisible(False)
+        if self.pending_tuning is not None:
+            self.tune_model(self.pending_tuning)
+
+    def toggle_performance_panel(self, checked):
+        """
+        Enables the pipeline tracing and shows its breakdown
+        """
+        tracer.enable(checked)
+        self.performance_panel.setVisible(checked)
+
+    def begin_run(self):
+        """
+        Starts tracing a run (segmentation, temperatures, report)
+        """
+        if tracer.enabled:
+            tracer.reset()
+            self.run_start = time.perf_counter()
+
+    def end_run(self, name):
+        """
+        Shows the stages of the run in the performance panel and saves its Chrome trace
+        in the session directory (trace_<name>.json)
+        """
+        if not tracer.enabled or self.run_start is None:
+            return
+        elapsed_ms = 1000*(time.perf_counter() - self.run_start)
+        self.run_start = None
+        self.performance_panel.show_summary(name, tracer.summary(), elapsed_ms)
+        directory = self.defaultDirectory if self.defaultDirectoryExists else 'outputs'
+        try:
+            tracer.export_chrome(os.path.join(directory, f'trace_{name}.json'), {'run': name, 'model': self.model})
+        except OSError as e:
+            print(f'Could not write trace: {e}')
 
     def set_default_config_settings(self, model_dir, session_dir):
         """
@@ -502,24 +847,22 @@ class Window:
         self.defaultDirectory = self.config['session_directory']
 
     def init_logs(self):
-        log_path = "outputs/logs.html"
-        open(log_path, 'w').close()
-        out_file = open(log_path , "a")
-        final_msg = f'<meta charset="UTF-8">\n'
-        out_file.write(final_msg)
-        out_file.close()
+        self.logger = Logger(max_records = 1000)
+        self.logger.appended.connect(self.on_log_record)
+        self.ui.textBrowser.document().setMaximumBlockCount(self.logger.records.maxlen)
+        QApplication.instance().aboutToQuit.connect(self.logger.close)
 
-    def message_print(self, message):
+    def message_print(self, message, level = 'INFO'):
         """
         Prints on interface console
         """
-        log_path = "outputs/logs.html"
-        out_file = open(log_path , "a")
-        final_msg = f"\n <br> >>> </br>  {message}\n"
-        out_file.write(final_msg)
-        out_file.close()
-        self.ui.textBrowser.setSource(log_path)
-        self.ui.textBrowser.reload()
+        self.logger.log(message, level)
+
+    def on_log_record(self, record):
+        """
+        Appends a single record to the console instead of reloading the log file
+        """
+        self.ui.textBrowser.append(f">>> {record.message}")
         self.ui.textBrowser.moveCursor(QTextCursor.End)
 
 
@@ -546,10 +889,9 @@ class Window:
         """
         Sort file list to an alphanumeric reasonable sense
         """         
-        convert = lambda text: int(text) if text.isdigit() else text 
-        alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ] 
         self.fileList =  sorted(self.fileList, key = alphanum_key)
         self.files =  sorted(self.files, key = alphanum_key)
+        self.outfiles =  sorted(self.outfiles, key = alphanum_key)
 
     def get_times(self):
         """
@@ -637,36 +979,55 @@ class Window:
 
     def feet_segment(self):
         """
-        Segments a single feet image
+        Queues the segmentation of a single feet image. Returns its job
         """
         self.message_print("Segmentando imagen...")
-        self.i2s.setModel(self.model)
-        self.i2s.setPath(self.opdir)
+        self.isSegmented = False
+        return self.jobs.submit('segmentacion', self.run_feet_segment, queue = 'session',
+                                on_done = self.on_feet_segmented, progress_format = "Segmentando...",
+                                model = self.model, path = self.opdir)
+
+    def run_feet_segment(self, job, model, path):
+        self.i2s.setModel(model)
+        self.i2s.setPath(path)
         self.i2s.extract()
+
+    def on_feet_segmented(self, result):
         self.show_segmented_image()
         self.isSegmented = True
         self.message_print("Imagen segmentada exitosamente")
 
     def session_segment(self):
         """
-        Segments a whole feet session
+        Queues the segmentation of a whole feet session. Returns its job
         """
-        self.ui.progressBar.setVisible(True)
-        self.ui.progressBar.setFormat("Segmentando..%p%")
-        self.ui.progressBar.setValue(0)
-        time.sleep(0.5)
         self.sessionIsSegmented = False
+        return self.jobs.submit('segmentacion', self.run_session_segment, queue = 'session',
+                                prepare = self.prepare_session_segment, on_done = self.on_session_segmented,
+                                progress_format = "Segmentando..%p%")
+
+    def prepare_session_segment(self):
         self.s2s.setModel(self.model)
         self.s2s.setPath(self.defaultDirectory)
-        self.s2s.whole_extract(self.fileList, cmap = self.input_cmap, progressBar = self.ui.progressBar)
+        self.configure_pipeline()
+        return {}
+
+    def run_session_segment(self, job):
+        self.begin_run()
+        self.pipeline.progressBar = job
+        masks = list(self.pipeline.get('masks')['masks'])
+        return masks, 'inference' in self.pipeline.computed
+
+    def on_session_segmented(self, result):
+        self.Y, inferred = result     #Eventually required by temp_extract
+        if not inferred:
+            self.message_print("Segmentación recuperada de la caché de la sesión")
         self.produce_segmented_session_output()
         self.show_output_image_from_session()
         self.message_print("Se ha segmentado exitosamente la sesion con "+ self.i2s.model)
+        self.end_run('segmentacion')
         self.sessionIsSegmented = True
-        self.ui.progressBar.setValue(100)
-        # time.sleep(0.5)
-        self.ui.progressBar.setVisible(False)
-        self.ui.progressBar.setFormat("%p%")
+
     def show_segmented_image(self):
         """
         Shows segmented image
@@ -693,31 +1054,15 @@ class Window:
     def produce_segmented_session_output(self):
         """
         Produce output images from a whole session and         """
-        #Recursively applies show_segmented_image to whole session
-        self.Y=[]
-        post_processing = PostProcessing(self.ui.morphoSpinBox.value())
-        for i in range(len(self.outfiles)):
-            threshold =  0.5
-            img = plt.imread(self.fileList[i])/255
-            Y = self.s2s.Y_pred[i]
-            Y = Y / Y.max()
-            Y = np.where( Y >= threshold  , 1 , 0)
-            Y = post_processing.execute(Y[0])
-            
-            self.Y.append(Y)    #Eventually required by temp_extract
-            
-            #print(f"Dimensiones de la salida: {Y.shape}")
-            Y = cv2.resize(Y, (img.shape[1],img.shape[0]), interpolation = cv2.INTER_NEAREST) # Resize the prediction to have the same dimensions as the input 
-            
-            if self.ui.rainbowCheckBox.isChecked():
-                cmap = 'rainbow'
-            else:
-                cmap = 'gray'
-            # plt.figure()
-            # plt.imshow(Y*img[:,:,0])
-            # plt.axis('off')
-            # plt.savefig(self.outfiles[i])
-            plt.imsave(self.outfiles[i], Y*img[:,:,0] , cmap=cmap)
+        #Frames are encoded in background, only the displayed one is waited for
+        if self.ui.rainbowCheckBox.isChecked():
+            cmap = 'rainbow'
+        else:
+            cmap = 'gray'
+        #Frames are not kept after the segmentation, the writer threads decode them again
+        self.outfiles = [self.output_writer.output_path(path) for path in self.outfiles]
+        self.output_futures = self.output_writer.write_session(self.outfiles, self.Y, sources = self.fileList,
+                                                               cmap = cmap)
 
 
     def show_output_image_from_session(self):
@@ -725,8 +1070,30 @@ class Window:
         Display segmented image from current one selected from the index 
         established by self.previous_image or self.next_image methods
         """
+        futures = getattr(self, 'output_futures', None)
+        if futures and self.imageIndex < len(futures):
+            try:
+                futures[self.imageIndex].result()
+            except Exception as e:
+                self.message_print(f"Error al escribir {self.outfiles[self.imageIndex]}: {e}", level = 'ERROR')
         self.ui.outputImgImport.setPixmap(self.outfiles[self.imageIndex])
 
+    def configure_pipeline(self):
+        """
+        Updates the session pipeline inputs from the interface settings
+        A new pipeline is made when the session or the segmenter change
+        """
+        pipeline = getattr(self, 'pipeline', None)
+        if pipeline is None or pipeline.s2s is not self.s2s or pipeline.session_dir != self.defaultDirectory:
+            self.pipeline = SessionPipeline(self.defaultDirectory, self.s2s, log = self.message_print,
+                                            recognizer = self.digits_recognizer, ocr_cache = self.ocr_cache,
+                                            workers = self.registration_workers)
+        manual_scale = None
+        if not self.ui.autoScaleCheckBoxImport.isChecked():
+            manual_scale = [self.ui.minSpinBoxImport.value() , self.ui.maxSpinBoxImport.value()]
+        self.pipeline.configure(self.fileList, self.model, self.input_cmap, self.ui.morphoSpinBox.value(),
+                                manual_scale = manual_scale, digits_model = self.digits_model_path)
+
     def segment(self):
         """
         Makes segmentation action depending on the current state (single image or whole session)
@@ -737,7 +1104,7 @@ class Window:
                 self.message_print("Segmentando toda la sesión...")
                 self.session_segment()
             else:
-                self.message_print("Error. Por favor verifique que se ha cargado el modelo y la sesión de entrada.")
+                self.message_print("Error. Por favor verifique que se ha cargado el modelo y la sesión de entrada.", level = 'ERROR')
         elif self.input_type == 0:
             #Single image
             if self.inputExists and self.modelsPathExists and self.model!=None:
@@ -759,126 +1126,203 @@ class Window:
     def temp_extract(self):
         """
         Extract temperatures from a segmented image or a whole session
+        Returns the job extracting them, segmenting first if needed, or None
         """
-        self.ui.progressBar.setVisible(True)
-        self.ui.progressBar.setValue(0)
         self.message_print("Obteniendo temperaturas...")
-        if (self.inputExists and (self.isSegmented or self.sessionIsSegmented)):
-            self.message_print("Obteniendo temperaturas de la sesión...")
-            self.ui.progressBar.setFormat("Extrayendo temperaturas... %p%")
-
-            if self.ui.autoScaleCheckBoxImport.isChecked and self.input_type>=1:
-                #Get automatic scales
-                self.scale_range = self.extract_multiple_scales(self.s2s.img_array)
-                
-            elif not self.ui.autoScaleCheckBoxImport.isChecked():
-                self.scale_range = [self.ui.minSpinBoxImport.value() , self.ui.maxSpinBoxImport.value()] 
-
-            if self.input_type>=1:   #If segmentation was for full session
-                self.meanTemperatures = []   #Whole feet mean temperature for all images in session
-                segmented_temps = []
-                original_temps = []
-                dermatomes_temps = []
-                dermatomes_masks = []
-                if self.ui.autoScaleCheckBoxImport.isChecked():
-                    for i in range(len(self.outfiles)):
-                        mean_out, temp, original_temp = mean_temperature(self.s2s.Xarray[i,:,:,0] , self.Y[i][:,:,0] , self.scale_range[i], plot = False)
-                        derm_temps, derm_mask = dermatomes_temperatures(original_temp, self.Y[i])
-                        self.meanTemperatures.append(mean_out)
-                        segmented_temps.append(temp)
-                        original_temps.append(original_temp)
-                        dermatomes_temps.append(derm_temps)
-                        dermatomes_masks.append(derm_mask)
-                        self.ui.progressBar.setValue((100*i+1)/len(self.outfiles))
-                    self.dermatomes_temps = np.array(dermatomes_temps)
-                    self.dermatomes_masks = np.array(dermatomes_masks)
-                    self.segmented_temps = np.array(segmented_temps)
-                    self.original_temps = np.array(original_temps)
-
-                else:
-                    for i in range(len(self.outfiles)):
-                        mean_out, temp, original_temp = mean_temperature(self.s2s.Xarray[i,:,:,0] , self.Y[i][:,:,0] , self.scale_range, plot = False)
-                        derm_temps, derm_mask = dermatomes_temperatures(original_temp, self.Y[i])
-                        self.meanTemperatures.append(mean_out)
-                        segmented_temps.append(temp)
-                        original_temps.append(original_temp)
-                        dermatomes_temps.append(derm_temps)
-                        dermatomes_masks.append(derm_mask)
-                        self.ui.progressBar.setValue((100*i+1)/len(self.outfiles))
-                    self.dermatomes_temps = np.array(dermatomes_temps)
-                    self.dermatomes_masks = np.array(dermatomes_masks)
-                    self.segmented_temps = np.array(segmented_temps)
-                    self.original_temps = np.array(original_temps)
-
-
-                self.message_print("La temperatura media es: " + str(self.meanTemperatures[self.imageIndex]))
-                self.message_print(f"La escala leida es: {self.scale_range[self.imageIndex]}")
-                rounded_temp = np.round(self.meanTemperatures[self.imageIndex], 3)
-                self.ui.temperatureLabelImport.setText(f'{rounded_temp} °C')
-                self.ui.minSpinBoxImport.setValue(self.scale_range[self.imageIndex][0])
-                self.ui.maxSpinBoxImport.setValue(self.scale_range[self.imageIndex][1])
-                self.temperaturesWereAcquired = True
-            else:      #If segmentation was for single image
-                if self.ui.autoScaleCheckBoxImport.isChecked():
-                    self.scale_range = self.extract_scales_with_pytesseract(self.i2s.img)
-                else:
-                    self.scale_range = [self.ui.minSpinBoxImport.value() , self.ui.maxSpinBoxImport.value()]
-                time.sleep(1.5)
-                mean, _ = mean_temperature(self.i2s.Xarray[:,:,0] , self.Y[:,:,0] , self.scale_range, plot = False)
-                self.message_print("La temperatura media es: " + str(mean))
-                rounded_temp = np.round(mean, 3)
-                self.ui.temperatureLabelImport.setText(f'{rounded_temp} °C')
-
-            if (self.ui.plotCheckBoxImport.isChecked() and self.input_type>=1):  #If user asked for plot
-                #self.message_print("Se generara plot de temperatura...")
-                self.get_times()
-                # self.temp_plot()
-
+        if self.sessionIsCreated and getattr(self, 'input_type', None) == 2:
+            #Live session, every capture was already processed when it arrived
+            if not self.use_live_results():
+                self.message_print("No se ha hecho ninguna captura.")
         elif self.inputExists:
-            #If input exists but session has not been segmented
-            self.message_print("No se ha segmentado previamente la sesión. Segmentando... ")
-            time.sleep(1)
-            self.session_segment()
-            self.temp_extract()
+            session = self.input_type >= 1
+            segmentation = None
+            if not (self.sessionIsSegmented if session else self.isSegmented):
+                #Temperatures wait for the segmentation job instead of blocking here
+                self.message_print(f"No se ha segmentado previamente la {'sesión' if session else 'imagen'}. Segmentando... ")
+                segmentation = self.session_segment() if session else self.feet_segment()
+            if session:
+                self.message_print("Obteniendo temperaturas de la sesión...")
+                return self.jobs.submit('temperaturas', self.run_session_temperatures, queue = 'session',
+                                        after = [segmentation], prepare = self.prepare_session_temperatures,
+                                        on_done = self.on_session_temperatures,
+                                        progress_format = "Extrayendo temperaturas... %p%")
+            return self.jobs.submit('temperaturas', self.run_image_temperature, queue = 'session',
+                                    after = [segmentation], prepare = self.prepare_image_temperature,
+                                    on_done = self.on_image_temperature,
+                                    progress_format = "Extrayendo temperaturas...")
         elif self.ui.tabWidget.currentIndex() == 0:
             #Live video tab
-            self.message_print("Obteniendo temperaturas para la última captura...")
-            time.sleep(1)
-            if not self.sessionIsCreated:
-                self.message_print("No se ha creado una sesión de entrada. Presione capturar para crear una sesión por defecto o cree una con los parámetros deseados")
-                return
-            if len(os.listdir(self.session_dir)) < 1:
-                self.message_print("No se ha hecho ninguna captura.")
-                return
-            #HERE COMES TO LOGIC FOR OBTAINING FULL PLOT FOR LIVE VIDEO
+            self.message_print("No se ha creado una sesión de entrada. Presione capturar para crear una sesión por defecto o cree una con los parámetros deseados")
 
         else:
             self.message_print("No se han seleccionado imagenes de entrada")
+        return None
+
+    def prepare_session_temperatures(self):
+        if not self.sessionIsSegmented:
+            return None
+        self.configure_pipeline()
+        return {}
+
+    def run_session_temperatures(self, job):
+        #Only the stages whose inputs changed are computed again
+        self.begin_run()
+        self.pipeline.progressBar = job
+        temperatures = self.pipeline.get('temperatures')
+        dermatomes = self.pipeline.get('dermatomes')
+        scale_range = self.pipeline.get('scales')['scale_range'].tolist()
+        return temperatures, dermatomes, scale_range
+
+    def on_session_temperatures(self, result):
+        temperatures, dermatomes, self.scale_range = result
+        self.meanTemperatures = unpack_mean_temperatures(temperatures['mean_temps'])   #Whole feet mean temperature for all images in session
+        self.segmented_temps = np.array(temperatures['segmented_temps'])
+        self.original_temps = np.array(temperatures['original_temps'])
+        self.dermatomes_temps = np.array(dermatomes['dermatomes_temps'])
+        self.dermatomes_masks = np.array(dermatomes['dermatomes_masks'])
+        self.end_run('temperaturas')
+
+        self.message_print("La temperatura media es: " + str(self.meanTemperatures[self.imageIndex]))
+        self.message_print(f"La escala leida es: {self.scale_range[self.imageIndex]}")
+        rounded_temp = np.round(self.meanTemperatures[self.imageIndex], 3)
+        self.ui.temperatureLabelImport.setText(f'{rounded_temp} °C')
+        self.ui.minSpinBoxImport.setValue(self.scale_range[self.imageIndex][0])
+        self.ui.maxSpinBoxImport.setValue(self.scale_range[self.imageIndex][1])
+        self.temperaturesWereAcquired = True
+
+        if self.ui.plotCheckBoxImport.isChecked():  #If user asked for plot
+            self.get_times()
+
+    def prepare_image_temperature(self):
+        if not self.isSegmented:
+            return None
+        manual_scale = None
+        if not self.ui.autoScaleCheckBoxImport.isChecked():
+            manual_scale = [self.ui.minSpinBoxImport.value() , self.ui.maxSpinBoxImport.value()]
+        return {'manual_scale': manual_scale}
+
+    def run_image_temperature(self, job, manual_scale):
+        scale_range = manual_scale if manual_scale is not None else self.extract_scales(self.i2s.img)
+        mean = mean_temperature(self.i2s.Xarray[:,:,0] , self.Y[:,:,0] , scale_range, plot = False)[0]
+        return scale_range, mean
+
+    def on_image_temperature(self, result):
+        self.scale_range, mean = result
+        self.message_print("La temperatura media es: " + str(mean))
+        rounded_temp = np.round(mean, 3)
+        self.ui.temperatureLabelImport.setText(f'{rounded_temp} °C')
 
-        self.ui.progressBar.setVisible(False)
-        self.ui.progressBar.setFormat("%p%")
     def toggle_model(self):
         """
         Change model loaded if user changes the model modelComboBox
+        Loading happens in background, on_model_loaded finishes the change
         """
         self.modelIndex = self.ui.modelComboBox.currentIndex()
         self.message_print("Cargando modelo: " + self.models[self.modelIndex]
                         +" Esto puede tomar unos momentos...")
-        try:
-            self.model = self.modelList[self.modelIndex]
-            self.s2s.setModel(self.model)
-            self.i2s.setModel(self.model)
-            self.s2s.loadModel()
-            self.i2s.loadModel()
-            self.ui.loadedModelLabel.setText(self.model)
-            self.message_print("Modelo " + self.models[self.modelIndex] + " cargado exitosamente")
-        except:
-            self.message_print("Error al cargar el modelo "+ self.models[self.modelIndex])
+        self.pending_model = self.model_for_precision(self.modelList[self.modelIndex])
+        self.model_loader.load(self.pending_model)
+
+    def prefetch_model(self, index):
+        """
+        Starts loading the model selected in modelComboBox before the user confirms it
+        """
+        if 0 <= index < len(self.modelList):
+            self.model_loader.load(self.model_for_precision(self.modelList[index], warn = False))
+
+    def on_model_loaded(self, path):
+        if path != getattr(self, 'pending_model', None):
+            return      #Prefetched model, not selected yet
+        if not self.startupReported:
+            self.report_startup()
+        self.pending_model = None
+        self.model = path
+        self.s2s.setModel(self.model)
+        self.i2s.setModel(self.model)
+        self.s2s.loadModel()
+        self.i2s.loadModel()
+        self.live_worker.set_model(self.model)
+        precision = registry.precision(self.model)
+        self.ui.loadedModelLabel.setText(f"{os.path.basename(self.model)} ({precision})")
+        self.message_print("Modelo " + os.path.basename(path) + f" ({precision}) cargado exitosamente")
+        if self.tuning_store.lookup(self.model) is None:
+            #First run of this model on this device. It is tuned when no session job is
+            #running, so it neither delays them nor is timed while they use the cores
+            if self.jobs.busy('session'):
+                self.pending_tuning = self.model
+            else:
+                self.tune_model()
+
+    def tune_model(self, path = None):
+        """
+        Benchmarks thread counts and delegates for a model (the current one by default) in
+        background and applies the fastest, which is kept in config.json for this device.
+        Tuning has its own queue, opening a new input does not cancel it
+        """
+        path = path or self.model
+        self.pending_tuning = None
+        self.message_print(f"Ajustando el intérprete de {os.path.basename(path)} para este equipo...")
+        return self.jobs.submit(f'ajuste:{path}', self.run_tuning, queue = 'tuning', on_done = self.on_model_tuned,
+                                progress_format = "Ajustando intérprete... %p%", path = path)
+
+    def run_tuning(self, job, path):
+        progress = lambda done, total: job.setValue(100*done/total)
+        return path, tune(path, self.tuning_store, log = print, progress = progress)
+
+    def on_model_tuned(self, result):
+        path, tuned = result
+        registry.set_settings(path, tuned)
+        self.message_print(f"Intérprete ajustado: {tuned['delegate']} con {tuned['num_threads']} hilos, "
+                           f"{tuned['ms']:.1f} ms por imagen")
+
+    def benchmark_models(self):
+        """
+        Compares every model of the models folder on a reference set with ground truth
+        masks (a folder chosen by the user, or the example image), in background
+        """
+        models = compare_models.find_models(self.modelsPath) if getattr(self, 'modelsPath', None) else []
+        if not models:
+            self.message_print("No se han cargado modelos. Seleccione la carpeta de modelos en Cargar modelos", level = 'ERROR')
+            return None
+        dataset = QFileDialog.getExistingDirectory(self.ui, "Imágenes de referencia (máscaras en masks/<nombre>.png)")
+        pairs = compare_models.find_pairs(dataset) if dataset else compare_models.parse_pairs(compare_models.DEFAULT_PAIRS)
+        if not pairs:
+            self.message_print(f"No se encontraron imágenes con máscara en {dataset}", level = 'ERROR')
+            return None
+        self.message_print(f"Comparando {len(models)} modelos en {len(pairs)} imágenes...")
+        return self.jobs.submit('comparacion', self.run_model_comparison, queue = 'session', on_done = self.on_models_compared,
+                                progress_format = "Comparando modelos... %p%", models = models, pairs = pairs,
+                                cmap = self.input_cmap, min_size = self.ui.morphoSpinBox.value())
+
+    def run_model_comparison(self, job, models, pairs, cmap, min_size):
+        progress = lambda done, total: job.setValue(100*done/total)
+        results = compare_models.compare(models, pairs, cmap, min_size, progress = progress)
+        compare_models.save_results('outputs/model_comparison.json', results, pairs, cmap = cmap, min_size = min_size)
+        return results
+
+    def on_models_compared(self, results):
+        for line in compare_models.format_table(results):
+            self.message_print(line)
+        valid = [r for r in results if 'error' not in r]
+        if valid:
+            best = max(valid, key = lambda r: r['dice'])
+            fastest = min(valid, key = lambda r: r['p95_ms'])
+            self.message_print(f"Mejor Dice: {os.path.basename(best['model'])}, más rápido: {os.path.basename(fastest['model'])}. "
+                               "Resultados en outputs/model_comparison.json")
+
+    def on_model_failed(self, path):
+        if path != getattr(self, 'pending_model', None):
+            return
+        if not self.startupReported:
+            self.report_startup()
+        self.pending_model = None
+        self.message_print("Error al cargar el modelo "+ os.path.basename(path), level = 'ERROR')
 
     def temp_plot(self):
         """
         Plots from acquired temperature samples from a session
         """
+        from scipy.interpolate import make_interp_spline
         plt.figure()
         x = np.linspace(min(self.timeList), max(self.timeList), 200)
         spl = make_interp_spline(self.timeList, self.meanTemperatures, k=3)
@@ -895,20 +1339,50 @@ class Window:
 
 
     def generate_full_session_plot(self):
+        """
+        Queues the session report, after the temperatures extraction if they are missing
+        on_report_rendered reports the result
+        """
+        temperatures = None
         if not self.temperaturesWereAcquired :
             self.message_print("No se han extraido las temperaturas, extrayendo...")
-            self.temp_extract()
-            self.generate_full_session_plot()
+            temperatures = self.temp_extract()
+            if temperatures is None and not self.temperaturesWereAcquired:
+                return None
+        return self.jobs.submit('reporte', self.run_report, queue = 'session', after = [temperatures],
+                                prepare = self.prepare_report, on_done = self.on_report_rendered,
+                                on_error = self.on_report_failed, progress_format = "Generando reporte...")
+
+    def prepare_report(self):
+        if not self.temperaturesWereAcquired:
+            return None
+        self.message_print("Generando reporte de la sesión...")
+        #Generación de información extra para la sesión
+        self.populate_session_info()
+        self.export_report()
+        self.report_path = os.path.join(self.defaultDirectory,'report')
+        return dict(path = self.report_path, img_temps = self.original_temps, segmented_temps = self.segmented_temps,
+                    mean_temps = list(self.meanTemperatures), times = list(self.timeList),
+                    dermatomes_temps = self.dermatomes_temps, dermatomes_masks = self.dermatomes_masks)
+
+    def run_report(self, job, path, **report):
+        from report import render_report     #Imports matplotlib, only when a report is made
+        self.begin_run()
+        return path, render_report(path = path, **report)
+
+    def on_report_rendered(self, result):
+        path, exit_value = result
+        self.end_run('reporte')
+        if exit_value == 0:
+            self.message_print("Se ha generado exitosamente el plot completo de sesión")
         else:
-            exit_value = plot_report(img_temps = self.original_temps, segmented_temps = self.segmented_temps, mean_temps = self.meanTemperatures, times = self.timeList, 
-                        path = os.path.join(self.defaultDirectory,'report'), dermatomes_temps = self.dermatomes_temps, dermatomes_masks = self.dermatomes_masks)
-            if exit_value == 0:
-                #Generación de información extra para la sesión
-                self.message_print("Se ha generado exitosamente el plot completo de sesión")
-            else:
-                self.message_print("Advertencia, se ha encontrado un valor no válido (nan) en los dígitos de escala de temperatura. Verifique que la imagen es del formato y referencia de cámara correctos")
-            self.populate_session_info()
-            self.export_report()
+            self.message_print("Advertencia, se ha encontrado un valor no válido (nan) en los dígitos de escala de temperatura. Verifique que la imagen es del formato y referencia de cámara correctos")
+        if self.ui.plotCheckBoxImport.isChecked():
+            QDesktopServices.openUrl(QUrl.fromLocalFile(path + '.pdf'))
+
+    def on_report_failed(self, error):
+        self.message_print("Error al generar el reporte " + self.report_path + ".pdf", level = 'ERROR')
+        print(error)
         
 
     def open_image(self):
@@ -996,25 +1470,30 @@ class Window:
 
     def update_software(self):
         """
-        Updates software from remote origin repository
+        Updates software from remote origin repository, in background
         """
-        try:
-            self.message_print(f"Actualizando software desde {self.repoUrl}...")
-            time.sleep(2)
-            exit_value = os.system("git pull")
-            if exit_value == 0:
-                self.message_print("Se ha actualizado exitosamente la interfaz. Se sugiere reiniciar interfaz")
-                return
-            self.message_print("Error al actualizar.")
-            raise RemotePullException(self.repoUrl)
-        except:
-            self.message_print("Error al actualizar.")
+        self.message_print(f"Actualizando software desde {self.repoUrl}...")
+        return self.jobs.submit('actualizacion', self.run_update, queue = 'update', on_done = self.on_updated,
+                                on_error = self.on_update_failed, progress_format = "Actualizando...")
+
+    def run_update(self, job):
+        exit_value = run_command(job, ['git', 'pull'])
+        if exit_value != 0:
             raise RemotePullException(self.repoUrl)
+        return exit_value
+
+    def on_updated(self, exit_value):
+        self.message_print("Se ha actualizado exitosamente la interfaz. Se sugiere reiniciar interfaz")
+
+    def on_update_failed(self, error):
+        self.message_print("Error al actualizar.", level = 'ERROR')
+        print(error)
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = Window()
     window.ui.show()
+    QTimer.singleShot(0, window.finish_startup)    #Right after the first paint
     #window.ui.show()
     sys.exit(app.exec_())
@@ -0,0 +1,21 @@
+#Segmentation quality metrics shared by the model comparison tools
+
+import numpy as np
+
+
+def masks_from(Y, threshold = 0.5):
+    """
+    Binary masks as computed by the session pipeline (predictions normalized to their maximum)
+    """
+    Y = Y / np.maximum(Y.max(axis = tuple(range(1, Y.ndim)), keepdims = True), 1e-12)
+    return Y >= threshold
+
+
+def dice(a, b):
+    total = a.sum() + b.sum()
+    return 1.0 if total == 0 else float(2*np.logical_and(a, b).sum()/total)
+
+
+def iou(a, b):
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum()/union)
@@ -0,0 +1,233 @@
+#Memoized session pipeline
+#Each stage result is stored as .npy files under the session folder, keyed by a hash of
+#its parameters and of the keys of the stages it depends on. A stage only runs again when
+#something upstream changed
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from segment import read_frame
+from postprocessing import PostProcessing
+from temperatures import mean_temperature, session_dermatomes_temperatures, pack_mean_temperatures, WARM_START_CHAIN
+import scales
+
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    """
+    SHA-1 of a file contents, cached per (path, modification time, size)
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _hashes_lock:
+        if key in _hashes:
+            return _hashes[key]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+    with _hashes_lock:
+        _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+
+class Sources(tuple):
+    """
+    Input files of a stage. They are hashed by content, not by name
+    """
+    def digest(self):
+        return [file_hash(path) for path in self]
+
+
+def canonical(value):
+    if isinstance(value, Sources):
+        return value.digest()
+    if isinstance(value, dict):
+        return {k: canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class ArtifactCache():
+    """
+    Stage outputs on disk: <root>/<stage>/<key>/<name>.npy, loaded as read-only memmaps.
+    Keeps the last max_versions results of each stage
+    """
+    def __init__(self, root, max_versions = 2):
+        self.root = root
+        self.max_versions = max_versions
+
+    def path(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def load(self, stage, key):
+        path = self.path(stage, key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            outputs = {name[:-4]: np.load(os.path.join(path, name), mmap_mode = 'r')
+                       for name in os.listdir(path) if name.endswith('.npy')}
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return outputs
+
+    def save(self, stage, key, outputs):
+        path = self.path(stage, key)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        os.makedirs(tmp_path)
+        for name, value in outputs.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), np.asarray(value))
+        shutil.rmtree(path, ignore_errors = True)
+        os.replace(tmp_path, path)
+        self.evict(stage)
+
+    def evict(self, stage):
+        stage_dir = os.path.join(self.root, stage)
+        versions = [os.path.join(stage_dir, d) for d in os.listdir(stage_dir) if not d.endswith('.tmp')]
+        versions.sort(key = os.path.getmtime, reverse = True)
+        for path in versions[self.max_versions:]:
+            shutil.rmtree(path, ignore_errors = True)
+
+
+class Pipeline():
+    """
+    DAG of named stages. A stage is function(*dependency_outputs, **params) returning
+    a dict of arrays. get(name) returns the memoized outputs, computing only the stages
+    whose key changed
+    """
+    def __init__(self, cache_dir = None, max_versions = 2):
+        self.stages = {}    #name -> (function, depends)
+        self.params = {}    #name -> params
+        self.memory = {}    #name -> (key, outputs)
+        self.cache = ArtifactCache(cache_dir, max_versions) if cache_dir else None
+        self.computed = []  #Stages computed by the last get, for logging
+
+    def add(self, name, function, depends = (), **params):
+        self.stages[name] = (function, tuple(depends))
+        self.params[name] = params
+
+    def set_params(self, name, **params):
+        self.params[name].update(params)
+
+    def key(self, name):
+        function, depends = self.stages[name]
+        description = {'stage': name,
+                       'params': canonical(self.params[name]),
+                       'depends': [self.key(d) for d in depends]}
+        return hashlib.sha1(json.dumps(description, sort_keys = True).encode()).hexdigest()[:16]
+
+    def get(self, name, _top = True):
+        if _top:
+            self.computed = []
+        function, depends = self.stages[name]
+        key = self.key(name)
+        if name in self.memory and self.memory[name][0] == key:
+            return self.memory[name][1]
+        outputs = self.cache.load(name, key) if self.cache else None
+        if outputs is None:
+            inputs = [self.get(d, _top = False) for d in depends]
+            outputs = function(*inputs, **self.params[name])
+            if self.cache:
+                self.cache.save(name, key, outputs)
+            self.computed.append(name)
+        self.memory[name] = (key, outputs)
+        return outputs
+
+
+class SessionPipeline(Pipeline):
+    """
+    inference -> masks -> temperatures -> dermatomes, with scales feeding temperatures.
+    Changing the model recomputes from inference, the post processing size from masks
+    and the scale settings from scales. Artifacts live in <session>/.cache
+    """
+    def __init__(self, session_dir, s2s, log = None, recognizer = None, ocr_cache = None, workers = None):
+        super(SessionPipeline, self).__init__(os.path.join(session_dir, '.cache'))
+        self.session_dir = session_dir
+        self.s2s = s2s
+        self.log = log
+        self.recognizer = recognizer
+        self.ocr_cache = ocr_cache
+        self.workers = workers
+        self.progressBar = None   #Optional widget with setValue(percent)
+        self.add('inference', self.inference, files = Sources(), model = Sources(), cmap = 'Gris')
+        self.add('masks', self.masks, ['inference'], min_size = 2500, threshold = 0.5)
+        self.add('scales', self.scales, files = Sources(), cmap = 'Gris', manual = None,
+                 digits_model = Sources())
+        self.add('temperatures', self.temperatures, ['inference', 'masks', 'scales'])
+        self.add('dermatomes', self.dermatomes, ['temperatures', 'masks'], warm_start = True,
+                 chain_length = WARM_START_CHAIN)
+
+    def configure(self, files, model, cmap, min_size, manual_scale = None, digits_model = None):
+        """
+        Sets the inputs of the session. manual_scale is [min, max] or None to read the scales
+        """
+        self.set_params('inference', files = Sources(files), model = Sources([model]), cmap = cmap)
+        self.set_params('masks', min_size = min_size)
+        self.set_params('scales', files = Sources(files), cmap = cmap,
+                        manual = None if manual_scale is None else list(map(float, manual_scale)),
+                        digits_model = Sources([digits_model] if digits_model else []))
+
+    def inference(self, files, model, cmap):
+        self.s2s.setModel(model[0])
+        self.s2s.whole_extract(list(files), cmap = cmap, progressBar = self.progressBar)
+        return {'Xarray': self.s2s.Xarray, 'Y_pred': self.s2s.Y_pred}
+
+    def masks(self, inference, min_size, threshold):
+        Y_pred = np.asarray(inference['Y_pred'])
+        Y = Y_pred / Y_pred.max(axis=(1,2,3), keepdims=True)
+        Y = np.where( Y >= threshold  , 1 , 0)
+        return {'masks': PostProcessing(min_size).execute_batch(Y)}
+
+    def scales(self, files, cmap, manual, digits_model, chunk = 32):
+        if manual is not None:
+            return {'scale_range': np.array([manual]*len(files), dtype = float)}
+        scale_range = []
+        images = self.s2s.img_array
+        if images is not None and len(images) == len(files):
+            scale_range = scales.extract_multiple_scales(images, log = self.log, recognizer = self.recognizer,
+                                                         cache = self.ocr_cache)
+        else:
+            #Frames are not kept by the segmentation (nor read when it came from the cache),
+            #decode them again in chunks
+            for start in range(0, len(files), chunk):
+                images = np.array([read_frame(f, cmap) for f in files[start:start+chunk]])
+                scale_range.extend(scales.extract_multiple_scales(images, log = self.log, recognizer = self.recognizer,
+                                                                  cache = self.ocr_cache))
+        if self.ocr_cache is not None:
+            self.ocr_cache.save()     #Once per session
+        return {'scale_range': np.array(scale_range, dtype = float)}
+
+    def temperatures(self, inference, masks, scales):
+        Xarray, masks, scale_range = inference['Xarray'], masks['masks'], scales['scale_range']
+        mean_temps, segmented_temps, original_temps = [], [], []
+        for i in range(len(masks)):
+            mean_out, temp, original_temp = mean_temperature(Xarray[i,:,:,0] , masks[i][:,:,0] , scale_range[i], plot = False)
+            mean_temps.append(mean_out)
+            segmented_temps.append(temp)
+            original_temps.append(original_temp)
+        return {'mean_temps': pack_mean_temperatures(mean_temps),
+                'segmented_temps': np.array(segmented_temps),
+                'original_temps': np.array(original_temps)}
+
+    def dermatomes(self, temperatures, masks, warm_start, chain_length):
+        #workers only changes the speed: warm start chains have fixed boundaries
+        dermatomes_temps, dermatomes_masks = session_dermatomes_temperatures(
+                    np.asarray(temperatures['original_temps']), np.asarray(masks['masks']),
+                    workers = self.workers, warm_start = warm_start, chain_length = chain_length,
+                    progress = self.report_progress)
+        return {'dermatomes_temps': dermatomes_temps, 'dermatomes_masks': dermatomes_masks}
+
+    def report_progress(self, done, total):
+        if self.progressBar is not None:
+            self.progressBar.setValue(100*done/total)
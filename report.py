@@ -1,8 +1,15 @@
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
 import matplotlib.colors as colors
 import matplotlib.cm as cmx
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.widgets import CheckButtons
+from instrument import traced
+from startup import lazy_import
+
+plt = lazy_import('matplotlib.pyplot')    #Only the interactive report needs pyplot
 
 
 dic_dermatomes = {0:'Backgroud', 10:'Medial Plantar Pie Derecho', 11:'Medial Plantar Pie Izquierdo', 20:'Lateral Plantar Pie Derecho', 21:'Lateral Plantar Pie Izquierdo',
@@ -14,95 +21,154 @@ derm_id = list(dic_dermatomes.keys())
 derm_id.sort()
 derm_names = [dic_dermatomes[key] for key in derm_id[1:-1]]
 
-
-def plot_report(img_temps, segmented_temps, mean_temps, dermatomes_temps, dermatomes_masks, times, path = './outputs/report'):
+colors_ = ['lightcoral', 'firebrick', 'darkcyan', 'mediumaquamarine', 'violet', 'lightsteelblue', 'indianred', 'peru', 'slategray', 'darkolivegreen', 'rosybrown', 'seagreen']
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(cmap, size=256):
+    """
+    (size,3) uint8 RGB lookup table of a matplotlib colormap
+    """
+    return (matplotlib.colormaps[cmap].resampled(size)(np.arange(size))[:, :3]*255).round().astype('uint8')
+
+
+def colorize(values, vmin, vmax, cmap='gnuplot', size=256):
+    """
+    Maps values to RGB with a colormap LUT, clipping to [vmin, vmax] like imshow does.
+    Works on whole (N,H,W) stacks at once
+    """
+    lut = colormap_lut(cmap, size)
+    scale = size/(vmax - vmin) if vmax > vmin else 0
+    index = np.clip((np.asarray(values, dtype='float32') - vmin)*scale, 0, size - 1)
+    return lut[index.astype('intp')]
+
+
+def report_images(img_temps, dermatomes_masks, vmin, vmax, cmap='gnuplot', edge_color=(255, 255, 255)):
+    """
+    RGB images of the report rows: the temperatures and the temperatures inside the
+    dermatomes, with the dermatome borders drawn as pixels of edge_color
+    """
+    dermatomes_masks = np.asarray(dermatomes_masks)
+    images = colorize(img_temps, vmin, vmax, cmap)
+    dermatomes_images = colorize(img_temps*(dermatomes_masks != 0), vmin, vmax, cmap)
+    dermatomes_images[dermatomes_masks == 255] = edge_color
+    return images, dermatomes_images
+
+
+def mosaic(rows, gap=8, fill=255):
+    """
+    Tiles a list of (N,H,W,3) stacks into one RGB image: one row per stack, one column
+    per frame, separated by gap pixels of fill
+    """
+    num_rows = len(rows)
+    n, h, w = rows[0].shape[:3]
+    image = np.full((num_rows*h + (num_rows-1)*gap, n*w + (n-1)*gap, 3), fill, dtype='uint8')
+    for i, row in enumerate(rows):
+        for j in range(n):
+            image[i*(h+gap):i*(h+gap)+h, j*(w+gap):j*(w+gap)+w] = row[j]
+    return image
+
+
+def pair_mean_temps(mean_temps):
+    """
+    Mean temperatures as a (N,2) array of [right, left] pairs. Single means are repeated
+    Returns the array and exit code 1 if a nan was found (replaced by 0)
+    """
     exit_code = 0
-    num_rows = 3
-    num_cols = img_temps.shape[0]
-    fig_title = 'Report'
-    figsize = 15,8,
+    pairs = []
+    for couple in mean_temps:
+        if np.ndim(couple) == 0:
+            if not np.isnan(couple):
+                couple = [couple, couple]
+            else:
+                couple = [0, 0]
+                print("Warning, nan was fount in temp values")
+                exit_code = 1
+        pairs.append(list(couple))
+    return np.array(pairs, dtype=float), exit_code
 
-    #Definiton of grid layout
-    fig = plt.figure(figsize=figsize)
-    fig.set_size_inches(figsize[0], figsize[1])
-    fig.suptitle(fig_title, fontsize=24, fontweight='bold')
 
-    axs = []
-    for i in range(num_rows-1):
-        axs_row = []
-        for j in range(num_cols):
-            axs_row.append(plt.subplot2grid((num_rows,num_cols), (i,j), fig=fig))
-        axs.append(axs_row)
-        axs_temp = plt.subplot2grid((num_rows,num_cols), (num_rows-1,0), colspan=num_cols-1, fig=fig)
+def draw_report(fig, img_temps, segmented_temps, mean_temps, dermatomes_temps, dermatomes_masks, times):
+    """
+    Draws the report on a figure. Images are rasterized with colormap LUTs, only text,
+    axes and curves are vector graphics
+    Returns the exit code, the temperature curves and the (images, curves) axes
+    """
+    num_rows = 3
+    num_cols = img_temps.shape[0]
+    fig.suptitle('Report', fontsize=24, fontweight='bold')
+    grid = fig.add_gridspec(num_rows, num_cols)
+    axs_img = fig.add_subplot(grid[:num_rows-1, :])
+    axs_temp = fig.add_subplot(grid[num_rows-1, :max(num_cols-1, 1)])
 
-    #Plot original input image, segmented image and mean temperatures
     cmap = 'gnuplot'
-    norm  = colors.Normalize(vmin=np.min(segmented_temps[segmented_temps != 0]), vmax=np.max(segmented_temps))
-
-
-
-    #Plot original input image, segmented image
-    for i in range(num_rows-1):
-        for j in range(num_cols):
-            if i == 0:
-                ##FALTA MOSTRAR IMAGEN ORIGINAL
-                #FALTA LOS YLABELS DE LAS CFILAS 1 Y 2
-                axs[i][j].imshow(img_temps[j,:,:], cmap=cmap, norm=norm)
-                axs[i][j].axis('off')
-                
-            elif i == 1:
-                axs[i][j].imshow(img_temps[j,:,:]*(dermatomes_masks[j] != 0), cmap=cmap, norm=norm)
-                edges = np.argwhere(dermatomes_masks[j] == 255) #Agregar Line1
-                axs[i][j].plot(edges[:,1], edges[:,0], '.w', markersize=1) #Agregar Line2
-                # axs[i][j].imshow(segmented_temps[j,:,:], cmap=cmap, norm=norm)
-                axs[i][j].axis('off')
-            else:
-                raise ValueError('Error')
-
-    # ind_t = [0,1,5,10,15]
+    vmin, vmax = np.min(segmented_temps[segmented_temps != 0]), np.max(segmented_temps)
+    norm = colors.Normalize(vmin=vmin, vmax=vmax)
+
+    #Original input images and segmented images with the dermatomes borders, composited
+    #as a single raster image
+    images, dermatomes_images = report_images(img_temps, dermatomes_masks, vmin, vmax, cmap)
+    gap = 8
+    axs_img.imshow(mosaic([images, dermatomes_images], gap), interpolation='nearest')
+    axs_img.axis('off')
+    width = images.shape[2]
     for j in range(num_cols):
-        axs[0][j].set_title("$t"+"_{"+str(times[j])+"}$", family='serif', size=15, weight=900)
+        axs_img.text(j*(width+gap) + width/2, -gap, "$t"+"_{"+str(times[j])+"}$", ha='center', va='bottom',
+                     family='serif', size=15, weight=900, clip_on=False)
 
     #Plot mean temperatures
-    #print(f"mean temps: {mean_temps}")
-
-    for i,couple in enumerate(mean_temps):
-        if type(couple) is not list:
-            if not np.isnan(couple):
-                mean_temps[i] = [couple, couple]
-            else:
-                mean_temps[i] = [0, 0]
-                print("Warning, nan was fount in temp values")
-                exit_code = 1
-
-    mean_temps = np.array(mean_temps)
-    
+    mean_temps, exit_code = pair_mean_temps(mean_temps)
     left_temps = mean_temps[:,0]
     right_temps = mean_temps[:,1]
 
-
-    colors_ = ['lightcoral', 'firebrick', 'darkcyan', 'mediumaquamarine', 'violet', 'lightsteelblue', 'indianred', 'peru', 'slategray', 'darkolivegreen', 'rosybrown', 'seagreen']
     lines = []
     for i in range(0,len(derm_names)):
         l, = axs_temp.plot(times, dermatomes_temps[:,i], label=derm_names[i], color = colors_[i])
-        # plt.legend(loc='upper right')
         lines.append(l)
 
-
     l1, = axs_temp.plot(times , left_temps , '-o',label = 'Pie Derecho', color = colors_[-2])
     l2, = axs_temp.plot(times , right_temps , '-o', label = 'Pie Izquierdo', color = colors_[-1])
     lines.append(l1)
     lines.append(l2)
-    # axs_temp.set_ylim([np.min(segmented_temps[segmented_temps != 0]), np.max(segmented_temps)])
-    # axs_temp.set_yticks(np.linspace(np.min(segmented_temps[segmented_temps != 0]), np.max(segmented_temps),5))
     axs_temp.set_title("Temperatura media de pies")
     axs_temp.set_xlabel("Tiempo (min)")
     axs_temp.set_ylabel("Temperatura (°C)")
     axs_temp.grid(visible= True)
-    # axs_temp.legend()
-    # fig.tight_layout()
     fig.tight_layout(rect=[0, 0, 0.9, 1])
 
+    #Plot clorbar
+    position = axs_img.get_position()
+    cax = fig.add_axes([position.x1 + 0.05, position.y0, 0.02, position.height])
+    sm = cmx.ScalarMappable(norm=norm, cmap=cmap)
+    sm.set_array(segmented_temps)
+    cbar = fig.colorbar(sm, cax=cax, ticks=np.linspace(vmin, vmax, 5))
+    for t in cbar.ax.get_yticklabels():
+        t.set_fontsize(10)
+    return exit_code, lines, (axs_img, axs_temp)
+
+
+@traced()
+def render_report(img_temps, segmented_temps, mean_temps, dermatomes_temps, dermatomes_masks, times, path = './outputs/report', formats = ('pdf',)):
+    """
+    Renders the report to path.<format> files without pyplot, so it can run outside
+    the GUI thread. The curves toggles of plot_report are replaced by a legend
+    """
+    fig = Figure(figsize=(15, 8))
+    FigureCanvasAgg(fig)
+    exit_code, lines, (_, axs_temp) = draw_report(fig, img_temps, segmented_temps, mean_temps, dermatomes_temps, dermatomes_masks, times)
+    axs_temp.legend(handles=lines, loc='center left', bbox_to_anchor=(1.01, 0.5), fontsize=8, frameon=False)
+    for format in formats:
+        fig.savefig(path+'.'+format, format=format, bbox_inches='tight')
+    return exit_code
+
+
+@traced()
+def plot_report(img_temps, segmented_temps, mean_temps, dermatomes_temps, dermatomes_masks, times, path = './outputs/report'):
+    figsize = 15,8,
+    fig = plt.figure(figsize=figsize)
+    fig.set_size_inches(figsize[0], figsize[1])
+    exit_code, lines, _ = draw_report(fig, img_temps, segmented_temps, mean_temps, dermatomes_temps, dermatomes_masks, times)
+
     rax = plt.axes([0.76, 0.03, 0.2, 0.33])
     labels = [str(line.get_label()) for line in lines]
     visibility = [line.get_visible() for line in lines]
@@ -116,16 +182,6 @@ def plot_report(img_temps, segmented_temps, mean_temps, dermatomes_temps, dermat
 
     check.on_clicked(func)
 
-
-    #Plot clorbar
-    cax = fig.add_axes([axs[-1][-1].get_position().x1 + 0.05,axs[-1][-1].get_position().y0,0.02,axs[0][-1].get_position().y1-axs[-1][-1].get_position().y0])
-    #Mappeable objects for connectivities colorbar1
-    sm = plt.cm.ScalarMappable(norm=norm, cmap=cmap)
-    sm.set_array(segmented_temps)
-    cbar = fig.colorbar(sm, cax=cax, ticks=np.linspace(np.min(segmented_temps[segmented_temps != 0]), np.max(segmented_temps), 5))
-    for t in cbar.ax.get_yticklabels():
-        t.set_fontsize(10)
-
     #Save image
 
     fig.show()
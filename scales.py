@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+from interpreters import registry
+from instrument import traced
+from startup import lazy_import
+
+pytesseract = lazy_import('pytesseract')
+
+
+#Regions of the thermal camera scale bar (rows, cols)
+LOWER_SCALE_REGION = (slice(445, 467), slice(575, 625))
+UPPER_SCALE_REGION = (slice(14, 34), slice(576, 624))
+DEFAULT_SCALE = (25, 45)
+
+#Regions of each digit (tens, units, tenths), lower scale first
+DIGIT_REGIONS = [(slice(445, 467), slice(575, 591)),
+                 (slice(445, 467), slice(589, 605)),
+                 (slice(445, 467), slice(609, 625)),
+                 (slice(14, 34), slice(576, 590)),
+                 (slice(14, 34), slice(590, 604)),
+                 (slice(14, 34), slice(610, 624))]
+DIGIT_WEIGHTS = np.array([10, 1, 0.1])
+
+
+class DigitRecognizer():
+    """
+    Reads the temperature scales with the digits classifier (digits_recognition.tflite).
+    The six digit crops of every frame of a session go through the model in one invoke.
+    """
+    def __init__(self, model_path = './digits_recognition.tflite', size = 28):
+        self.model_path = model_path
+        self.size = size
+
+    def crops(self, X):
+        """
+        (N*6, size, size, 1) array with the grayscale digit crops of every frame
+        """
+        crops = np.empty((len(X)*len(DIGIT_REGIONS), self.size, self.size, 1), dtype = np.float32)
+        for i, x in enumerate(X):
+            for j, region in enumerate(DIGIT_REGIONS):
+                crop = cv2.resize(x[region], (self.size, self.size), interpolation = cv2.INTER_NEAREST)
+                crop = np.uint8(crop)
+                if crop.ndim == 3:
+                    crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+                crops[i*len(DIGIT_REGIONS) + j, :, :, 0] = crop
+        return crops
+
+    @traced()
+    def classify(self, crops):
+        """
+        Class probabilities (M, 10) of a batch of crops
+        """
+        with registry.lease(self.model_path) as model:
+            try:
+                model.resize_batch(crops.shape[0])
+                batches = [crops]
+            except (RuntimeError, ValueError):
+                #No dynamic batch: resize_batch restored the last batch, one crop per invoke
+                model.resize_batch(1)
+                batches = [crop[None] for crop in crops]
+            outputs = []
+            for batch in batches:
+                outputs.append(model.predict(batch))
+        output = np.concatenate(outputs).astype(np.float64)
+        if not np.allclose(output.sum(axis=1), 1, atol=1e-3) or output.min() < 0:
+            #Logits, convert to probabilities
+            output = np.exp(output - output.max(axis=1, keepdims=True))
+            output /= output.sum(axis=1, keepdims=True)
+        return output
+
+    def predict(self, X):
+        """
+        Scales of a stack of frames
+        Returns
+        -------
+        (np.ndarray, np.ndarray): (N,2) lower and upper scales, (N,) confidence
+                                  (probability of the least certain digit of the frame)
+        """
+        probabilities = self.classify(self.crops(X)).reshape(len(X), len(DIGIT_REGIONS), -1)
+        digits = probabilities.argmax(axis=2).reshape(len(X), 2, 3)
+        confidence = probabilities.max(axis=2).min(axis=1)
+        return np.round(digits @ DIGIT_WEIGHTS, 1), confidence
+
+
+class OCRCache():
+    """
+    On-disk LRU cache of tesseract results, keyed by the hash of the thresholded crop.
+    Scale bars rarely change between frames and sessions, so most crops are read once.
+    """
+    def __init__(self, path = 'outputs/ocr_cache.json', max_entries = 4096):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict(self.read())
+        self.modified = False
+
+    def read(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.modified = True
+
+    def save(self):
+        """
+        Writes the cache, merged with entries saved meanwhile by other processes
+        """
+        with self.lock:
+            if not self.modified:
+                return
+            entries = OrderedDict(self.read())
+            entries.update(self.entries)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_path, self.path)
+            self.modified = False
+
+
+def threshold_crop(img):
+    """
+    Binarized crop for tesseract (dark digits on white background)
+    """
+    uint8img = img.astype("uint8")
+    return cv2.threshold(uint8img , 100, 255, cv2.THRESH_BINARY_INV+cv2.THRESH_OTSU)[1]
+
+
+def crop_key(thresh):
+    return hashlib.sha1(repr(thresh.shape).encode() + thresh.tobytes()).hexdigest()
+
+
+def clean_number_text(text):
+    #Text cleaning and replacement...
+    return text.replace('\n','').replace('-]', '4').replace(']', '1').replace(' ', '').replace(',', '.').replace('%', '7').replace('€','9').replace('[','').replace('&', '5').replace('-','3')
+
+
+def read_number(text):
+    """
+    Number of a tesseract text, or None if it is not a number
+    """
+    try:
+        num = float(clean_number_text(text))
+    except ValueError:
+        return None
+    if num>=100:
+        num/=10
+    return num
+
+
+def parse_number(text, log=None):
+    """
+    Converts tesseract text into a number. Returns -100 if it is not possible
+    """
+    num = read_number(text)
+    if num is None:
+        clean_text = clean_number_text(text)
+        print(f"Could not convert string {clean_text} into number")
+        if log is not None:
+            log(f"No se ha podido detectar escalas automáticamente de: Texto base: {text}, Texto limpio: {clean_text}. Dejando rango por defecto: [25, 45]")
+        return -100
+    return num
+
+
+#Montages and single crops are read with the same page segmentation, so the cached text
+#of a crop does not depend on how it was read
+OCR_CONFIG = '--psm 6'
+
+
+@traced()
+def ocr_montage(crops, gap = 16):
+    """
+    Reads several thresholded crops with a single tesseract call, stacking them
+    vertically on a white montage. Words are assigned to crops by their position, so a
+    missing or split line is detected. Returns one text per crop, or None if a crop has
+    no text, a word falls between crops or a text is not a number
+    """
+    width = max(crop.shape[1] for crop in crops) + 2*gap
+    rows = [np.full((gap, width), 255, dtype=np.uint8)]
+    bounds = []     #(top, bottom) of every crop in the montage
+    top = gap
+    for crop in crops:
+        row = np.full((crop.shape[0], width), 255, dtype=np.uint8)
+        row[:, gap:gap+crop.shape[1]] = crop
+        rows += [row, np.full((gap, width), 255, dtype=np.uint8)]
+        bounds.append((top, top + crop.shape[0]))
+        top += crop.shape[0] + gap
+    data = pytesseract.image_to_data(np.vstack(rows), config = OCR_CONFIG, output_type = pytesseract.Output.DICT)
+    words = [[] for _ in crops]
+    for text, left, word_top, height in zip(data['text'], data['left'], data['top'], data['height']):
+        if not text.strip():
+            continue
+        center = word_top + height/2
+        row = [i for i, (row_top, row_bottom) in enumerate(bounds) if row_top - gap/2 <= center < row_bottom + gap/2]
+        if not row:
+            return None
+        words[row[0]].append((left, text))
+    lines = [' '.join(text for _, text in sorted(row_words)) for row_words in words]
+    if any(read_number(line) is None for line in lines):
+        return None
+    return lines
+
+
+@traced()
+def ocr_texts(crops, cache=None):
+    """
+    Tesseract text of a list of thresholded crops. Identical and cached crops are not
+    read again, and all the remaining ones go to tesseract in one montage image.
+    Only texts that are numbers are cached. The cache is not written, callers save it
+    once per session or batch
+    """
+    keys = [crop_key(crop) for crop in crops]
+    texts = {}
+    for key in keys:
+        if key not in texts and cache is not None:
+            text = cache.get(key)
+            if text is not None:
+                texts[key] = text
+
+    missing = OrderedDict((key, crop) for key, crop in zip(keys, crops) if key not in texts)
+    if missing:
+        lines = ocr_montage(list(missing.values())) if len(missing) > 1 else None
+        if lines is None:
+            lines = [pytesseract.image_to_string(crop, config = OCR_CONFIG) for crop in missing.values()]
+        for key, text in zip(missing, lines):
+            texts[key] = text
+            if cache is not None and read_number(text) is not None:
+                cache.put(key, text)
+    return [texts[key] for key in keys]
+
+
+def predict_number_with_pytesseract(img, log=None, cache=None):
+    """
+    Obtain number from section of an image
+    Returns -100 if the text could not be converted into a number
+    """
+    text, = ocr_texts([threshold_crop(img)], cache)
+    return parse_number(text, log)
+
+
+def extract_scales_with_pytesseract(x, log=None, cache=None):
+    """
+    Extracts float lower and upper scales from a thermal image with pytesseract
+    """
+    return extract_multiple_scales_with_pytesseract(x[None], log, cache)[0]
+
+
+def extract_multiple_scales_with_pytesseract(X, log=None, cache=None):
+    """
+    Extracts float lower and upper scales from a stack of thermal images,
+    with at most one tesseract call for all of them
+    """
+    crops = []
+    for x in X:
+        crops += [threshold_crop(x[LOWER_SCALE_REGION + (0,)]), threshold_crop(x[UPPER_SCALE_REGION + (0,)])]
+    texts = ocr_texts(crops, cache)
+
+    scales = []
+    for i in range(len(X)):
+        lower_prediction = parse_number(texts[2*i], log)
+        upper_prediction = parse_number(texts[2*i+1], log)
+        if lower_prediction == -100:
+            lower_prediction = DEFAULT_SCALE[0]
+        if upper_prediction == -100:
+            upper_prediction = DEFAULT_SCALE[1]
+        scales.append((lower_prediction, upper_prediction))
+    return scales
+
+
+@traced()
+def extract_multiple_scales(X, log=None, recognizer=None, min_confidence=0.9, cache=None):
+    """
+    Extracts scales from a whole imported session
+    With a DigitRecognizer, all frames are read with the digits model at once and
+    only frames with a confidence below min_confidence are read with pytesseract
+    """
+    if recognizer is None:
+        return extract_multiple_scales_with_pytesseract(X, log, cache)
+
+    predicted, confidence = recognizer.predict(X)
+    scales = [tuple(predicted[i]) for i in range(len(X))]
+    uncertain = [i for i in range(len(X)) if confidence[i] < min_confidence]
+    if uncertain:
+        ocr_scales = extract_multiple_scales_with_pytesseract(np.asarray(X)[uncertain], log, cache)
+        for i, scale in zip(uncertain, ocr_scales):
+            scales[i] = scale
+    return scales
@@ -3,13 +3,39 @@
 
 import numpy as np
 import os
-import tflite_runtime.interpreter as tflite
-import matplotlib.pyplot as plt
+from interpreters import registry
+from startup import lazy_import
 from cv2 import connectedComponentsWithStats
 import cv2
+from collections import namedtuple
+from instrument import traced, tracer
 
+plt = lazy_import('matplotlib.pyplot')
 
 
+SessionChunk = namedtuple('SessionChunk', ['start', 'files', 'images', 'X', 'Y_pred'])
+
+
+def read_frame(path, cmap = 'rainbow'):
+    """
+    Reads a session frame as a uint8 (H,W,3) array. 'Hierro' frames are converted to
+    grayscale and repeated on the three channels expected by the models
+    """
+    img = plt.imread(path)
+    if cmap == 'Hierro':
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        img = cv2.merge([img, img, img])
+    return img
+
+
+def normalize_inputs(X):
+    """
+    Model inputs (uint8) as float32 normalized to their maximum, as used for temperatures
+    """
+    Xarray = X.astype(np.float32)
+    Xarray /= max(X.max(), 1)
+    return Xarray
+
 
 class ImageToSegment():
     def __init__(self):
@@ -19,41 +45,41 @@ class ImageToSegment():
         self.imageIsLoaded = False
         self.model = None
 
-    def predict(self, X):
-        input_details = self.interpreter.get_input_details()
-        output_details = self.interpreter.get_output_details()
-
-        input_shape = input_details[0]['shape']
-        input_data = np.float32(X)
-
-        self.interpreter.set_tensor(input_details[0]['index'], input_data)
-
-        self.interpreter.invoke()  # predict
-
-        output_data = self.interpreter.get_tensor(output_details[0]['index'])
+    @traced()
+    def predict(self, X, scale = 1.0):
+        """
+        Predicts a batch whose real values are X*scale, with float or quantized models
+        """
+        with registry.lease(self.model) as model:
+            model.resize_batch(X.shape[0])
+            output_data = model.predict(X, scale)
         
         return output_data
 
     def loadModel(self):
-        self.interpreter = tflite.Interpreter(model_path = self.model)
-        self.interpreter.allocate_tensors()
+        self.input_details, self.output_details = registry.load(self.model)
 
     def input_shape(self):
-        input_details = self.interpreter.get_input_details()[0]['shape'][1]
-        print(input_details)
-        return input_details
+        self.loadModel()
+        return self.input_details[0]['shape'][1]
 
     def extract(self, cmap = 'rainbow'):
+        if cmap == 'Hierro' or cmap == 'Gris':
+            self.img = plt.imread(self.imPath)
+        self.extract_array(self.img, cmap)
+
+    @traced()
+    def extract_array(self, img, cmap = 'rainbow'):
+        """
+        Segments an image already in memory (e.g. a camera frame)
+        """
         img_size = self.input_shape() # Input shape of the cnn
         if cmap == 'Hierro':  # If cmap is rainbow, convert to grayscale
-            self.img = plt.imread(self.imPath)
-            self.img = cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY)
-            new_img = np.empty((self.img.shape[0], self.img.shape[1], 3))
-            new_img[:,:,0] = new_img[:,:,1] = new_img[:,:,2] = self.img # Add three channels to be compatible with dl models
-            self.img = new_img
-        
-        if cmap == 'Gris':
-            self.img = plt.imread(self.imPath)
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            new_img = np.empty((img.shape[0], img.shape[1], 3))
+            new_img[:,:,0] = new_img[:,:,1] = new_img[:,:,2] = img # Add three channels to be compatible with dl models
+            img = new_img
+        self.img = img
 
         # self.X = tf.convert_to_tensor(self.img)
         self.X = self.img
@@ -72,63 +98,133 @@ class ImageToSegment():
         
         
 class SessionToSegment():
-    def __init__(self):
+    def __init__(self, batch_size = None, memory_budget = None):
         self.thereIsX = False
         self.X = None
         self.Xarray = None
-        
-    def predict(self, X, progressBar):
-        input_details = self.interpreter.get_input_details()
-        output_details = self.interpreter.get_output_details()
-        predictions = []
-
-        for i in range(X.shape[0]):
-            input_shape = input_details[0]['shape']
-            input_data = np.float32(X[i])
-            input_data = np.expand_dims(input_data, axis=0)
-            
-            self.interpreter.set_tensor(input_details[0]['index'], input_data)
-
-            self.interpreter.invoke()  # predict
-
-            output_data = self.interpreter.get_tensor(output_details[0]['index'])
-            predictions.append(output_data)
-            progressBar.setValue((100*i+1)/X.shape[0])
+        self.img_array = None
+        self.batch_size = batch_size   #Frames per invoke, None for the whole session at once
+        self.memory_budget = memory_budget   #Bytes of working memory per chunk, None for the whole session at once
+
+    @traced()
+    def predict(self, X, progressBar=None, scale = 1.0):
+        """
+        Predicts a whole session in chunks of self.batch_size frames, one invoke per chunk
+        X real values are X*scale, e.g. uint8 frames with scale 1/255, so quantized
+        models take the frames without converting them to float
+        Returns a contiguous float32 (N,H,W,1) array of predictions
+        """
+        n = X.shape[0]
+        chunk = self.batch_size or n
+        predictions = None
+        start = 0
+
+        with registry.lease(self.model) as model:
+            while start < n:
+                input_data = X[start:start+chunk]
+                try:
+                    model.resize_batch(input_data.shape[0])
+                except (RuntimeError, ValueError):
+                    #Model does not support dynamic batch, fall back to one frame per invoke
+                    #(resize_batch restored the last batch that worked, so this resize is done)
+                    model.resize_batch(1)
+                    chunk = self.batch_size = 1
+                    input_data = input_data[:1]
+
+                output_data = model.predict(input_data, scale)
+                if predictions is None:
+                    predictions = np.empty((n, *output_data.shape[1:]), dtype = output_data.dtype)
+                predictions[start:start+input_data.shape[0]] = output_data
+                start += input_data.shape[0]
+                if progressBar is not None:
+                    progressBar.setValue(100*start/n)
 
         return predictions
     
     def loadModel(self):
-        self.interpreter = tflite.Interpreter(model_path = self.model)
-        self.interpreter.allocate_tensors()
+        self.input_details, self.output_details = registry.load(self.model)
 
     def input_shape(self):
-        input_details = self.interpreter.get_input_details()[0]['shape'][1]
-        print(input_details)
-        return input_details
-
-    def whole_extract(self, dirs, cmap = 'rainbow',progressBar=None):
+        self.loadModel()
+        return self.input_details[0]['shape'][1]
+
+    def frame_bytes(self, image_shape, img_size):
+        """
+        Working memory needed to stream one frame: the decoded image, its model
+        input (uint8 and float32), the interpreter tensors and the prediction
+        """
+        output_channels = self.output_details[0]['shape'][-1]
+        return (int(np.prod(image_shape)) + img_size*img_size*3*(1 + 4 + 4)
+                + 2*4*img_size*img_size*output_channels)
+
+    def chunk_size(self, dirs, cmap = 'rainbow', image_shape = None):
+        """
+        Frames per chunk that fit in self.memory_budget (the whole session if there is no budget)
+        image_shape is the shape of the frames, read from the first one if not given
+        """
+        if self.memory_budget is None or not dirs:
+            return max(len(dirs), 1)
         img_size = self.input_shape()
-        self.img_array=[]
-        if cmap == 'Gris':
-            for i in range(len(dirs)):
-                self.img_array.append(plt.imread(dirs[i]))
-
-        
-        if cmap == 'Hierro': # If input images are in gnuplot2, convert them to grayscale
-            for i in range(len(dirs)):
-                img = plt.imread(dirs[i])
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                new_img = np.empty((img.shape[0], img.shape[1], 3)) # Add three more channels to the image
-                new_img[:,:,0] = new_img[:,:,1] = new_img[:,:,2] = img
-                img = new_img
-
-                self.img_array.append(img)
-
-        self.img_array=np.array(self.img_array)
-        self.X = np.array([cv2.resize(self.img_array[i] , (img_size , img_size), interpolation = cv2.INTER_NEAREST) for i in range(self.img_array.shape[0])])/255.
-        self.Xarray  = np.array(self.X)
-        self.Xarray = (self.Xarray/self.Xarray.max()).reshape(len(dirs) ,img_size , img_size , 3)
-        self.Y_pred = self.predict(self.X,progressBar)
+        if image_shape is None:
+            image_shape = read_frame(dirs[0], cmap).shape
+        return int(np.clip(self.memory_budget // self.frame_bytes(image_shape, img_size), 1, len(dirs)))
+
+    def stream(self, dirs, cmap = 'rainbow', chunk_size = None, progressBar = None):
+        """
+        Segments a session in chunks of frames, decoding only one chunk at a time
+        Yields SessionChunk(start, files, images, X, Y_pred) with uint8 (n,H,W,3) images,
+        uint8 (n,S,S,3) model inputs and float32 predictions
+        """
+        if not dirs:
+            return
+        img_size = self.input_shape()
+        first = read_frame(dirs[0], cmap)     #Sizes the chunks and is reused as the first frame
+        image_shape = first.shape
+        chunk_size = chunk_size or self.chunk_size(dirs, cmap, image_shape)
+        for start in range(0, len(dirs), chunk_size):
+            files = dirs[start:start+chunk_size]
+            images = np.empty((len(files), *image_shape), dtype = np.uint8)
+            X = np.empty((len(files), img_size, img_size, 3), dtype = np.uint8)
+            with tracer.span('SessionToSegment.decode', frames = len(files)):
+                for i, file in enumerate(files):
+                    img = first if start + i == 0 else read_frame(file, cmap)
+                    if img.shape != image_shape:
+                        img = cv2.resize(img, (image_shape[1], image_shape[0]), interpolation = cv2.INTER_NEAREST)
+                    images[i] = img
+                    X[i] = cv2.resize(img, (img_size, img_size), interpolation = cv2.INTER_NEAREST)
+            first = None
+            Y_pred = self.predict(X, scale = 1/255)
+            if progressBar is not None:
+                progressBar.setValue(100*(start + len(files))/len(dirs))
+            yield SessionChunk(start, files, images, X, Y_pred)
+
+    @traced()
+    def whole_extract(self, dirs, cmap = 'rainbow', progressBar = None, keep_images = False):
+        """
+        Segments a whole session, streaming it in chunks that fit in self.memory_budget
+        Keeps Xarray (float32 inputs normalized to the session maximum), Y_pred and, only
+        if keep_images, the full resolution frames in img_array. Without them the memory
+        kept grows with the model resolution only
+        """
+        img_size = self.input_shape()
+        n = len(dirs)
+        self.Xarray = np.empty((n, img_size, img_size, 3), dtype = np.float32)
+        self.img_array = None
+        self.Y_pred = None
+        maximum = 0
+        for chunk in self.stream(dirs, cmap, progressBar = progressBar):
+            end = chunk.start + len(chunk.files)
+            self.Xarray[chunk.start:end] = chunk.X
+            maximum = max(maximum, int(chunk.X.max()))
+            if self.Y_pred is None:
+                self.Y_pred = np.empty((n, *chunk.Y_pred.shape[1:]), dtype = chunk.Y_pred.dtype)
+            self.Y_pred[chunk.start:end] = chunk.Y_pred
+            if keep_images:
+                if self.img_array is None:
+                    self.img_array = np.empty((n, *chunk.images.shape[1:]), dtype = np.uint8)
+                self.img_array[chunk.start:end] = chunk.images
+        self.X = None
+        self.Xarray /= max(maximum, 1)     #As normalize_inputs, without a uint8 copy of the session
 
     def setPath(self,im):
         self.sessionPath = im
@@ -0,0 +1,30 @@
+import os
+import re
+
+
+def alphanum_key(key):
+    """
+    Sorting key to an alphanumeric reasonable sense (t5 < t10)
+    """
+    convert = lambda text: int(text) if text.isdigit() else text
+    return [ convert(c) for c in re.split('([0-9]+)', key) ]
+
+
+def find_session_images(directory):
+    """
+    Finds all jpg images of a session directory, sorted by capture time
+    """
+    file_list = []
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            if (file.endswith(".jpg")):
+                file_list.append(os.path.join(root,file))
+    return sorted(file_list, key = alphanum_key)
+
+
+def get_times(files):
+    """
+    Converts standarized names (t<minutes>.jpg) of a file list into a list of
+    integers with time capture in minutes
+    """
+    return [int(os.path.basename(file).rsplit(".")[0][1:]) for file in files]
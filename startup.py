@@ -0,0 +1,82 @@
+#Application startup: heavy modules imported on first use and a timing report of the start
+#Import this module first, its timer starts with the process imports
+
+import importlib
+import json
+import threading
+import time
+
+
+class StartupTimer():
+    """
+    Time of each startup step, in ms since this module was imported
+    """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.marks = []
+        self.lock = threading.Lock()
+
+    def elapsed_ms(self):
+        return 1000*(time.perf_counter() - self.origin)
+
+    def mark(self, name):
+        elapsed = self.elapsed_ms()
+        with self.lock:
+            self.marks.append((name, elapsed))
+        return elapsed
+
+    def report(self):
+        """
+        One line per step with its time since start and since the previous step
+        """
+        lines = []
+        previous = 0
+        with self.lock:
+            marks = list(self.marks)
+        for name, elapsed in marks:
+            lines.append(f"{name:<32}{elapsed:9.0f} ms  (+{elapsed - previous:.0f} ms)")
+            previous = elapsed
+        return '\n'.join(lines)
+
+    def save(self, path):
+        with self.lock:
+            marks = [{'step': name, 'ms': elapsed} for name, elapsed in self.marks]
+        with open(path, 'w') as outfile:
+            json.dump(marks, outfile, indent = 2)
+
+
+timer = StartupTimer()
+
+
+class LazyModule():
+    """
+    Stands for a module until one of its attributes is used, then imports it.
+    The import time is recorded in the startup timer
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self._name)
+                timer.mark(f"import {self._name} ({1000*(time.perf_counter() - start):.0f} ms)")
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        module = self._module if self._module is not None else self._load()
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{'' if self._module is None else ' (loaded)'}>"
+
+
+def lazy_import(name):
+    """
+    plt = lazy_import('matplotlib.pyplot') imports matplotlib only when plt is first used
+    """
+    return LazyModule(name)
@@ -1,8 +1,81 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import cv2
-from dermatomes import get_dermatomes
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from dermatomes import get_dermatomes, SessionRegistration
+from instrument import traced
+from startup import lazy_import
 
+plt = lazy_import('matplotlib.pyplot')
+
+
+def region_statistics(values, labels, label_ids, percentiles=()):
+    """Statistics of values inside every labelled region, for all the labels at once
+    Parameters
+    ----------
+    values: np.ndarray, image (H,W) or session stack (N,H,W)
+    labels: np.ndarray, integer valued label map with the same shape as values
+    label_ids: list, labels to get statistics from, other labels are ignored
+    percentiles: list, percentiles (0-100) to compute for every region
+    Returns
+    -------
+    dict: 'count', 'mean', 'std', 'min', 'max' and 'p<q>' for each percentile q.
+          Arrays of shape (len(label_ids),), or (N, len(label_ids)) for a stack.
+          Regions without pixels have count 0 and nan statistics
+    """
+    values = np.asarray(values)
+    labels = np.asarray(labels).astype(np.int64)
+    stacked = values.ndim == 3
+    n_frames = values.shape[0] if stacked else 1
+    n_labels = len(label_ids)
+
+    #Region index of every pixel: frame*n_labels + position of its label in label_ids
+    lut = np.full(max(labels.max(), max(label_ids)) + 1, -1, dtype=np.int64)
+    lut[list(label_ids)] = np.arange(n_labels)
+    region = lut[labels.reshape(n_frames, -1)]
+    region = np.where(region >= 0, region + n_labels*np.arange(n_frames)[:,None], -1).ravel()
+    valid = region >= 0
+    region = region[valid]
+    flat_values = values.reshape(-1)[valid].astype(np.float64)
+
+    n_regions = n_frames*n_labels
+    count = np.bincount(region, minlength=n_regions)
+    total = np.bincount(region, weights=flat_values, minlength=n_regions)
+    total_sq = np.bincount(region, weights=flat_values**2, minlength=n_regions)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+        std = np.sqrt(np.maximum(total_sq/count - mean**2, 0))
+
+    #Pixels sorted by region (and by value inside each region for percentiles)
+    if len(percentiles):
+        order = np.lexsort((flat_values, region))
+    else:
+        order = np.argsort(region, kind='stable')
+    sorted_values = flat_values[order]
+    starts = np.concatenate(([0], np.cumsum(count)[:-1]))
+    present = count > 0
+
+    stats = {'count': count, 'mean': mean, 'std': std,
+             'min': np.full(n_regions, np.nan), 'max': np.full(n_regions, np.nan)}
+    if present.any():
+        stats['min'][present] = np.minimum.reduceat(sorted_values, starts[present])
+        stats['max'][present] = np.maximum.reduceat(sorted_values, starts[present])
+    for q in percentiles:
+        #Linear interpolation between closest ranks, as np.percentile
+        position = (count[present] - 1)*q/100
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        low_values = sorted_values[starts[present] + low]
+        high_values = sorted_values[starts[present] + high]
+        stats[f'p{q:g}'] = np.full(n_regions, np.nan)
+        stats[f'p{q:g}'][present] = low_values + (high_values - low_values)*(position - low)
+
+    shape = (n_frames, n_labels) if stacked else (n_labels,)
+    return {key: value.reshape(shape) for key, value in stats.items()}
+
+
+@traced()
 def mean_temperature(image , mask , range_=[22.5 , 35.5], plot = False):
     """Get mean temperature of feet image based on mask and scale
     Parameters
@@ -28,15 +101,8 @@ def mean_temperature(image , mask , range_=[22.5 , 35.5], plot = False):
     result = cv2.connectedComponentsWithStats(mask.astype('uint8'))    
 
     if result[0] == 3:
-        #Find left and right feet masks
-        right_mask = np.where(result[1] == 1, 1, 0)
-        left_mask = np.where(result[1] == 2, 1, 0)
-        #Map with their temperatures
-        right_temp = right_mask * original_temp
-        left_temp = left_mask * original_temp
-        #Get final mean values
-        left_mean = (left_temp[left_mask!=0]).mean()
-        right_mean = (right_temp[right_mask!=0]).mean()
+        #Right foot is component 1, left foot is component 2
+        left_mean, right_mean = region_statistics(original_temp, result[1], [2, 1])['mean']
         means = [left_mean, right_mean]        
         return means, temp, original_temp
     else:
@@ -44,6 +110,24 @@ def mean_temperature(image , mask , range_=[22.5 , 35.5], plot = False):
         return mean, temp, original_temp
 
 
+def pack_mean_temperatures(means):
+    """
+    Stacks mean_temperature outputs, [left, right] pairs or single means, into a
+    (N,2) float array. Single means are stored as [mean, nan]
+    """
+    packed = np.full((len(means), 2), np.nan)
+    for i, mean in enumerate(means):
+        packed[i, :np.size(mean)] = mean
+    return packed
+
+
+def unpack_mean_temperatures(packed):
+    """
+    Inverse of pack_mean_temperatures, as a list of pairs and single means
+    """
+    return [[float(a), float(b)] if not np.isnan(b) else float(a) for a, b in np.asarray(packed)]
+
+
 dic_dermatomes = {0:'Backgroud', 10:'Medial Plantar Pie Derecho', 11:'Medial Plantar Pie Izquierdo', 20:'Lateral Plantar Pie Derecho', 21:'Lateral Plantar Pie Izquierdo',
                   30:'Sural Pie Derecho', 31:'Sural Pie Izquierdo', 40:'Tibial Pie Derecho', 41:'Tibial Pie Izquierdo',
                   50:'Saphenous Pie Derecho', 51:'Saphenous Pie Izquierdo', 255:'Edges'}
@@ -54,14 +138,117 @@ derm_id.sort()
 derm_names = [dic_dermatomes[key] for key in derm_id[1:-1]]
 
 
-def dermatomes_temperatures(original_temp, mask):
-    
-    dermatomes_mask = get_dermatomes(mask.astype('uint8'))
+@traced()
+def dermatomes_temperatures(original_temp, mask, registration=None, executor=None):
+    """Mean temperature of every dermatome
+    registration: optional dermatomes.SessionRegistration shared by the frames of a session
+    executor: optional executor to register both feet concurrently
+    """
+    dermatomes_mask = get_dermatomes(mask.astype('uint8'), registration=registration, executor=executor)
      
-    mean_temp_t_derm = np.zeros((len(derm_names)))
-    
-    for j, derm_id in enumerate(np.unique(dermatomes_mask)[1:-1]):
-        mean_temp_t_derm[j] = original_temp[dermatomes_mask==derm_id].mean()
-        
+    mean_temp_t_derm = region_statistics(original_temp, dermatomes_mask, derm_id[1:-1])['mean']
+    mean_temp_t_derm[np.isnan(mean_temp_t_derm)] = 0    #Dermatome not found in the mask
     
-    return mean_temp_t_derm, dermatomes_mask
\ No newline at end of file
+    return mean_temp_t_derm, dermatomes_mask
+
+
+def session_statistics(original_temps, masks, dermatomes_masks, percentiles=(5, 25, 50, 75, 95)):
+    """Temperature statistics of both feet and every dermatome for a whole session
+    Parameters
+    ----------
+    original_temps: np.ndarray, (N,H,W) temperature images
+    masks: np.ndarray, (N,H,W) or (N,H,W,1) segmentation masks
+    dermatomes_masks: np.ndarray, (N,H,W) dermatomes masks from dermatomes_temperatures
+    percentiles: list, percentiles to compute for every region
+    Returns
+    -------
+    dict: {'feet': stats, 'dermatomes': stats}, as region_statistics over the stack.
+          Feet columns are [left, right] as in mean_temperature, dermatomes columns follow derm_names
+    """
+    masks = np.asarray(masks).reshape(np.shape(original_temps)).astype('uint8')
+    feet_labels = np.array([cv2.connectedComponents(mask)[1] for mask in masks])
+    return {'feet': region_statistics(original_temps, feet_labels, [2, 1], percentiles),
+            'dermatomes': region_statistics(original_temps, dermatomes_masks, derm_id[1:-1], percentiles)}
+
+
+WARM_START_CHAIN = 8    #Frames registered from the previous one before a cold start
+
+
+def _dermatomes_chunk(original_temps, masks, warm_start, stop=None, frame_done=None):
+    """
+    Serial dermatomes temperatures of a warm start chain of frames. Runs in a worker
+    stop: optional threading.Event, the chain is abandoned (returns None) at the next frame once set
+    frame_done: optional callable, called after every frame
+    """
+    registration = SessionRegistration() if warm_start else None
+    results = []
+    with ThreadPoolExecutor(1) as feet_executor:
+        for original_temp, mask in zip(original_temps, masks):
+            if stop is not None and stop.is_set():
+                return None
+            results.append(dermatomes_temperatures(original_temp, mask, registration, feet_executor))
+            if frame_done is not None:
+                frame_done()
+    return [r[0] for r in results], [r[1] for r in results]
+
+
+def session_dermatomes_temperatures(original_temps, masks, workers=None, use_processes=False, warm_start=True,
+                                    chain_length=WARM_START_CHAIN, progress=None):
+    """Dermatomes temperatures of all the frames of a session, registered concurrently
+    Parameters
+    ----------
+    original_temps: list or np.ndarray, temperature image of every frame
+    masks: list or np.ndarray, segmentation mask of every frame
+    workers: int, number of chains of frames registered concurrently, by default the number of cores
+    use_processes: boolean, use a process pool instead of threads (when the GIL is the bottleneck)
+    warm_start: boolean, warm start the registration between consecutive frames of a chain
+    chain_length: int, frames of each warm start chain. Chains start cold at fixed frames,
+                  so the results do not depend on the number of workers
+    progress: callable(done, total), called as frames are finished (as chains with processes).
+              If it raises (e.g. a cancelled job), the registrations stop at their next frame
+              and the exception propagates
+    Returns
+    -------
+    (np.ndarray, np.ndarray): dermatomes mean temperatures (N, dermatomes) and dermatomes masks
+    """
+    n = len(masks)
+    chains = [(a, min(a + chain_length, n)) for a in range(0, n, chain_length)]
+    workers = max(1, min(workers or os.cpu_count() or 1, len(chains)))
+
+    dermatomes_temps = [None]*n
+    dermatomes_masks = [None]*n
+    done = [0]
+    lock = threading.Lock()
+
+    def frame_done(frames=1):
+        with lock:
+            done[0] += frames
+            count = done[0]
+        if progress is not None:
+            progress(count, n)
+
+    if workers == 1:
+        for a, b in chains:
+            dermatomes_temps[a:b], dermatomes_masks[a:b] = _dermatomes_chunk(original_temps[a:b], masks[a:b],
+                                                                             warm_start, frame_done = frame_done)
+    else:
+        Executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        stop = None if use_processes else threading.Event()
+        executor = Executor(workers)
+        try:
+            futures = {executor.submit(_dermatomes_chunk, original_temps[a:b], masks[a:b], warm_start,
+                                       stop, None if use_processes else frame_done): (a, b)
+                       for a, b in chains}
+            for future in as_completed(futures):
+                a, b = futures[future]
+                dermatomes_temps[a:b], dermatomes_masks[a:b] = future.result()
+                if use_processes:
+                    frame_done(b - a)
+        except BaseException:
+            #Queued chains are dropped and running ones stop at their next frame
+            if stop is not None:
+                stop.set()
+            executor.shutdown(cancel_futures = True)
+            raise
+        executor.shutdown()
+    return np.array(dermatomes_temps), np.array(dermatomes_masks)
@@ -0,0 +1,77 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import interpreters
+
+
+class FixedBatchInterpreter():
+    """
+    Stand-in for a TFLite interpreter of a model without dynamic batch: allocate_tensors
+    rejects batches larger than max_batch, after the input was already resized.
+    The model multiplies its input by 2, or outputs a one-hot of its first value (digits)
+    """
+    def __init__(self, input_shape = (1, 4, 4, 1), output_shape = None, max_batch = 1):
+        self.input_shape = list(input_shape)
+        self.output_shape = list(output_shape) if output_shape else None
+        self.max_batch = max_batch
+        self.allocated = None
+        self.input = None
+        self.output = None
+
+    def resize_tensor_input(self, index, shape):
+        self.input_shape = list(shape)
+
+    def allocate_tensors(self):
+        if self.input_shape[0] > self.max_batch:
+            raise RuntimeError('Dynamic batch is not supported by this model')
+        self.allocated = list(self.input_shape)
+
+    def _details(self, index, shape):
+        return [{'index': index, 'shape': np.array(shape), 'dtype': np.float32, 'quantization': (0.0, 0)}]
+
+    def get_input_details(self):
+        return self._details(0, self.input_shape)
+
+    def get_output_details(self):
+        if self.output_shape:
+            return self._details(1, [self.input_shape[0], *self.output_shape[1:]])
+        return self._details(1, self.input_shape)
+
+    def get_tensor_details(self):
+        return []
+
+    def set_tensor(self, index, value):
+        if list(value.shape) != self.input_shape or self.allocated != self.input_shape:
+            raise ValueError(f'Cannot set tensor: got {list(value.shape)} expected {self.input_shape}')
+        self.input = value
+
+    def invoke(self):
+        if self.output_shape:
+            classes = self.output_shape[-1]
+            labels = np.clip(self.input.reshape(len(self.input), -1)[:, 0], 0, classes - 1).astype(int)
+            self.output = np.eye(classes, dtype = np.float32)[labels]
+        else:
+            self.output = self.input*2
+
+    def get_tensor(self, index):
+        return self.output
+
+
+@pytest.fixture
+def fixed_batch_model(tmp_path, monkeypatch):
+    """
+    Fresh registry whose interpreters are FixedBatchInterpreter. Returns (registry, model
+    path, factory) where factory(**kwargs) sets the stub arguments
+    """
+    registry = interpreters.InterpreterRegistry()
+    stub_kwargs = {}
+    monkeypatch.setattr(interpreters, 'make_interpreter',
+                        lambda content, settings = None: FixedBatchInterpreter(**stub_kwargs))
+    path = tmp_path / 'model.tflite'
+    path.write_bytes(b'model')
+    return registry, str(path), stub_kwargs.update
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+
+def test_rejected_batch_keeps_the_instance_usable(fixed_batch_model):
+    registry, path, _ = fixed_batch_model
+    with registry.lease(path) as model:
+        with pytest.raises(RuntimeError):
+            model.resize_batch(8)
+        assert model.batch_size == 1
+        model.resize_batch(1)
+        X = np.ones((1, 4, 4, 1), dtype = np.float32)
+        assert np.array_equal(model.predict(X), 2*X)
+
+    #The instance went back to the idle pool and is still usable by the next lease
+    with registry.lease(path) as model:
+        assert np.array_equal(model.predict(np.ones((1, 4, 4, 1))), np.full((1, 4, 4, 1), 2))
+
+
+def test_batch_resize_within_limits(fixed_batch_model):
+    registry, path, set_stub = fixed_batch_model
+    set_stub(max_batch = 8)
+    with registry.lease(path) as model:
+        model.resize_batch(8)
+        assert model.batch_size == 8
+        X = np.arange(8*16, dtype = np.float32).reshape(8, 4, 4, 1)
+        assert np.array_equal(model.predict(X), 2*X)
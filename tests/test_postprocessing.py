@@ -0,0 +1,73 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from postprocessing import PostProcessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def example_mask(size = 224):
+    mask = cv2.imread(os.path.join(ROOT, 'images', 'example_maks.png'), cv2.IMREAD_GRAYSCALE)
+    return (cv2.resize(mask, (size, size), interpolation = cv2.INTER_NEAREST) != 0).astype('uint8')
+
+
+def random_mask(seed, size = 224):
+    """
+    Smooth random blobs, as noisy model outputs
+    """
+    rng = np.random.default_rng(seed)
+    noise = cv2.GaussianBlur(rng.random((size, size)).astype('float32'), (0, 0), 4)
+    return (noise > np.percentile(noise, 60)).astype('uint8')
+
+
+def feet_mask(size = 224):
+    """
+    Two feet with holes, several small components and objects touching every border
+    """
+    mask = np.zeros((size, size), dtype = 'uint8')
+    cv2.ellipse(mask, (70, 112), (35, 90), 0, 0, 360, 1, -1)
+    cv2.ellipse(mask, (155, 112), (35, 90), 0, 0, 360, 1, -1)
+    cv2.circle(mask, (70, 100), 10, 0, -1)          #Holes
+    cv2.rectangle(mask, (150, 60), (160, 75), 0, -1)
+    for x, y in [(20, 20), (200, 30), (110, 200), (30, 190)]:
+        cv2.circle(mask, (x, y), 4, 1, -1)           #Small components
+    mask[:3, 90:130] = 1                             #Touching the borders
+    mask[100:140, -5:] = 1
+    mask[-8:, :40] = 1
+    mask[60:70, :2] = 1
+    mask[180, 180] = 1                               #Single pixel
+    return mask
+
+
+MASKS = {'example': example_mask, 'feet': feet_mask,
+         **{f'random_{seed}': (lambda seed = seed: random_mask(seed)) for seed in range(5)},
+         'empty': lambda: np.zeros((224, 224), dtype = 'uint8'),
+         'full': lambda: np.ones((224, 224), dtype = 'uint8')}
+
+
+@pytest.mark.parametrize('min_size', [50, 2500])
+@pytest.mark.parametrize('name', MASKS)
+def test_execute_matches_reference(name, min_size):
+    mask = MASKS[name]()
+    post_processing = PostProcessing(min_size)
+    expected = post_processing.execute_reference(mask)
+    output = post_processing.execute(mask)
+    assert output.shape == expected.shape == (224, 224, 1)
+    assert output.dtype == expected.dtype
+    assert np.array_equal(output, expected)
+    #Model outputs come as (H,W,1) masks
+    assert np.array_equal(post_processing.execute(mask[..., None]), expected)
+
+
+@pytest.mark.parametrize('channel', [False, True])
+def test_execute_batch_matches_reference(channel):
+    masks = np.array([mask() for mask in MASKS.values()])
+    post_processing = PostProcessing(2500)
+    expected = np.array([post_processing.execute_reference(mask) for mask in masks])
+    output = post_processing.execute_batch(masks[..., None] if channel else masks)
+    assert output.shape == (len(masks), 224, 224, 1)
+    assert output.dtype == np.float32
+    assert np.array_equal(output, expected)
@@ -0,0 +1,88 @@
+import numpy as np
+
+import scales
+from scales import DigitRecognizer, DIGIT_REGIONS
+
+
+def frame_with_digits(digits):
+    """
+    Frame whose digit regions are filled with the digit they should read, as the stub
+    digits model outputs the first pixel of each crop
+    """
+    frame = np.zeros((480, 640, 3), dtype = np.uint8)
+    for region, digit in zip(DIGIT_REGIONS, digits):
+        frame[region] = digit
+    return frame
+
+
+def test_digits_without_dynamic_batch(fixed_batch_model, monkeypatch):
+    registry, path, set_stub = fixed_batch_model
+    set_stub(input_shape = (1, 28, 28, 1), output_shape = (1, 10))
+    monkeypatch.setattr(scales, 'registry', registry)
+    recognizer = DigitRecognizer(path)
+    X = np.array([frame_with_digits([2, 5, 3, 3, 4, 1]), frame_with_digits([2, 2, 0, 3, 6, 5])])
+
+    predicted, confidence = recognizer.predict(X)
+
+    assert np.allclose(predicted, [[25.3, 34.1], [22.0, 36.5]])
+    assert np.allclose(confidence, 1)
+
+
+class FakeTesseract():
+    """
+    pytesseract stand-in returning fixed words (text, top) for montages and a fixed text
+    for single crops
+    """
+    class Output():
+        DICT = 'dict'
+
+    def __init__(self, words = (), text = ''):
+        self.words = list(words)
+        self.text = text
+        self.configs = []
+
+    def image_to_data(self, image, config = '', output_type = None):
+        self.configs.append(config)
+        return {'text': [text for text, _ in self.words], 'left': [10]*len(self.words),
+                'top': [top for _, top in self.words], 'height': [14]*len(self.words)}
+
+    def image_to_string(self, image, config = ''):
+        self.configs.append(config)
+        return self.text
+
+
+def crops(n):
+    return [np.full((20, 40), 255 - i, dtype = np.uint8) for i in range(n)]
+
+
+def test_montage_lines_follow_the_crops(monkeypatch):
+    #Crops lie at rows 16-36, 52-72 and 88-108 of the montage
+    monkeypatch.setattr(scales, 'pytesseract', FakeTesseract([('25.3', 19), ('34.1', 55), ('22', 91)]))
+    assert scales.ocr_montage(crops(3)) == ['25.3', '34.1', '22']
+
+
+def test_montage_with_a_missing_line_is_rejected(monkeypatch):
+    #Second crop not read, third one split in two words: same line count, misaligned
+    monkeypatch.setattr(scales, 'pytesseract', FakeTesseract([('25.3', 19), ('34', 88), ('.1', 95)]))
+    assert scales.ocr_montage(crops(3)) is None
+
+
+def test_montage_with_text_that_is_not_a_number_is_rejected(monkeypatch):
+    monkeypatch.setattr(scales, 'pytesseract', FakeTesseract([('25.3', 19), ('abc', 55)]))
+    assert scales.ocr_montage(crops(2)) is None
+
+
+def test_only_numbers_are_cached_and_the_cache_is_not_written(monkeypatch, tmp_path):
+    fake = FakeTesseract(text = 'not a number')
+    monkeypatch.setattr(scales, 'pytesseract', fake)
+    cache = scales.OCRCache(str(tmp_path / 'ocr_cache.json'))
+    assert scales.ocr_texts(crops(1), cache) == ['not a number']
+    assert not cache.entries
+
+    fake.text = '25.3'
+    assert scales.ocr_texts(crops(1), cache) == ['25.3']
+    assert list(cache.entries.values()) == ['25.3']
+    assert not (tmp_path / 'ocr_cache.json').exists()
+    cache.save()
+    assert scales.OCRCache(str(tmp_path / 'ocr_cache.json')).entries == cache.entries
+    assert set(fake.configs) == {scales.OCR_CONFIG}
@@ -0,0 +1,29 @@
+import numpy as np
+
+import segment
+from segment import SessionToSegment
+
+
+def test_predict_falls_back_to_single_frames(fixed_batch_model, monkeypatch):
+    registry, path, _ = fixed_batch_model
+    monkeypatch.setattr(segment, 'registry', registry)
+    s2s = SessionToSegment()
+    s2s.setModel(path)
+    X = np.arange(5*16, dtype = np.uint8).reshape(5, 4, 4, 1)
+
+    Y = s2s.predict(X, scale = 1/255)
+
+    assert s2s.batch_size == 1
+    assert np.allclose(Y, 2*X/255)
+
+
+def test_predict_batches_with_dynamic_batch(fixed_batch_model, monkeypatch):
+    registry, path, set_stub = fixed_batch_model
+    set_stub(max_batch = 8)
+    monkeypatch.setattr(segment, 'registry', registry)
+    s2s = SessionToSegment(batch_size = 4)
+    s2s.setModel(path)
+    X = np.arange(10*16, dtype = np.float32).reshape(10, 4, 4, 1)
+
+    assert np.array_equal(s2s.predict(X), 2*X)
+    assert s2s.batch_size == 4
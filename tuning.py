@@ -0,0 +1,200 @@
+"""
+Interpreter auto-tuning: finds the fastest thread count and delegate of a model on this device
+Usage:
+    tuning.py [options] MODEL...
+
+Options:
+    MODEL                   Models to tune
+    -c --config=PATH        Configuration file where the results are kept [default: config.json]
+    -r --repeats=N          Timed invokes per candidate [default: 10]
+    -t --max-threads=N      Largest thread count tried (defaults to all cores)
+    -f --force              Tune again models that are already tuned on this device
+"""
+import ctypes.util
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+from interpreters import make_interpreter, DELEGATE_LIBRARIES, tflite
+
+
+@lru_cache(maxsize = None)
+def _model_hash(path, mtime_ns, size):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as model_file:
+        for block in iter(lambda: model_file.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def model_hash(path):
+    """
+    SHA-1 of the model contents, so renamed or copied models keep their tuning
+    """
+    stat = os.stat(path)
+    return _model_hash(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class TuningStore():
+    """
+    Tuned interpreter settings kept in config.json under 'interpreter_tuning',
+    per hostname and model hash. Other keys of the file are preserved.
+    Can be used as registry.settings_provider
+    """
+    section = 'interpreter_tuning'
+
+    def __init__(self, path = 'config.json', hostname = None):
+        self.path = path
+        self.hostname = hostname or socket.gethostname()
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            with open(self.path) as infile:
+                content = infile.read()
+        except FileNotFoundError:
+            return {}
+        if not content.strip():
+            return {}
+        try:
+            config = json.loads(content)
+        except ValueError:
+            print(f'Could not read {self.path}, tuning results are not loaded')
+            return {}
+        return config if isinstance(config, dict) else {}
+
+    def lookup(self, model_path):
+        """
+        Tuned settings of a model on this host, or None
+        """
+        try:
+            key = model_hash(model_path)
+        except OSError:
+            return None
+        with self.lock:
+            return self.read().get(self.section, {}).get(self.hostname, {}).get(key)
+
+    def save(self, model_path, settings):
+        with self.lock:
+            config = self.read()
+            host = config.setdefault(self.section, {}).setdefault(self.hostname, {})
+            host[model_hash(model_path)] = dict(settings, model = os.path.basename(model_path))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as outfile:
+                json.dump(config, outfile, indent = 2)
+            os.replace(tmp_path, self.path)
+
+    def __call__(self, model_path):
+        return self.lookup(model_path)
+
+
+def available_delegates():
+    """
+    'xnnpack' and 'none' always, plus the external delegates whose library loads
+    """
+    delegates = ['xnnpack', 'none']
+    for name, library in DELEGATE_LIBRARIES.items():
+        if not os.path.exists(library) and ctypes.util.find_library(library[3:].split('.so')[0]) is None:
+            continue
+        try:
+            tflite.load_delegate(library)
+            delegates.append(name)
+        except (ValueError, OSError, RuntimeError):
+            pass
+    return delegates
+
+
+def candidates(max_threads = None):
+    """
+    Settings to try: powers of two thread counts up to the cores, for every delegate
+    """
+    cores = max_threads or os.cpu_count() or 1
+    threads = sorted({min(2**i, cores) for i in range(cores.bit_length() + 1)})
+    return [{'num_threads': n, 'delegate': delegate} for delegate in available_delegates() for n in threads]
+
+
+def sample_input(details, rng):
+    shape = [1, *details['shape'][1:]]
+    dtype = details['dtype']
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return rng.integers(info.min, info.max, size = shape, endpoint = True).astype(dtype)
+    return rng.random(shape, dtype = np.float32).astype(dtype)
+
+
+def time_settings(model_content, settings, repeats = 10, warmup = 2, seed = 0):
+    """
+    Median invoke time in ms of one frame with the given settings
+    """
+    interpreter = make_interpreter(model_content, settings)
+    interpreter.allocate_tensors()
+    details = interpreter.get_input_details()[0]
+    interpreter.set_tensor(details['index'], sample_input(details, np.random.default_rng(seed)))
+    for _ in range(warmup):
+        interpreter.invoke()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        interpreter.invoke()
+        times.append(1000*(time.perf_counter() - t0))
+    return float(np.median(times))
+
+
+def tune(model_path, store = None, repeats = 10, max_threads = None, log = print, progress = None):
+    """
+    Times every candidate, saves the fastest in the store and returns it.
+    progress: callable(done, total), called before each candidate
+    """
+    with open(model_path, 'rb') as model_file:
+        content = model_file.read()
+    results = []
+    settings_list = candidates(max_threads)
+    for i, settings in enumerate(settings_list):
+        if progress is not None:
+            progress(i, len(settings_list))
+        try:
+            ms = time_settings(content, settings, repeats)
+        except (ValueError, RuntimeError) as e:
+            log(f"{settings['delegate']} x{settings['num_threads']}: {e}")
+            continue
+        results.append(dict(settings, ms = ms))
+        log(f"{settings['delegate']} x{settings['num_threads']}: {ms:.2f} ms")
+    if not results:
+        raise RuntimeError(f'No interpreter settings could run {model_path}')
+    best = min(results, key = lambda r: r['ms'])
+    tuned = {'num_threads': best['num_threads'],
+             'delegate': best['delegate'],
+             'ms': best['ms'],
+             'tuned': datetime.now().isoformat(timespec = 'seconds'),
+             'candidates': results}
+    if store is not None:
+        store.save(model_path, tuned)
+    return tuned
+
+
+def main(args):
+    store = TuningStore(args['--config'])
+    max_threads = int(args['--max-threads']) if args['--max-threads'] else None
+    for model in args['MODEL']:
+        if not args['--force'] and store.lookup(model) is not None:
+            tuned = store.lookup(model)
+            print(f"{model}: already tuned on {store.hostname} ({tuned['delegate']}, {tuned['num_threads']} threads)")
+            continue
+        print(f'Tuning {model} on {store.hostname}')
+        tuned = tune(model, store, int(args['--repeats']), max_threads)
+        print(f"{model}: {tuned['delegate']} with {tuned['num_threads']} threads, {tuned['ms']:.2f} ms per frame\n")
+    return 0
+
+
+if __name__ == "__main__":
+    import docopt
+    args = docopt.docopt(__doc__)
+    sys.exit(main(args))
@@ -0,0 +1,90 @@
+#Session output images, written by a pool of threads with OpenCV encoders
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from startup import lazy_import
+
+report = lazy_import('report')    #Imports matplotlib, only needed once outputs are written
+
+
+def encode_params(path, quality = 95):
+    """
+    OpenCV encoder parameters for the format of path. quality goes from 0 to 100
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.jpg', '.jpeg'):
+        return [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    if ext == '.webp':
+        return [cv2.IMWRITE_WEBP_QUALITY, max(int(quality), 1)]
+    if ext == '.png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, int(np.clip(9 - quality//11, 0, 9))]
+    return []
+
+
+def segmented_output(img, mask, cmap = 'gray'):
+    """
+    Input image under the mask, colormapped like plt.imsave (normalized to its own
+    range). img is (H,W) or (H,W,C), mask is (S,S) or (S,S,1) in any resolution
+    Returns a BGR uint8 image ready for cv2.imwrite
+    """
+    if img.ndim == 3:
+        img = img[:,:,0]
+    mask = np.asarray(mask, dtype = 'float32').reshape(mask.shape[0], mask.shape[1])
+    mask = cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation = cv2.INTER_NEAREST)
+    values = mask*img
+    rgb = report.colorize(values, values.min(), values.max(), cmap)
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+
+def read_channel(path):
+    """
+    First (red) channel of an image file, as plt.imread(path)[:,:,0]
+    """
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError(f'Could not read {path}')
+    return img[:,:,2]
+
+
+class OutputWriter():
+    """
+    Writes segmented outputs in background threads. Frames can be given in memory or
+    as the path of the input file, which is then decoded in the worker thread.
+    format overrides the extension of the output paths (e.g. 'png', 'webp')
+    """
+    def __init__(self, workers = None, quality = 95, format = None):
+        self.quality = quality
+        self.format = format
+        self.executor = ThreadPoolExecutor(workers or min(4, os.cpu_count() or 1))
+
+    def output_path(self, path):
+        if self.format is None:
+            return path
+        return os.path.splitext(path)[0] + '.' + self.format
+
+    def _write(self, path, mask, image, source, cmap):
+        if image is None:
+            image = read_channel(source)
+        if not cv2.imwrite(path, segmented_output(image, mask, cmap), encode_params(path, self.quality)):
+            raise IOError(f'Could not write {path}')
+        return path
+
+    def submit(self, path, mask, image = None, source = None, cmap = 'gray'):
+        """
+        Queues one output. Returns a future with the written path
+        """
+        return self.executor.submit(self._write, self.output_path(path), mask, image, source, cmap)
+
+    def write_session(self, paths, masks, images = None, sources = None, cmap = 'gray'):
+        """
+        Queues the outputs of a whole session. Returns one future per frame
+        """
+        return [self.submit(path, masks[i],
+                            image = None if images is None else images[i],
+                            source = None if sources is None else sources[i], cmap = cmap)
+                for i, path in enumerate(paths)]
+
+    def close(self, wait = True):
+        self.executor.shutdown(wait = wait)